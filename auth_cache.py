@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Сколько секунд доверяем закэшированным правам пользователя
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '300'))
+# Максимальное количество пользователей в кэше (самые давние вытесняются)
+AUTH_CACHE_MAX_SIZE = int(os.environ.get('AUTH_CACHE_MAX_SIZE', '10000'))
+
+# Сведения о пользователе из таблицы users. user_id здесь - ID найденной строки:
+# он отличается от Telegram ID, если пользователь найден по username с временным ID
+Profile = namedtuple('Profile', ['user_id', 'username', 'first_name', 'last_name'])
+
+# Права автора обновления; profile равен None, если пользователь не найден в users
+Principal = namedtuple('Principal', ['user_id', 'is_authorized', 'is_admin', 'profile'])
+
+
+class AuthCache:
+    """
+    Кэш прав доступа в памяти процесса: Telegram user_id -> Principal.
+
+    Записи живут не дольше ttl секунд. Команды, меняющие состав пользователей
+    или их роли, должны вызывать invalidate(), чтобы изменения вступали в силу сразу.
+    """
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, max_size=AUTH_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # user_id -> (Principal, момент устаревания)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Возвращает Principal или None, если записи нет или она устарела"""
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is None:
+                return None
+            principal, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return principal
+
+    def set(self, principal):
+        with self._lock:
+            self._entries[principal.user_id] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(principal.user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return principal
+
+    def invalidate(self, user_id=None):
+        """
+        Сбрасывает записи пользователя, а без аргумента - весь кэш. user_id может быть
+        и ID строки в users: тогда сбрасываются и записи тех, кто найден по этой строке
+        (например, по username с временным ID)
+        """
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                return
+            self._entries.pop(user_id, None)
+            stale = [key for key, (principal, _) in self._entries.items()
+                     if principal.profile is not None and principal.profile.user_id == user_id]
+            for key in stale:
+                del self._entries[key]
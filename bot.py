@@ -1,24 +1,71 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import functools
 import logging
-import sqlite3
 import os
 import time
 import re
 import random
 import signal
 import sys
+import threading
+from collections import namedtuple
 from datetime import datetime, timedelta
 import pytz
-from telegram import Update, ParseMode, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler
+from telegram import (Update, ParseMode, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardMarkup,
+                      InlineKeyboardButton)
+from telegram.error import BadRequest
+from telegram.ext import (CommandHandler, MessageHandler, TypeHandler, CallbackQueryHandler, Filters,
+                          CallbackContext, ConversationHandler, DispatcherHandlerStop)
+from psycopg2.extras import execute_values
 
 # Импортируем класс анализатора видео
 from video_analyzer import VideoDownloadsAnalyzer
 
 # Импортируем модуль для работы с базой данных
-from db_utils import setup_database, get_db_connection, load_buttons, save_button
+from db_utils import (setup_database, db_connection, close_db_connections, load_buttons_versioned, save_button,
+                      get_data_version, DATA_VERSION_LESSONS, normalize_username, db_timestamp, format_timestamp,
+                      parse_display_time, get_or_create_lesson, execute_statement, LESSON_ACTION_PREFIX,
+                      load_lesson_catalog_versioned, publish_lesson, retire_lesson, create_broadcast,
+                      finish_broadcast, get_recent_broadcasts, get_last_update_id, save_last_update_id)
+
+# Импортируем кэш прав доступа
+from auth_cache import AuthCache, Principal, Profile
+
+# Импортируем фоновую запись логов
+from log_writer import LogWriter
+
+# Импортируем реестр кнопок в памяти
+from button_registry import ButtonRegistry, BUTTONS_VERSION_CHECK_INTERVAL
+
+# Импортируем кэш готовых клавиатур
+from keyboard_cache import KeyboardCache, make_keyboard
+
+# Импортируем планировщик исходящих сообщений
+from send_scheduler import SendScheduler, PRIORITY_INTERACTIVE, PRIORITY_BULK, SEND_CONCURRENCY
+
+# Импортируем фоновое выполнение рассылок
+from broadcaster import Broadcaster, STATUS_RUNNING, STATUS_CANCELLED, BROADCAST_CHECK_INTERVAL
+
+# Импортируем ограничитель частоты запросов
+from rate_limiter import RateLimiter, ALLOW, SHED_NOTIFY, CLASS_BUTTON, CLASS_START, CLASS_COMMAND
+
+# Импортируем пул обработки обновлений с очередью на каждого пользователя
+from update_sequencer import UpdateSequencer, UPDATE_WORKERS
+
+# Импортируем учет обработанных обновлений
+from update_tracker import UpdateTracker, DrainMarker, UPDATE_MAX_AGE, UPDATE_OFFSET_SAVE_INTERVAL
+
+# Импортируем получение обновлений длинным опросом
+from update_poller import PollingUpdater, POLL_TIMEOUT, POLL_INTERVAL
+
+# Импортируем прием обновлений через вебхук
+from webhook_server import (WebhookUpdater, webhook_url, UPDATE_MODE, UPDATE_MODE_WEBHOOK, WEBHOOK_URL,
+                            WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS)
+
+# Импортируем выбор ведущего экземпляра через базу данных
+from leader_election import LeaderElection
 
 # Импортируем функцию инициализации базы данных
 try:
@@ -43,20 +90,62 @@ MSG_PREVIOUS_LESSON = '''Запись занятия: https://drive.google.com/d
 
 Запись доступна в течение 7 дней.'''
 
+# Количество кнопок занятий, которые можно настроить командами /button<номер>
+LESSON_BUTTONS_COUNT = int(os.environ.get('LESSON_BUTTONS_COUNT', '2'))
+
 # Третья кнопка (обновление клавиатуры)
 BUTTON_REFRESH = 'Обновить'
 
-# Словарь для хранения кнопок и сообщений
+# Словарь для хранения кнопок занятий и сообщений (кнопка "Обновить" в него не входит)
 BUTTONS = {
     1: {'text': BUTTON_LATEST_LESSON, 'message': MSG_LATEST_LESSON},
-    2: {'text': BUTTON_PREVIOUS_LESSON, 'message': MSG_PREVIOUS_LESSON},
-    3: {'text': BUTTON_REFRESH, 'message': ''}
+    2: {'text': BUTTON_PREVIOUS_LESSON, 'message': MSG_PREVIOUS_LESSON}
 }
 
+# Каталог занятий: на клавиатуре показываются столько последних опубликованных занятий
+LESSON_KEYBOARD_SIZE = int(os.environ.get('LESSON_KEYBOARD_SIZE', '2'))
+# Через сколько дней опубликованное занятие снимается с показа (0 - не снимается)
+LESSON_TTL_DAYS = float(os.environ.get('LESSON_TTL_DAYS', '7'))
+# Текст кнопки занятия по его названию
+LESSON_BUTTON_TEMPLATE = os.environ.get('LESSON_BUTTON_TEMPLATE', 'Запись занятия {title}')
+
+# Дата занятия в тексте кнопки, например "18 мая"
+LESSON_DATE_PATTERN = re.compile(r'\d{1,2} \w+')
+# За сколько секунд до запланированной публикации или снятия занятия заранее
+# загружать новый каталог и строить клавиатуры
+LESSON_PREPARE_AHEAD = float(os.environ.get('LESSON_PREPARE_AHEAD', '60'))
+
+# Все, что нужно для ответа на нажатие кнопки занятия: вычисляется при изменении каталога
+ButtonAction = namedtuple('ButtonAction', ['reply', 'lesson_id', 'action', 'action_data',
+                                           'published_at', 'expires_at'])
+# Как показывать кнопки занятий: 'reply' - обычная клавиатура под полем ввода,
+# 'inline' - встроенная клавиатура под сообщением, нажатия приходят как callback-запросы
+KEYBOARD_MODE = os.environ.get('KEYBOARD_MODE', 'reply')
+KEYBOARD_MODE_REPLY = 'reply'
+KEYBOARD_MODE_INLINE = 'inline'
+
+# Виды клавиатуры: обычная, после активации аккаунта (без кнопки "Обновить") и встроенная
+KEYBOARD_MEMBER = 'member'
+KEYBOARD_ACTIVATED = 'activated'
+KEYBOARD_INLINE = 'inline'
+
+# callback_data встроенной клавиатуры: "l:<версия каталога>:<ID занятия>" и "r" (обновить)
+CALLBACK_LESSON = 'l'
+CALLBACK_REFRESH = 'r'
+
+# Текст кнопки -> ButtonAction; словарь целиком заменяется при перестроении
+BUTTON_ACTIONS = {}
+# ID занятия -> ButtonAction для нажатий встроенной клавиатуры
+LESSON_ACTIONS_BY_ID = {}
+# Кнопки занятий каталога, новые первыми: (текст, начало показа, конец показа)
+LESSON_BUTTONS = []
+
 # Общие тексты сообщений
 MSG_WELCOME = 'Привет, я бот для занятий по авангардному кино. Чтобы получить запись прошедшего занятия, нажми кнопку. Записи хранятся 7 дней.'
 MSG_ACCOUNT_ACTIVATED = 'Аккаунт активирован. Используй кнопки для доступа к записям занятий.'
 MSG_NOT_AUTHORIZED = 'Чтобы получить доступ, напиши @tovlad.'
+MSG_RATE_LIMITED = 'Слишком много запросов. Подожди немного и попробуй снова.'
+MSG_LESSON_UNAVAILABLE = 'Эта запись больше недоступна. Нажми «Обновить».'
 
 # Enable logging
 logging.basicConfig(
@@ -67,55 +156,268 @@ logger = logging.getLogger(__name__)
 # Функция setup_database теперь в модуле db_utils
 # Администратор также добавляется в модуле db_utils
 
-# User authentication
-def is_user_authorized(user_id, username=None, phone_number=None):
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Проверяем по ID
-    if db_type == 'postgres':
-        cursor.execute("SELECT user_id FROM users WHERE user_id = %s", (user_id,))
-    else:
-        cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    
-    # Если не нашли по ID, но есть username, проверяем по нему
-    if result is None and username:
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM users WHERE username = %s", (username,))
-        else:
-            cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
-        result = cursor.fetchone()
-    
-    # Если не нашли по ID и username, но есть phone_number, проверяем по нему
-    if result is None and phone_number:
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM users WHERE phone_number = %s", (phone_number,))
-        else:
-            cursor.execute("SELECT user_id FROM users WHERE phone_number = ?", (phone_number,))
-        result = cursor.fetchone()
-    
-    conn.close()
-    return result is not None
+# Кэш прав доступа: известный пользователь проверяется без обращения к базе
+auth_cache = AuthCache()
 
-def is_admin(user_id):
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
+# User authentication
+def resolve_principal(user_id, username=None, phone_number=None):
+    """
+    Определяет права пользователя одним запросом: строка с совпадающим ID
+    имеет приоритет, иначе подходит строка с тем же username или телефоном.
+    """
+    principal = auth_cache.get(user_id)
+    if principal is not None:
+        return principal
+    
+    # Отсутствующие username и телефон передаются как NULL и ни с чем не совпадают
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        execute_statement(cursor, db_type, 'principal_lookup',
+                          (user_id, normalize_username(username), phone_number or None, user_id))
+        row = cursor.fetchone()
     
-    if db_type == 'postgres':
-        cursor.execute("SELECT is_admin FROM users WHERE user_id = %s", (user_id,))
+    if row is None:
+        principal = Principal(user_id, False, False, None)
     else:
-        cursor.execute("SELECT is_admin FROM users WHERE user_id = ?", (user_id,))
+        row_user_id, row_username, first_name, last_name, admin_flag = row
+        # Права администратора даются только строке с собственным ID пользователя
+        principal = Principal(
+            user_id,
+            True,
+            bool(admin_flag) and row_user_id == user_id,
+            Profile(row_user_id, row_username, first_name, last_name)
+        )
+    return auth_cache.set(principal)
+
+def get_principal(update: Update, context: CallbackContext):
+    """Возвращает права автора обновления, определенные один раз на обновление"""
+    principal = getattr(context, 'principal', None)
+    if principal is None:
+        user = update.effective_user
+        principal = resolve_principal(user.id, user.username)
+        context.principal = principal
+    return principal
+
+# Планировщик исходящих сообщений: все ответы идут через него с учетом лимитов Telegram
+send_scheduler = SendScheduler()
+
+# Пул обработки обновлений: обновления одного пользователя по порядку, разных - параллельно
+update_sequencer = UpdateSequencer()
+
+def sequence_key(update: Update):
+    """Ключ очереди обновления: ID пользователя, а для обновлений без автора - само обновление"""
+    if update.effective_user:
+        return update.effective_user.id
+    return ('update', update.update_id)
+
+def sequenced(callback):
+    """
+    Оборачивает обработчик так, что он выполняется в пуле update_sequencer,
+    а поток диспетчера сразу переходит к следующему обновлению. Права автора
+    определяются уже в очереди пользователя, поэтому учитывают результат его
+    предыдущих обновлений (например, активацию по первому /start).
+    """
+    @functools.wraps(callback)
+    def run_sequenced(update: Update, context: CallbackContext) -> None:
+        def task():
+            try:
+                if update.effective_user:
+                    context.principal = None
+                    get_principal(update, context)
+                callback(update, context)
+            except Exception as e:
+                context.dispatcher.dispatch_error(update, e)
+            finally:
+                update_tracker.task_done(update.update_id)
+        update_tracker.add_task(update.update_id)
+        update_sequencer.submit(sequence_key(update), task)
+    return run_sequenced
+
+# Учет обработанных обновлений: ID последнего из них сохраняется в базе, чтобы после
+# перезапуска не обрабатывать обновления повторно
+update_tracker = UpdateTracker(get_last_update_id, save_last_update_id)
+# ID сохраняется и восстанавливается только в режиме опроса, где обновления получает
+# один ведущий экземпляр. Вебхук принимают все экземпляры, и общий ID одного из них
+# отбросил бы обновления, которые Telegram повторно доставляет другому
+TRACK_UPDATE_OFFSET = UPDATE_MODE != UPDATE_MODE_WEBHOOK
+
+def track_update(update: Update, context: CallbackContext) -> None:
+    """
+    Предобработчик (группа -3): учитывает обновление; уже обработанные до перезапуска
+    и слишком старые сообщения дальше не передаются
+    """
+    if update_tracker.is_processed(update.update_id):
+        logger.info(f"Обновление {update.update_id} уже обработано до перезапуска")
+        raise DispatcherHandlerStop()
+    
+    update_tracker.begin(update.update_id)
+    message = update.message
+    if UPDATE_MAX_AGE > 0 and message is not None and message.date is not None:
+        age = time.time() - message.date.timestamp()
+        if age > UPDATE_MAX_AGE:
+            logger.info(f"Обновление {update.update_id} пропущено: сообщение отправлено {age:.0f} с назад")
+            update_tracker.end_dispatch(update.update_id)
+            raise DispatcherHandlerStop()
+
+def finish_update(update: Update, context: CallbackContext) -> None:
+    """Последняя группа обработчиков: диспетчер закончил разбор обновления"""
+    update_tracker.end_dispatch(update.update_id)
+
+def save_update_offset(context: CallbackContext) -> None:
+    """Периодическая задача: сохраняет ID последнего обработанного обновления"""
+    update_tracker.save()
+
+def mark_drained(marker: DrainMarker, context: CallbackContext) -> None:
+    """Диспетчер дошел до маркера: все обновления перед ним разобраны"""
+    marker.done.set()
+
+def reply(update: Update, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """
+    Отвечает на сообщение пользователя через планировщик отправки.
+    Возвращает Future с отправленным сообщением.
+    """
+    message = update.effective_message
+    return send_scheduler.submit(message.chat_id, lambda: message.reply_text(text, **kwargs), priority)
+
+# Ограничитель частоты запросов: работает до определения прав и любых запросов к базе
+rate_limiter = RateLimiter()
+
+def classify_update(update: Update):
+    """Класс запроса для ограничителя и его содержимое для поиска повторов"""
+    if update.callback_query is not None:
+        return CLASS_BUTTON, update.callback_query.data
+    message = update.effective_message
+    text = message.text if message is not None else None
+    if not text:
+        return CLASS_COMMAND, None
+    if text.startswith('/'):
+        command = text.split()[0].split('@')[0].lower()
+        return (CLASS_START if command in ('/start', '/refresh') else CLASS_COMMAND), text
+    return CLASS_BUTTON, text
+
+def rate_limit(update: Update, context: CallbackContext) -> None:
+    """
+    Предобработчик (группа -2): повторные нажатия молча отбрасываются, а запросы
+    сверх лимита - после одного предупреждения. Отброшенное обновление не доходит
+    ни до одного обработчика. Администраторы, чьи права уже в кэше, не ограничиваются.
+    """
+    user = update.effective_user
+    if user is None:
+        return
+    principal = auth_cache.get(user.id)
+    if principal is not None and principal.is_admin:
+        return
     
-    result = cursor.fetchone()
-    conn.close()
+    request_class, payload = classify_update(update)
+    verdict = rate_limiter.check(user.id, request_class, payload)
+    if verdict == ALLOW:
+        return
     
-    if db_type == 'postgres':
-        return result and result[0] is True
-    else:
-        return result and result[0] == 1
-
-# Функция загрузки настроек кнопок
+    if verdict == SHED_NOTIFY:
+        logger.warning(f"Пользователь {user.id} превысил лимит запросов ({request_class})")
+    if update.callback_query is not None:
+        # Нажатие отвечаем всегда, иначе на кнопке крутится индикатор до таймаута Telegram
+        try:
+            update.callback_query.answer(MSG_RATE_LIMITED if verdict == SHED_NOTIFY else None)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить на отброшенное нажатие: {e}")
+    elif verdict == SHED_NOTIFY and update.effective_message is not None:
+        reply(update, MSG_RATE_LIMITED)
+    # Группа 1 (finish_update) не будет вызвана: отбрасываемое обновление обработано здесь
+    update_tracker.end_dispatch(update.update_id)
+    raise DispatcherHandlerStop()
+
+# Реестр кнопок: нажатия читают только память, каталог занятий читается после
+# публикации или когда периодическая проверка видит новую версию каталога
+button_registry = ButtonRegistry(load_lesson_catalog_versioned, lambda: get_data_version(DATA_VERSION_LESSONS))
+
+def lesson_title_from_button(button_text):
+    """Название занятия по тексту кнопки: дата из текста, а если ее нет - весь текст"""
+    date_match = LESSON_DATE_PATTERN.search(button_text)
+    return date_match.group(0) if date_match else button_text
+
+def lesson_expiry(days=None, published_at=None):
+    """
+    Момент снятия занятия с показа (Unix-время) через days дней после публикации
+    (по умолчанию - после текущего момента) или None, если срок не ограничен
+    """
+    days = LESSON_TTL_DAYS if days is None else days
+    start = time.time() if published_at is None else published_at
+    return start + days * 86400 if days > 0 else None
+
+def is_lesson_shown(published_at, expires_at, now=None):
+    """Показывается ли занятие в момент now"""
+    now = time.time() if now is None else now
+    return (published_at is None or published_at <= now) and (expires_at is None or expires_at > now)
+
+def button_tables(lessons):
+    """
+    Строит таблицу текст кнопки -> ButtonAction для всех занятий каталога,
+    чтобы нажатие обходилось одним поиском в словаре без разбора текста.
+    Возвращает (таблицу по тексту, таблицу по ID занятия, список кнопок занятий).
+    """
+    actions = {}
+    actions_by_id = {}
+    buttons = []
+    for lesson in lessons:
+        text = LESSON_BUTTON_TEMPLATE.format(title=lesson.title)
+        if text in actions:
+            continue
+        action = ButtonAction(lesson.message, lesson.id, f'{LESSON_ACTION_PREFIX}{lesson.title}', text,
+                              lesson.published_at, lesson.expires_at)
+        actions[text] = action
+        actions_by_id[lesson.id] = action
+        buttons.append((text, lesson.id, lesson.published_at, lesson.expires_at))
+    return actions, actions_by_id, buttons
+
+def rebuild_button_actions(lessons):
+    """Перестраивает таблицы нажатий для нового набора занятий каталога"""
+    global BUTTON_ACTIONS, LESSON_ACTIONS_BY_ID, LESSON_BUTTONS
+    
+    # Заменяем таблицы целиком: обработчики видят либо старую, либо новую версию
+    BUTTON_ACTIONS, LESSON_ACTIONS_BY_ID, LESSON_BUTTONS = button_tables(lessons)
+
+button_registry.on_change(rebuild_button_actions)
+
+def build_keyboard(version, layout, now=None, buttons=None):
+    """
+    Клавиатура с кнопками последних LESSON_KEYBOARD_SIZE занятий, которые показываются
+    в момент now (по умолчанию - сейчас), и (кроме клавиатуры после активации) кнопкой
+    "Обновить". Во встроенной клавиатуре кнопки несут короткие callback_data с версией
+    каталога и ID занятия. buttons - список кнопок занятий (по умолчанию LESSON_BUTTONS).
+    Возвращает (клавиатура, момент ближайшей публикации или снятия занятия или None).
+    """
+    now = time.time() if now is None else now
+    lessons = []
+    valid_until = None
+    for text, lesson_id, published_at, expires_at in (LESSON_BUTTONS if buttons is None else buttons):
+        for moment in (published_at, expires_at):
+            if moment is not None and moment > now and (valid_until is None or moment < valid_until):
+                valid_until = moment
+        if len(lessons) < LESSON_KEYBOARD_SIZE and is_lesson_shown(published_at, expires_at, now):
+            lessons.append((text, lesson_id))
+    
+    if layout == KEYBOARD_INLINE:
+        rows = [[InlineKeyboardButton(text, callback_data=f'{CALLBACK_LESSON}:{version or 0}:{lesson_id}')]
+                for text, lesson_id in lessons]
+        rows.append([InlineKeyboardButton(BUTTON_REFRESH, callback_data=CALLBACK_REFRESH)])
+        return InlineKeyboardMarkup(rows), valid_until
+    
+    rows = [[text for text, _ in lessons]]
+    if layout != KEYBOARD_ACTIVATED:
+        rows.append([BUTTON_REFRESH])
+    return ReplyKeyboardMarkup(rows, resize_keyboard=True), valid_until
+
+# Сериализованные клавиатуры по версии каталога и виду клавиатуры
+keyboard_cache = KeyboardCache(build_keyboard)
+
+def current_keyboard(layout=KEYBOARD_MEMBER):
+    """Готовая клавиатура для текущей версии каталога; в режиме inline - всегда встроенная"""
+    if KEYBOARD_MODE == KEYBOARD_MODE_INLINE:
+        layout = KEYBOARD_INLINE
+    return keyboard_cache.get(button_registry.version, layout)
+
+# Функция загрузки каталога занятий
 def load_buttons_from_db():
     global BUTTON_LATEST_LESSON, MSG_LATEST_LESSON, BUTTON_PREVIOUS_LESSON, MSG_PREVIOUS_LESSON, BUTTONS
     
@@ -138,26 +440,110 @@ def load_buttons_from_db():
         BUTTONS[2]['text'] = BUTTON_PREVIOUS_LESSON
         BUTTONS[2]['message'] = MSG_PREVIOUS_LESSON
     
-    # Затем загружаем настройки из базы данных
-    buttons_data = load_buttons()
-    
-    # Обновляем глобальные переменные из загруженных данных
-    if 1 in buttons_data:
-        BUTTON_LATEST_LESSON = buttons_data[1]['text']
-        MSG_LATEST_LESSON = buttons_data[1]['message']
-        BUTTONS[1]['text'] = BUTTON_LATEST_LESSON
-        BUTTONS[1]['message'] = MSG_LATEST_LESSON
-    
-    if 2 in buttons_data:
-        BUTTON_PREVIOUS_LESSON = buttons_data[2]['text']
-        MSG_PREVIOUS_LESSON = buttons_data[2]['message']
-        BUTTONS[2]['text'] = BUTTON_PREVIOUS_LESSON
-        BUTTONS[2]['message'] = MSG_PREVIOUS_LESSON
+    # Затем загружаем кнопки, сохраненные командами /button<номер>
+    buttons_data = load_buttons_versioned()[1]
+    for button_number, data in buttons_data.items():
+        BUTTONS[button_number] = {'text': data['text'], 'message': data['message']}
     
     # Если нет данных в базе, сохраняем значения по умолчанию
     if not buttons_data:
-        save_button_to_db(1, BUTTON_LATEST_LESSON, MSG_LATEST_LESSON)
-        save_button_to_db(2, BUTTON_PREVIOUS_LESSON, MSG_PREVIOUS_LESSON)
+        save_button_to_db(1, BUTTONS[1]['text'], BUTTONS[1]['message'])
+        save_button_to_db(2, BUTTONS[2]['text'], BUTTONS[2]['message'])
+    
+    # Загружаем каталог занятий (rebuild_button_actions перестроит таблицу нажатий)
+    lessons = button_registry.reload()
+    
+    # Пустой каталог заполняем сохраненными кнопками: первая кнопка - самое новое занятие
+    if not lessons:
+        for button_number in sorted(BUTTONS, reverse=True):
+            publish_lesson(lesson_title_from_button(BUTTONS[button_number]['text']),
+                           BUTTONS[button_number]['message'])
+        button_registry.reload()
+
+def check_buttons_version(context: CallbackContext) -> None:
+    """Периодическая задача: перечитывает каталог, если его изменили в обход этого процесса"""
+    button_registry.check_version()
+
+# Имя задач JobQueue для ближайшей смены каталога и подготовленный для нее набор
+ROTATION_JOB_NAME = 'lesson_rotation'
+ROTATION_SNAPSHOT = None
+rotation_lock = threading.Lock()
+
+def keyboard_layouts():
+    """Виды клавиатур, которые отправляет бот в текущем режиме"""
+    if KEYBOARD_MODE == KEYBOARD_MODE_INLINE:
+        return (KEYBOARD_INLINE,)
+    return (KEYBOARD_MEMBER, KEYBOARD_ACTIVATED)
+
+def schedule_lesson_rotation(lessons=None):
+    """
+    Планирует в JobQueue ближайшую публикацию или снятие занятия: подготовку нового
+    набора за LESSON_PREPARE_AHEAD секунд и его установку точно в срок.
+    Вызывается после каждой перезагрузки каталога; прежние задачи отменяются.
+    """
+    global ROTATION_SNAPSHOT
+    
+    if global_updater is None:
+        return
+    
+    now = time.time()
+    moments = [moment for _, _, published_at, expires_at in LESSON_BUTTONS
+               for moment in (published_at, expires_at) if moment is not None and moment > now]
+    
+    job_queue = global_updater.job_queue
+    with rotation_lock:
+        for job in job_queue.get_jobs_by_name(ROTATION_JOB_NAME):
+            job.schedule_removal()
+        ROTATION_SNAPSHOT = None
+        if not moments:
+            return
+        
+        moment = min(moments)
+        job_queue.run_once(prepare_lesson_rotation, max(0, moment - LESSON_PREPARE_AHEAD - now),
+                           context=moment, name=ROTATION_JOB_NAME)
+        job_queue.run_once(apply_lesson_rotation, moment - now, context=moment, name=ROTATION_JOB_NAME)
+    logger.info(f"Следующая смена каталога запланирована на {format_timestamp(moment)}")
+
+button_registry.on_change(schedule_lesson_rotation)
+
+def prepare_lesson_rotation(context: CallbackContext) -> None:
+    """Задача JobQueue: заранее загружает каталог на момент смены и строит клавиатуры"""
+    global ROTATION_SNAPSHOT
+    
+    moment = context.job.context
+    try:
+        version, lessons = load_lesson_catalog_versioned(at=moment)
+        buttons = button_tables(lessons)[2]
+        keyboards = {}
+        for layout in keyboard_layouts():
+            reply_markup, valid_until = build_keyboard(version, layout, now=moment, buttons=buttons)
+            keyboards[layout] = (make_keyboard(reply_markup), valid_until)
+    except Exception as e:
+        logger.error(f"Не удалось подготовить смену каталога: {e}")
+        return
+    
+    with rotation_lock:
+        ROTATION_SNAPSHOT = (moment, version, lessons, keyboards)
+
+def apply_lesson_rotation(context: CallbackContext) -> None:
+    """
+    Задача JobQueue: устанавливает подготовленный набор в момент смены каталога.
+    Если набор не подготовлен или каталог с тех пор изменился, каталог перечитывается.
+    """
+    moment = context.job.context
+    with rotation_lock:
+        snapshot = ROTATION_SNAPSHOT
+    
+    try:
+        if snapshot is not None and snapshot[0] == moment and snapshot[1] == button_registry.version:
+            _, version, lessons, keyboards = snapshot
+            # Сначала клавиатуры: к моменту смены таблиц нажатий они уже готовы
+            keyboard_cache.install(version, keyboards)
+            button_registry.install(version, lessons)
+        else:
+            button_registry.reload()
+    except Exception as e:
+        logger.error(f"Не удалось сменить каталог: {e}")
 
 def save_button_to_db(button_number, button_text, message_text):
     # Используем функцию из модуля db_utils для сохранения настроек кнопок
@@ -199,40 +585,76 @@ def save_button_to_db(button_number, button_text, message_text):
         logger.error(f"Error saving environment variables: {e}")
 
 # Log user actions with detailed information
-def log_action(user_id, action, action_data=None):
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get user information
-    if db_type == 'postgres':
-        cursor.execute("SELECT username, first_name, last_name FROM users WHERE user_id = %s", (user_id,))
-    else:
-        cursor.execute("SELECT username, first_name, last_name FROM users WHERE user_id = ?", (user_id,))
-    
-    user_info = cursor.fetchone()
-    
-    if user_info:
-        username, first_name, last_name = user_info
-    else:
-        username, first_name, last_name = None, None, None
-    
-    # Current timestamp
-    now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
-    
-    # Insert log with detailed information
-    if db_type == 'postgres':
-        cursor.execute(
-            "INSERT INTO logs (user_id, username, first_name, last_name, action, action_data, timestamp) VALUES (%s, %s, %s, %s, %s, %s, %s)", 
-            (user_id, username, first_name, last_name, action, action_data, now)
-        )
-    else:
-        cursor.execute(
-            "INSERT INTO logs (user_id, username, first_name, last_name, action, action_data, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)", 
-            (user_id, username, first_name, last_name, action, action_data, now)
-        )
-    
-    conn.commit()
-    conn.close()
+def write_log_batch(rows):
+    """Сохраняет пачку записей лога одной транзакцией (вызывается фоновым потоком LogWriter)"""
+    # Скачивания занятий сворачиваем по (занятие, пользователь) для lesson_downloads
+    downloads = {}
+    for user_id, action, action_data, ts, lesson_id in rows:
+        if lesson_id is not None:
+            first_seen, count = downloads.get((lesson_id, user_id), (ts, 0))
+            downloads[(lesson_id, user_id)] = (min(first_seen, ts), count + 1)
+    
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        
+        # Имена пользователей в логи не копируются: они берутся из users при чтении
+        if db_type == 'postgres':
+            execute_values(
+                cursor,
+                "INSERT INTO logs (user_id, action, action_data, timestamp, lesson_id) VALUES %s",
+                rows,
+                template="(%s, %s, %s, to_timestamp(%s), %s)"
+            )
+        else:
+            cursor.executemany(
+                "INSERT INTO logs (user_id, action, action_data, timestamp, lesson_id) VALUES (?, ?, ?, ?, ?)", 
+                [(user_id, action, action_data, int(ts), lesson_id)
+                 for user_id, action, action_data, ts, lesson_id in rows]
+            )
+        
+        # Обновляем счетчики скачиваний в той же транзакции, что и сами логи
+        if downloads:
+            download_rows = [
+                (lesson_id, user_id, first_seen, count)
+                for (lesson_id, user_id), (first_seen, count) in downloads.items()
+            ]
+            if db_type == 'postgres':
+                execute_values(
+                    cursor,
+                    "INSERT INTO lesson_downloads (lesson_id, user_id, first_seen, count) VALUES %s "
+                    "ON CONFLICT (lesson_id, user_id) DO UPDATE SET count = lesson_downloads.count + EXCLUDED.count",
+                    download_rows,
+                    template="(%s, %s, to_timestamp(%s), %s)"
+                )
+            else:
+                cursor.executemany(
+                    "INSERT INTO lesson_downloads (lesson_id, user_id, first_seen, count) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (lesson_id, user_id) DO UPDATE SET count = count + excluded.count",
+                    [(lesson_id, user_id, int(first_seen), count)
+                     for lesson_id, user_id, first_seen, count in download_rows]
+                )
+        
+        conn.commit()
+
+# Фоновая запись логов: обработчики не ждут коммита в базу
+log_writer = LogWriter(write_log_batch)
+
+def log_action(user_id, action, action_data=None, lesson_id=None):
+    # Время записывается как Unix-время и форматируется только при показе
+    log_writer.enqueue((user_id, action, action_data, time.time(), lesson_id))
+
+# Кэш ID занятий: название (дата) -> lessons.id
+LESSON_IDS = {}
+
+def get_lesson_id(title):
+    """ID занятия по его названию; новое занятие создается при первом обращении"""
+    lesson_id = LESSON_IDS.get(title)
+    if lesson_id is None:
+        with db_connection() as (conn, db_type):
+            lesson_id = get_or_create_lesson(conn, db_type, title)
+            conn.commit()
+        LESSON_IDS[title] = lesson_id
+    return lesson_id
 
 # Command handlers
 def start(update: Update, context: CallbackContext) -> None:
@@ -242,145 +664,130 @@ def start(update: Update, context: CallbackContext) -> None:
     first_name = user.first_name
     last_name = user.last_name
     
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
+    principal = get_principal(update, context)
     
-    # Проверяем, есть ли пользователь с таким username, но с временным ID (отрицательным)
-    if username:
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM users WHERE username = %s AND user_id < 0", (username,))
-        else:
-            cursor.execute("SELECT user_id FROM users WHERE username = ? AND user_id < 0", (username,))
-        
-        temp_user = cursor.fetchone()
+    # Проверяем, найден ли пользователь по username, но с временным ID (отрицательным)
+    temp_user = principal.profile is not None and principal.profile.user_id < 0
+    
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
         
         if temp_user:
             # Нашли пользователя с временным ID, обновляем на реальный ID
-            temp_user_id = temp_user[0]
+            temp_user_id = principal.profile.user_id
             
             # Обновляем пользователя с временным ID на реальный
-            if db_type == 'postgres':
-                cursor.execute(
-                    "UPDATE users SET user_id = %s, first_name = %s, last_name = %s WHERE user_id = %s", 
-                    (user_id, first_name, last_name, temp_user_id)
-                )
-            else:
-                cursor.execute(
-                    "UPDATE users SET user_id = ?, first_name = ?, last_name = ? WHERE user_id = ?", 
-                    (user_id, first_name, last_name, temp_user_id)
-                )
+            execute_statement(cursor, db_type, 'user_activate', (user_id, first_name, last_name, temp_user_id))
             conn.commit()
-            
-            # Теперь пользователь авторизован
-            keyboard = [
-                [BUTTON_LATEST_LESSON, BUTTON_PREVIOUS_LESSON]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
-            update.message.reply_text(
-                MSG_ACCOUNT_ACTIVATED.format(first_name),
-                reply_markup=reply_markup
-            )
-            log_action(user_id, 'start_activated', 'account_activation')
-            conn.close()
-            return
-    
-    # Стандартная проверка авторизации
-    if is_user_authorized(user_id, username) or is_admin(user_id):
-        # Обновляем информацию о пользователе
-        if db_type == 'postgres':
-            cursor.execute(
-                "UPDATE users SET username = %s, first_name = %s, last_name = %s WHERE user_id = %s", 
-                (username, first_name, last_name, user_id)
-            )
+            # Пользователь мог быть закэширован как неавторизованный до активации
+            auth_cache.invalidate(user_id)
+            authorized = True
         else:
-            cursor.execute(
-                "UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?", 
-                (username, first_name, last_name, user_id)
-            )
-        conn.commit()
-        
-        keyboard = [
-            [BUTTON_LATEST_LESSON, BUTTON_PREVIOUS_LESSON],
-            [BUTTON_REFRESH]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            # Стандартная проверка авторизации
+            authorized = principal.is_authorized
+            
+            if authorized:
+                # Администратор мог добавить этот никнейм еще раз, уже с временным ID: такая
+                # строка - дубликат, ее права администратора переходят к настоящей строке
+                username_key = normalize_username(username)
+                promoted = False
+                if username_key is not None:
+                    promoted = execute_statement(cursor, db_type, 'user_inherit_temp_admin',
+                                                 (user_id, username_key)).rowcount > 0
+                    execute_statement(cursor, db_type, 'user_delete_temp_duplicate', (username_key,))
+                
+                # Никнеймы в Telegram уникальны: если этот никнейм числится за строкой другого
+                # пользователя, данные там устарели, освобождаем его (username_key - уникальный индекс)
+                execute_statement(cursor, db_type, 'user_release_username', (username_key, user_id))
+                
+                # Обновляем информацию о пользователе
+                execute_statement(cursor, db_type, 'user_update_profile', (username, first_name, last_name, user_id))
+                conn.commit()
+                if promoted:
+                    auth_cache.invalidate(user_id)
+            else:
+                # Сохраняем информацию о пользователе для возможного добавления администратором
+                # Проверяем, есть ли информация о пользователе в таблице pending_users
+                execute_statement(cursor, db_type, 'pending_exists', (user_id,))
+                    
+                if not cursor.fetchone():
+                    # Добавляем пользователя в таблицу ожидающих
+                    now = db_timestamp(db_type)
+                    
+                    execute_statement(cursor, db_type, 'pending_upsert',
+                                      (user_id, username, first_name, last_name, now))
+                    conn.commit()
+    
+    if temp_user:
+        # Теперь пользователь авторизован
+        keyboard = current_keyboard(KEYBOARD_ACTIVATED)
+        
+        reply(
+            update,
+            MSG_ACCOUNT_ACTIVATED.format(first_name),
+            reply_markup=keyboard.markup
+        )
+        keyboard_cache.remember(user_id, keyboard)
+        log_action(user_id, 'start_activated', 'account_activation')
+    elif authorized:
+        keyboard = current_keyboard()
         
         # Проверяем, является ли пользователь администратором
         welcome_message = MSG_WELCOME.format(first_name)
         
         # Добавляем информацию о правах администратора, если пользователь является администратором
-        if is_admin(user_id):
+        if principal.is_admin:
             welcome_message += '''
 
 Вы имеете права администратора. Используйте /help для просмотра доступных команд.'''
         
-        update.message.reply_text(
+        reply(
+            update,
             welcome_message,
-            reply_markup=reply_markup
+            reply_markup=keyboard.markup
         )
+        keyboard_cache.remember(user_id, keyboard)
         log_action(user_id, 'start', 'regular_start')
     else:
-        # Сохраняем информацию о пользователе для возможного добавления администратором
-        # Проверяем, есть ли информация о пользователе в таблице pending_users
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM pending_users WHERE user_id = %s", (user_id,))
-        else:
-            cursor.execute("SELECT user_id FROM pending_users WHERE user_id = ?", (user_id,))
-            
-        if not cursor.fetchone():
-            # Добавляем пользователя в таблицу ожидающих
-            now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
-            
-            if db_type == 'postgres':
-                cursor.execute(
-                    "INSERT INTO pending_users (user_id, username, first_name, last_name, request_date) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (user_id) DO UPDATE SET username = %s, first_name = %s, last_name = %s, request_date = %s", 
-                    (user_id, username, first_name, last_name, now, username, first_name, last_name, now)
-                )
-            else:
-                cursor.execute(
-                    "INSERT OR REPLACE INTO pending_users (user_id, username, first_name, last_name, request_date) VALUES (?, ?, ?, ?, ?)", 
-                    (user_id, username, first_name, last_name, now)
-                )
-            conn.commit()
-        
-        conn.close()
-        
-        update.message.reply_text(
+        reply(
+            update,
             f'Привет, {first_name}! {MSG_NOT_AUTHORIZED}'
         )
 
 def refresh_keyboard(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     user_id = user.id
-    username = user.username
     
     # Проверяем, что пользователь авторизован
-    if not (is_user_authorized(user_id, username) or is_admin(user_id)):
-        update.message.reply_text(MSG_NOT_AUTHORIZED)
+    if not get_principal(update, context).is_authorized:
+        reply(update, MSG_NOT_AUTHORIZED)
         return
     
-    # Создаем клавиатуру с актуальными кнопками
-    keyboard = [
-        [BUTTON_LATEST_LESSON, BUTTON_PREVIOUS_LESSON],
-        [BUTTON_REFRESH]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    # Берем готовую клавиатуру с актуальными кнопками
+    keyboard = current_keyboard()
     
-    # Отправляем сообщение с обновленной клавиатурой
-    update.message.reply_text(
-        'Данные обновлены.',
-        reply_markup=reply_markup
-    )
+    # Кнопка "Обновить" нажата на клавиатуре, которая уже актуальна: повторно ее не отправляем.
+    # Команду /refresh отвечаем клавиатурой всегда - у пользователя ее может не быть
+    if update.message.text == BUTTON_REFRESH and keyboard_cache.is_current(user_id, keyboard):
+        reply(update, 'Данные обновлены.')
+    else:
+        # Отправляем сообщение с обновленной клавиатурой
+        reply(
+            update,
+            'Данные обновлены.',
+            reply_markup=keyboard.markup
+        )
+        keyboard_cache.remember(user_id, keyboard)
     
     log_action(user_id, 'refresh_keyboard', 'keyboard_updated')
 
 def help_command(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     user_id = user.id
-    username = user.username
     
-    if is_user_authorized(user_id, username) or is_admin(user_id):
+    principal = get_principal(update, context)
+    
+    if principal.is_authorized:
         help_text = (
             'Доступные команды:\n'
             '/start - Начать работу с ботом\n'
@@ -389,7 +796,7 @@ def help_command(update: Update, context: CallbackContext) -> None:
             'Используйте кнопки для доступа к записям занятий.'
         )
         
-        if is_admin(user_id):
+        if principal.is_admin:
             help_text += (
                 '*Команды администратора:*\n'
                 '/adduser <user_id> - Добавить пользователя по ID\n'
@@ -401,32 +808,35 @@ def help_command(update: Update, context: CallbackContext) -> None:
                 '/makeadmin <user_id или @username> - Назначить пользователя администратором\n'
                 '/button1 "Текст кнопки" "URL" - Обновить текст и ссылку для кнопки 1\n'
                 '/button2 "Текст кнопки" "URL" - Обновить текст и ссылку для кнопки 2\n'
+                '/publish "Название" "URL" [дней] - Опубликовать занятие\n'
+                '/retire <название> - Снять занятие с показа\n'
+                '/broadcast <текст> - Разослать сообщение всем пользователям\n'
                 '/stats - Показать статистику использования бота\n'
                 '/users - Показать список пользователей\n'
                 '/pending - Показать список ожидающих подтверждения пользователей\n'
             )
         
-        update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+        reply(update, help_text, parse_mode=ParseMode.MARKDOWN)
         log_action(user_id, 'help', 'command')
     else:
-        update.message.reply_text(MSG_NOT_AUTHORIZED)
+        reply(update, MSG_NOT_AUTHORIZED)
 
 # Admin commands
 def add_user(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     if not context.args:
-        update.message.reply_text('Пожалуйста, укажите Telegram ID, @username или номер телефона пользователя.')
+        reply(update, 'Пожалуйста, укажите Telegram ID, @username или номер телефона пользователя.')
         return
     
     user_identifier = context.args[0]
     
     # Добавляем отладочный вывод
-    update.message.reply_text(f'Получен идентификатор: {user_identifier}')
+    reply(update, f'Получен идентификатор: {user_identifier}')
     
     # Проверяем, является ли идентификатор числом (ID), именем пользователя или номером телефона
     if user_identifier.isdigit() and len(user_identifier) < 10:
@@ -438,82 +848,61 @@ def add_user(update: Update, context: CallbackContext) -> None:
         username = user_identifier[1:]  # Убираем символ @
         
         # Проверяем, есть ли пользователь с таким именем в базе
-        conn, db_type = get_db_connection()
-        cursor = conn.cursor()
-        
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM users WHERE username = %s", (username,))
-        else:
-            cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
             
-        existing_user = cursor.fetchone()
-        
-        if existing_user:
-            update.message.reply_text(f'Пользователь @{username} уже зарегистрирован.')
-            conn.close()
-            return
-        
-        # Проверяем, есть ли пользователь в таблице pending_users
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM pending_users WHERE LOWER(username) = LOWER(%s) OR LOWER(username) = LOWER('@' || %s)", (username, username))
-        else:
-            cursor.execute("SELECT user_id FROM pending_users WHERE LOWER(username) = LOWER(?) OR LOWER(username) = LOWER('@' || ?)", (username, username))
+            execute_statement(cursor, db_type, 'user_by_username', (normalize_username(username),))
             
-        pending_user = cursor.fetchone()
-        
-        if pending_user:
-            # Если пользователь уже взаимодействовал с ботом, добавляем его из pending_users
-            new_user_id = pending_user[0]
+            existing_user = cursor.fetchone()
             
-            # Получаем полную информацию о пользователе
-            if db_type == 'postgres':
-                cursor.execute("SELECT user_id, username, first_name, last_name, request_date FROM pending_users WHERE user_id = %s", (new_user_id,))
-            else:
-                cursor.execute("SELECT user_id, username, first_name, last_name, request_date FROM pending_users WHERE user_id = ?", (new_user_id,))
-                
-            user_data = cursor.fetchone()
+            if existing_user:
+                reply(update, f'Пользователь @{username} уже зарегистрирован.')
+                return
+            
+            # Проверяем, есть ли пользователь в таблице pending_users
+            execute_statement(cursor, db_type, 'pending_by_username', (normalize_username(username),))
+            
+            pending_user = cursor.fetchone()
             
-            if user_data:
-                user_id, username, first_name, last_name, _ = user_data
-                now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
+            if pending_user:
+                # Если пользователь уже взаимодействовал с ботом, добавляем его из pending_users
+                new_user_id = pending_user[0]
                 
-                # Добавляем пользователя в авторизованные
-                if db_type == 'postgres':
-                    cursor.execute(
-                        "INSERT INTO users (user_id, username, first_name, last_name, registration_date) VALUES (%s, %s, %s, %s, %s)", 
-                        (user_id, username, first_name, last_name, now)
-                    )
+                # Получаем полную информацию о пользователе
+                execute_statement(cursor, db_type, 'pending_get', (new_user_id,))
+                
+                user_data = cursor.fetchone()
+                
+                if user_data:
+                    user_id, username, first_name, last_name, phone_number, _ = user_data
+                    now = db_timestamp(db_type)
                     
-                    # Удаляем из ожидающих
-                    cursor.execute("DELETE FROM pending_users WHERE user_id = %s", (user_id,))
-                else:
-                    cursor.execute(
-                        "INSERT INTO users (user_id, username, first_name, last_name, registration_date) VALUES (?, ?, ?, ?, ?)", 
-                        (user_id, username, first_name, last_name, now)
-                    )
+                    # Добавляем пользователя в авторизованные
+                    execute_statement(cursor, db_type, 'user_insert_from_pending',
+                                      (user_id, username, first_name, last_name, phone_number, now))
                     
                     # Удаляем из ожидающих
-                    cursor.execute("DELETE FROM pending_users WHERE user_id = ?", (user_id,))
-                
-                conn.commit()
-                conn.close()
-                
-                update.message.reply_text(f'Пользователь @{username} (ID: {user_id}) успешно добавлен.')
-                log_action(user_id, 'add_user', f'username:@{username}, user_id:{user_id}')
-                return
-        
-        # Если пользователь не найден в pending_users, добавляем его напрямую
-        # Создаем временный ID (отрицательное число) - при первом взаимодействии с ботом он будет обновлен
-        temp_user_id = -int(time.time())  # Используем текущее время как временный ID
-        now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
-        
-        cursor.execute("INSERT INTO users (user_id, username, registration_date) VALUES (?, ?, ?)", 
-                      (temp_user_id, username, now))
-        
-        conn.commit()
-        conn.close()
+                    execute_statement(cursor, db_type, 'pending_delete', (user_id,))
+                    
+                    conn.commit()
+                    auth_cache.invalidate()
+                    
+                    reply(update, f'Пользователь @{username} (ID: {user_id}) успешно добавлен.')
+                    log_action(user_id, 'add_user', f'username:@{username}, user_id:{user_id}')
+                    return
+            
+            # Если пользователь не найден в pending_users, добавляем его напрямую
+            # Создаем временный ID (отрицательное число) - при первом взаимодействии с ботом он будет обновлен
+            temp_user_id = -int(time.time())  # Используем текущее время как временный ID
+            now = db_timestamp(db_type)
+            
+            execute_statement(cursor, db_type, 'user_insert', (temp_user_id, username, now))
+            
+            conn.commit()
+            auth_cache.invalidate()
         
-        update.message.reply_text(
+        reply(
+            update,
             f'Пользователь @{username} добавлен с временным ID. '
             f'ID будет автоматически обновлен, когда пользователь напишет боту /start.'
         )
@@ -530,120 +919,96 @@ def add_user(update: Update, context: CallbackContext) -> None:
         username = None
         
         # Добавляем отладочный вывод
-        update.message.reply_text(f'Обрабатываю номер телефона: {phone_number}')
+        reply(update, f'Обрабатываю номер телефона: {phone_number}')
         
         # Проверяем, есть ли пользователь с таким номером телефона в базе
-        conn, db_type = get_db_connection()
-        cursor = conn.cursor()
-        
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM users WHERE phone_number = %s", (phone_number,))
-        else:
-            cursor.execute("SELECT user_id FROM users WHERE phone_number = ?", (phone_number,))
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
             
-        existing_user = cursor.fetchone()
-        
-        if existing_user:
-            update.message.reply_text(f'Пользователь с номером {phone_number} уже зарегистрирован.')
-            conn.close()
-            return
-        
-        # Проверяем, есть ли пользователь в таблице pending_users
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM pending_users WHERE phone_number = %s", (phone_number,))
-        else:
-            cursor.execute("SELECT user_id FROM pending_users WHERE phone_number = ?", (phone_number,))
+            execute_statement(cursor, db_type, 'user_by_phone', (phone_number,))
             
-        pending_user = cursor.fetchone()
-        
-        if pending_user:
-            # Если пользователь уже взаимодействовал с ботом, добавляем его из pending_users
-            new_user_id = pending_user[0]
+            existing_user = cursor.fetchone()
             
-            # Получаем полную информацию о пользователе
-            if db_type == 'postgres':
-                cursor.execute("SELECT user_id, username, first_name, last_name, phone_number, request_date FROM pending_users WHERE user_id = %s", (new_user_id,))
-            else:
-                cursor.execute("SELECT user_id, username, first_name, last_name, phone_number, request_date FROM pending_users WHERE user_id = ?", (new_user_id,))
-                
-            user_data = cursor.fetchone()
+            if existing_user:
+                reply(update, f'Пользователь с номером {phone_number} уже зарегистрирован.')
+                return
+            
+            # Проверяем, есть ли пользователь в таблице pending_users
+            execute_statement(cursor, db_type, 'pending_by_phone', (phone_number,))
             
-            if user_data:
-                user_id_data, username_data, first_name, last_name, phone_number_data, _ = user_data
-                now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
+            pending_user = cursor.fetchone()
+            
+            if pending_user:
+                # Если пользователь уже взаимодействовал с ботом, добавляем его из pending_users
+                new_user_id = pending_user[0]
+                
+                # Получаем полную информацию о пользователе
+                execute_statement(cursor, db_type, 'pending_get', (new_user_id,))
                 
-                # Добавляем пользователя в авторизованные
-                if db_type == 'postgres':
-                    cursor.execute("INSERT INTO users (user_id, username, first_name, last_name, phone_number, registration_date) VALUES (%s, %s, %s, %s, %s, %s)", 
-                                   (user_id_data, username_data, first_name, last_name, phone_number_data, now))
+                user_data = cursor.fetchone()
+                
+                if user_data:
+                    user_id_data, username_data, first_name, last_name, phone_number_data, _ = user_data
+                    now = db_timestamp(db_type)
                     
-                    # Удаляем из pending_users
-                    cursor.execute("DELETE FROM pending_users WHERE user_id = %s", (user_id_data,))
-                else:
-                    cursor.execute("INSERT INTO users (user_id, username, first_name, last_name, phone_number, registration_date) VALUES (?, ?, ?, ?, ?, ?)", 
-                                   (user_id_data, username_data, first_name, last_name, phone_number_data, now))
+                    # Добавляем пользователя в авторизованные
+                    execute_statement(cursor, db_type, 'user_insert_from_pending',
+                                      (user_id_data, username_data, first_name, last_name, phone_number_data, now))
                     
                     # Удаляем из pending_users
-                    cursor.execute("DELETE FROM pending_users WHERE user_id = ?", (user_id_data,))
-                
-                conn.commit()
-                conn.close()
-                
-                update.message.reply_text(f'Пользователь с номером {phone_number} (ID: {user_id_data}) успешно добавлен.')
-                log_action(user_id, 'add_user', f'phone_number:{phone_number}, user_id:{user_id_data}')
-                return
-        
-        # Если пользователь не найден в pending_users, добавляем его напрямую
-        # Создаем временный ID (отрицательное число) - при первом взаимодействии с ботом он будет обновлен
-        temp_user_id = -int(time.time())  # Используем текущее время как временный ID
-        now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
-        
-        if db_type == 'postgres':
-            cursor.execute("INSERT INTO users (user_id, phone_number, registration_date) VALUES (%s, %s, %s)", 
-                          (temp_user_id, phone_number, now))
-        else:
-            cursor.execute("INSERT INTO users (user_id, phone_number, registration_date) VALUES (?, ?, ?)", 
-                          (temp_user_id, phone_number, now))
-        
-        conn.commit()
-        conn.close()
+                    execute_statement(cursor, db_type, 'pending_delete', (user_id_data,))
+                    
+                    conn.commit()
+                    auth_cache.invalidate()
+                    
+                    reply(update, f'Пользователь с номером {phone_number} (ID: {user_id_data}) успешно добавлен.')
+                    log_action(user_id, 'add_user', f'phone_number:{phone_number}, user_id:{user_id_data}')
+                    return
+            
+            # Если пользователь не найден в pending_users, добавляем его напрямую
+            # Создаем временный ID (отрицательное число) - при первом взаимодействии с ботом он будет обновлен
+            temp_user_id = -int(time.time())  # Используем текущее время как временный ID
+            now = db_timestamp(db_type)
+            
+            execute_statement(cursor, db_type, 'user_insert_phone', (temp_user_id, phone_number, now))
+            
+            conn.commit()
+            auth_cache.invalidate()
         
-        update.message.reply_text(f'Пользователь с номером {phone_number} успешно добавлен.')
+        reply(update, f'Пользователь с номером {phone_number} успешно добавлен.')
         log_action(user_id, 'add_user', f'phone_number:{phone_number}')
         return
     else:
-        update.message.reply_text('Пожалуйста, укажите корректный Telegram ID, @username или номер телефона пользователя.')
-        return
-    
-    conn = sqlite3.connect('filmschool.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (new_user_id,))
-    if cursor.fetchone():
-        update.message.reply_text(f'Пользователь с ID {new_user_id} уже зарегистрирован.')
-        conn.close()
+        reply(update, 'Пожалуйста, укажите корректный Telegram ID, @username или номер телефона пользователя.')
         return
     
-    now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
-    cursor.execute("INSERT INTO users (user_id, username, registration_date) VALUES (?, ?, ?)", 
-                  (new_user_id, username, now))
-    conn.commit()
-    conn.close()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        
+        execute_statement(cursor, db_type, 'user_exists', (new_user_id,))
+        if cursor.fetchone():
+            reply(update, f'Пользователь с ID {new_user_id} уже зарегистрирован.')
+            return
+        
+        now = db_timestamp(db_type)
+        execute_statement(cursor, db_type, 'user_insert', (new_user_id, username, now))
+        conn.commit()
+        auth_cache.invalidate()
     
-    update.message.reply_text(f'Пользователь с ID {new_user_id} успешно добавлен.')
+    reply(update, f'Пользователь с ID {new_user_id} успешно добавлен.')
     log_action(user_id, 'add_user', f'user_id:{new_user_id}')
 
 def add_users(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
     # Проверяем, что команду выполняет администратор
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     # Проверяем, что есть текст после команды
     if not context.args and not update.message.text.split(' ', 1)[1:]:
-        update.message.reply_text('''Пожалуйста, укажите список никнеймов пользователей для добавления.
+        reply(update, '''Пожалуйста, укажите список никнеймов пользователей для добавления.
 
 Пример: `/addusers @user1 @user2 @user3`
 Или отправьте список никнеймов, каждый в новой строке.''', parse_mode=ParseMode.MARKDOWN)
@@ -669,106 +1034,76 @@ def add_users(update: Update, context: CallbackContext) -> None:
             clean_usernames.append(username.lower())  # Приводим к нижнему регистру
     
     if not clean_usernames:
-        update.message.reply_text('Не удалось найти допустимые никнеймы в вашем списке.')
+        reply(update, 'Не удалось найти допустимые никнеймы в вашем списке.')
         return
     
     # Подключаемся к базе данных
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Статистика добавления
-    added_count = 0
-    already_exists_count = 0
-    not_found_count = 0
-    not_found_usernames = []
-    
-    # Проходим по всем никнеймам
-    for username in clean_usernames:
-        # Сначала проверяем, есть ли пользователь уже в таблице users по имени пользователя
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM users WHERE LOWER(username) = LOWER(%s) OR LOWER(username) = LOWER('@' || %s)", (username, username))
-        else:
-            cursor.execute("SELECT user_id FROM users WHERE LOWER(username) = LOWER(?) OR LOWER(username) = LOWER('@' || ?)", (username, username))
-            
-        existing_user_by_name = cursor.fetchone()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
         
-        if existing_user_by_name:
-            # Пользователь уже существует в таблице users
-            already_exists_count += 1
-            print(f"Пользователь @{username} уже существует в таблице users")
-            continue
+        # Статистика добавления
+        added_count = 0
+        already_exists_count = 0
+        not_found_count = 0
+        not_found_usernames = []
         
-        # Проверяем, есть ли пользователь в таблице pending_users
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM pending_users WHERE LOWER(username) = LOWER(%s) OR LOWER(username) = LOWER('@' || %s)", (username, username))
-        else:
-            cursor.execute("SELECT user_id FROM pending_users WHERE LOWER(username) = LOWER(?) OR LOWER(username) = LOWER('@' || ?)", (username, username))
+        # Проходим по всем никнеймам
+        for username in clean_usernames:
+            # Сначала проверяем, есть ли пользователь уже в таблице users по имени пользователя
+            execute_statement(cursor, db_type, 'user_by_username', (normalize_username(username),))
             
-        pending_user = cursor.fetchone()
-        
-        if pending_user:
-            # Пользователь найден в ожидающих
-            pending_user_id = pending_user[0]
+            existing_user_by_name = cursor.fetchone()
             
-            # Проверяем, не существует ли уже такой пользователь в таблице users по ID
-            if db_type == 'postgres':
-                cursor.execute("SELECT user_id FROM users WHERE user_id = %s", (pending_user_id,))
-            else:
-                cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (pending_user_id,))
-                
-            existing_user = cursor.fetchone()
+            if existing_user_by_name:
+                # Пользователь уже существует в таблице users
+                already_exists_count += 1
+                print(f"Пользователь @{username} уже существует в таблице users")
+                continue
             
-            if not existing_user:
-                # Добавляем пользователя в таблицу users
-                now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
+            # Проверяем, есть ли пользователь в таблице pending_users
+            execute_statement(cursor, db_type, 'pending_by_username', (normalize_username(username),))
+            
+            pending_user = cursor.fetchone()
+            
+            if pending_user:
+                # Пользователь найден в ожидающих
+                pending_user_id = pending_user[0]
+                
+                # Проверяем, не существует ли уже такой пользователь в таблице users по ID
+                execute_statement(cursor, db_type, 'user_exists', (pending_user_id,))
                 
-                if db_type == 'postgres':
-                    cursor.execute(
-                        "INSERT INTO users (user_id, username, registration_date, is_admin) VALUES (%s, %s, %s, %s)", 
-                        (pending_user_id, username, now, False)
-                    )
+                existing_user = cursor.fetchone()
+                
+                if not existing_user:
+                    # Добавляем пользователя в таблицу users
+                    now = db_timestamp(db_type)
                     
-                    # Удаляем из ожидающих
-                    cursor.execute("DELETE FROM pending_users WHERE user_id = %s", (pending_user_id,))
-                else:
-                    cursor.execute(
-                        "INSERT INTO users (user_id, username, registration_date, is_admin) VALUES (?, ?, ?, ?)", 
-                        (pending_user_id, username, now, 0)
-                    )
+                    execute_statement(cursor, db_type, 'user_insert', (pending_user_id, username, now))
                     
                     # Удаляем из ожидающих
-                    cursor.execute("DELETE FROM pending_users WHERE user_id = ?", (pending_user_id,))
+                    execute_statement(cursor, db_type, 'pending_delete', (pending_user_id,))
+                    
+                    added_count += 1
+                    print(f"Добавлен пользователь @{username} из pending_users с ID {pending_user_id}")
+                    log_action(user_id, 'add_user', f'username:@{username}, user_id:{pending_user_id}')
+                else:
+                    already_exists_count += 1
+                    print(f"Пользователь @{username} с ID {pending_user_id} уже существует в таблице users")
+            else:
+                # Пользователь не найден в ожидающих, добавляем его напрямую
+                # Создаем временный ID (отрицательное число) - при первом взаимодействии с ботом он будет обновлен
+                temp_user_id = -int(time.time()) - random.randint(1, 1000)  # Используем текущее время и случайное число как временный ID
+                now = db_timestamp(db_type)
+                
+                # Добавляем пользователя в таблицу users
+                execute_statement(cursor, db_type, 'user_insert', (temp_user_id, username, now))
                 
                 added_count += 1
-                print(f"Добавлен пользователь @{username} из pending_users с ID {pending_user_id}")
-                log_action(user_id, 'add_user', f'username:@{username}, user_id:{pending_user_id}')
-            else:
-                already_exists_count += 1
-                print(f"Пользователь @{username} с ID {pending_user_id} уже существует в таблице users")
-        else:
-            # Пользователь не найден в ожидающих, добавляем его напрямую
-            # Создаем временный ID (отрицательное число) - при первом взаимодействии с ботом он будет обновлен
-            temp_user_id = -int(time.time()) - random.randint(1, 1000)  # Используем текущее время и случайное число как временный ID
-            now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Добавляем пользователя в таблицу users
-            if db_type == 'postgres':
-                cursor.execute(
-                    "INSERT INTO users (user_id, username, registration_date, is_admin) VALUES (%s, %s, %s, %s)", 
-                    (temp_user_id, username, now, False)
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO users (user_id, username, registration_date, is_admin) VALUES (?, ?, ?, ?)", 
-                    (temp_user_id, username, now, 0)
-                )
-            
-            added_count += 1
-            print(f"Добавлен новый пользователь @{username} с временным ID {temp_user_id}")
-            log_action(user_id, 'add_user', f'username:@{username}, direct_add:true, temp_id:{temp_user_id}')
-    
-    conn.commit()
-    conn.close()
+                print(f"Добавлен новый пользователь @{username} с временным ID {temp_user_id}")
+                log_action(user_id, 'add_user', f'username:@{username}, direct_add:true, temp_id:{temp_user_id}')
+        
+        conn.commit()
+        auth_cache.invalidate()
     
     # Формируем отчет
     report = f"*Результаты добавления пользователей:*\n\n"
@@ -780,110 +1115,93 @@ def add_users(update: Update, context: CallbackContext) -> None:
     report += "\n\nВсе пользователи успешно добавлены в базу данных."
     report += "\nДля проверки используйте команду /checkusers с теми же пользователями."
     
-    update.message.reply_text(report, parse_mode=ParseMode.MARKDOWN)
+    reply(update, report, parse_mode=ParseMode.MARKDOWN)
 
 def remove_user(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     if not context.args:
-        update.message.reply_text('Пожалуйста, укажите Telegram ID или @username пользователя.')
+        reply(update, 'Пожалуйста, укажите Telegram ID или @username пользователя.')
         return
     
     user_identifier = context.args[0]
     
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Определяем, является ли идентификатор числом (ID) или именем пользователя
-    if user_identifier.isdigit():
-        # Если это ID
-        remove_user_id = int(user_identifier)
-        
-        # Проверяем, является ли пользователь администратором
-        if is_admin(remove_user_id):
-            update.message.reply_text('Невозможно удалить администратора.')
-            conn.close()
-            return
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
         
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM users WHERE user_id = %s", (remove_user_id,))
-        else:
-            cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (remove_user_id,))
+        # Определяем, является ли идентификатор числом (ID) или именем пользователя
+        if user_identifier.isdigit():
+            # Если это ID
+            remove_user_id = int(user_identifier)
             
-        if not cursor.fetchone():
-            update.message.reply_text(f'Пользователь с ID {remove_user_id} не найден.')
-            conn.close()
-            return
-        
-        if db_type == 'postgres':
-            cursor.execute("DELETE FROM users WHERE user_id = %s", (remove_user_id,))
-        else:
-            cursor.execute("DELETE FROM users WHERE user_id = ?", (remove_user_id,))
+            execute_statement(cursor, db_type, 'user_admin_flag', (remove_user_id,))
             
-        conn.commit()
-        conn.close()
-        
-        update.message.reply_text(f'Пользователь с ID {remove_user_id} успешно удален.')
-        log_action(user_id, 'remove_user', f'user_id:{remove_user_id}')
-    
-    elif user_identifier.startswith('@'):
-        # Если это @username
-        username = user_identifier[1:]  # Убираем символ @
-        
-        # Находим пользователя по имени
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id, is_admin FROM users WHERE username = %s", (username,))
-        else:
-            cursor.execute("SELECT user_id, is_admin FROM users WHERE username = ?", (username,))
+            user_data = cursor.fetchone()
             
-        user_data = cursor.fetchone()
-        
-        if not user_data:
-            update.message.reply_text(f'Пользователь @{username} не найден.')
-            conn.close()
-            return
+            if not user_data:
+                reply(update, f'Пользователь с ID {remove_user_id} не найден.')
+                return
+            
+            # Проверяем, является ли пользователь администратором
+            if user_data[2]:
+                reply(update, 'Невозможно удалить администратора.')
+                return
             
-        remove_user_id, is_admin_flag = user_data
+            execute_statement(cursor, db_type, 'user_delete', (remove_user_id,))
+            
+            conn.commit()
+            auth_cache.invalidate(remove_user_id)
+            
+            reply(update, f'Пользователь с ID {remove_user_id} успешно удален.')
+            log_action(user_id, 'remove_user', f'user_id:{remove_user_id}')
         
-        # Проверяем, является ли пользователь администратором
-        if db_type == 'postgres':
-            is_admin_value = is_admin_flag is True
-        else:
-            is_admin_value = is_admin_flag == 1
+        elif user_identifier.startswith('@'):
+            # Если это @username
+            username = user_identifier[1:]  # Убираем символ @
             
-        if is_admin_value:
-            update.message.reply_text('Невозможно удалить администратора.')
-            conn.close()
-            return
+            # Находим пользователя по имени
+            execute_statement(cursor, db_type, 'user_by_username', (normalize_username(username),))
+            
+            user_data = cursor.fetchone()
+            
+            if not user_data:
+                reply(update, f'Пользователь @{username} не найден.')
+                return
+            
+            remove_user_id, is_admin_flag = user_data
+            
+            # Проверяем, является ли пользователь администратором
+            is_admin_value = bool(is_admin_flag)
+            
+            if is_admin_value:
+                reply(update, 'Невозможно удалить администратора.')
+                return
+            
+            execute_statement(cursor, db_type, 'user_delete', (remove_user_id,))
+            conn.commit()
+            auth_cache.invalidate(remove_user_id)
+            
+            reply(update, f'Пользователь @{username} (ID: {remove_user_id}) успешно удален.')
+            log_action(user_id, 'remove_user', f'user_id:{remove_user_id}')
         
-        if db_type == 'postgres':
-            cursor.execute("DELETE FROM users WHERE user_id = %s", (remove_user_id,))
         else:
-            cursor.execute("DELETE FROM users WHERE user_id = ?", (remove_user_id,))
-        conn.commit()
-        conn.close()
-        
-        update.message.reply_text(f'Пользователь @{username} (ID: {remove_user_id}) успешно удален.')
-        log_action(user_id, 'remove_user', f'user_id:{remove_user_id}')
-    
-    else:
-        update.message.reply_text('Пожалуйста, укажите корректный Telegram ID или @username пользователя.')
-        conn.close()
+            reply(update, 'Пожалуйста, укажите корректный Telegram ID или @username пользователя.')
 
 def update_button(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     # Проверяем, что переданы все необходимые аргументы
     if len(context.args) < 3:
-        update.message.reply_text(
+        reply(
+            update,
             '''Пожалуйста, укажите все необходимые параметры: 
 
 /button<номер> "<текст кнопки>" "<ссылка>"
@@ -897,8 +1215,8 @@ def update_button(update: Update, context: CallbackContext) -> None:
         command = update.message.text.split()[0]  # Получаем /button1
         button_num = int(command.replace('/button', ''))
         
-        if button_num not in [1, 2]:
-            raise ValueError("Номер кнопки должен быть 1 (последнее занятие) или 2 (предыдущее занятие)")
+        if not 1 <= button_num <= LESSON_BUTTONS_COUNT:
+            raise ValueError(f"Номер кнопки должен быть от 1 до {LESSON_BUTTONS_COUNT}")
         
         # Получаем текст кнопки и ссылку
         # Аргументы могут содержать пробелы и быть в кавычках, поэтому используем полный текст сообщения
@@ -919,26 +1237,17 @@ def update_button(update: Update, context: CallbackContext) -> None:
         # Используем явные символы новой строки вместо многострочной строки
         message_text = "Запись занятия: " + button_url + "\n\nЗапись доступна в течение 7 дней."
         
-        # Обновляем глобальные переменные в зависимости от номера кнопки
-        global BUTTON_LATEST_LESSON, MSG_LATEST_LESSON, BUTTON_PREVIOUS_LESSON, MSG_PREVIOUS_LESSON, BUTTONS
-        
-        if button_num == 1:
-            BUTTON_LATEST_LESSON = button_text
-            MSG_LATEST_LESSON = message_text
-        else:  # button_num == 2
-            BUTTON_PREVIOUS_LESSON = button_text
-            MSG_PREVIOUS_LESSON = message_text
-        
-        # Обновляем словарь кнопок
-        BUTTONS[button_num] = {'text': button_text, 'message': message_text}
-        
-        # Сохраняем изменения в базе данных
+        # Сохраняем кнопку (из нее заполняется пустой каталог при перезапуске)
+        # и публикуем занятие в каталоге на место кнопки, затем перечитываем реестр кнопок
         save_button_to_db(button_num, button_text, message_text)
+        publish_lesson(lesson_title_from_button(button_text), message_text, expires_at=lesson_expiry(),
+                       slot=button_num)
+        button_registry.reload()
         
         # Формируем сообщение об успехе
         success_message = 'Готово. Нажми «Обновить».'
         
-        update.message.reply_text(success_message)
+        reply(update, success_message)
         log_action(user_id, 'update_button', f'button_num:{button_num}, text:"{button_text}", url:{button_url}')
         
     except ValueError as e:
@@ -949,7 +1258,7 @@ def update_button(update: Update, context: CallbackContext) -> None:
 
 Пожалуйста, проверьте формат команды:
 /button<номер> "<текст кнопки>" "<ссылка>"'''
-        update.message.reply_text(error_message)
+        reply(update, error_message)
     except Exception as e:
         # Формируем детальное сообщение о неожиданной ошибке
         unexpected_error = f'''⚠️ Неожиданная ошибка при обновлении кнопки:
@@ -957,17 +1266,171 @@ def update_button(update: Update, context: CallbackContext) -> None:
 {str(e)}
 
 Пожалуйста, свяжитесь с администратором или попробуйте еще раз.'''
-        update.message.reply_text(unexpected_error)
+        reply(update, unexpected_error)
+
+def publish_command(update: Update, context: CallbackContext) -> None:
+    """Публикует занятие: /publish "<название>" "<ссылка>" [дней показа] [время публикации]"""
+    user_id = update.effective_user.id
+    
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
+        return
+    
+    # Название и ссылка могут содержать пробелы, поэтому берем их из кавычек
+    full_text = update.message.text
+    matches = re.findall(r'"([^"]*)"', full_text)
+    if len(matches) < 2 or not matches[0].strip():
+        reply(
+            update,
+            'Пожалуйста, укажите название занятия и ссылку в кавычках:\n\n'
+            '/publish "<название>" "<ссылка>" [дней показа] [ДД.ММ.ГГГГ ЧЧ:ММ]\n\n'
+            f'Например: /publish "1 июня" "https://drive.google.com/..." {LESSON_TTL_DAYS:g}\n'
+            'Со временем публикации занятие появится на клавиатуре в указанный момент.'
+        )
+        return
+    
+    title, url = matches[0].strip(), matches[1].strip()
+    tail = full_text.rsplit('"', 1)[1].split()
+    try:
+        days = float(tail[0]) if tail else None
+    except ValueError:
+        reply(update, 'Количество дней показа должно быть числом.')
+        return
+    
+    published_at = None
+    if len(tail) > 1:
+        try:
+            published_at = parse_display_time(' '.join(tail[1:]))
+        except ValueError:
+            reply(update, 'Время публикации укажите в формате ДД.ММ.ГГГГ ЧЧ:ММ или ДД.ММ ЧЧ:ММ.')
+            return
+    
+    expires_at = lesson_expiry(days, published_at)
+    message_text = "Запись занятия: " + url
+    if expires_at is not None:
+        message_text += "\n\nЗапись доступна до " + format_timestamp(expires_at, '%d.%m.%Y %H:%M') + "."
+    
+    try:
+        lesson_id = publish_lesson(title, message_text, expires_at=expires_at, published_at=published_at)
+        button_registry.reload()
+    except Exception as e:
+        reply(update, f'Произошла ошибка: {str(e)}')
+        return
+    
+    if published_at is not None and published_at > time.time():
+        reply(update, f'Занятие «{title}» будет опубликовано {format_timestamp(published_at, "%d.%m.%Y %H:%M")}.')
+    else:
+        reply(update, f'Занятие «{title}» опубликовано. Нажми «Обновить».')
+    log_action(user_id, 'publish_lesson', f'lesson_id:{lesson_id}, title:"{title}", url:{url}')
+
+def retire_command(update: Update, context: CallbackContext) -> None:
+    """Снимает занятие с показа: /retire <название>"""
+    user_id = update.effective_user.id
+    
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
+        return
+    
+    title = ' '.join(context.args).strip().strip('"')
+    if not title:
+        reply(update, 'Пожалуйста, укажите название занятия: /retire <название>')
+        return
+    
+    try:
+        retired = retire_lesson(title)
+        if retired:
+            button_registry.reload()
+    except Exception as e:
+        reply(update, f'Произошла ошибка: {str(e)}')
+        return
+    
+    if retired:
+        reply(update, f'Занятие «{title}» снято с показа.')
+        log_action(user_id, 'retire_lesson', f'title:"{title}"')
+    else:
+        reply(update, f'Занятие «{title}» не найдено среди показываемых.')
+
+def send_broadcast_message(user_id, text):
+    """Отправляет сообщение рассылки с актуальной клавиатурой через очередь массовых отправок"""
+    keyboard = current_keyboard()
+    
+    def send():
+        message = global_updater.bot.send_message(user_id, text, reply_markup=keyboard.markup)
+        keyboard_cache.remember(user_id, keyboard)
+        return message
+    
+    return send_scheduler.submit(user_id, send, PRIORITY_BULK)
+
+def report_broadcast_finished(broadcast, status, sent, failed):
+    """Сообщает автору рассылки о ее завершении"""
+    if broadcast.created_by:
+        text = f'Рассылка #{broadcast.id} завершена: отправлено {sent}, не доставлено {failed}.'
+        send_scheduler.submit(broadcast.created_by,
+                              lambda: global_updater.bot.send_message(broadcast.created_by, text))
+
+# Рассылки выполняются в отдельном потоке и продолжаются после перезапуска
+broadcaster = Broadcaster(send_broadcast_message, report_broadcast_finished)
+
+def broadcast_command(update: Update, context: CallbackContext) -> None:
+    """
+    /broadcast <текст> - разослать сообщение с актуальной клавиатурой всем пользователям;
+    /broadcast - состояние последних рассылок; /broadcast cancel <номер> - отменить рассылку.
+    """
+    user_id = update.effective_user.id
+    
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
+        return
+    
+    # Текст берем целиком из сообщения, чтобы сохранить переносы строк
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ''
+    
+    try:
+        if not text:
+            broadcasts = get_recent_broadcasts()
+            if not broadcasts:
+                reply(update, 'Рассылок еще не было. Чтобы начать: /broadcast <текст сообщения>')
+                return
+            lines = ['Последние рассылки:']
+            for broadcast_id, status, total, sent, failed, created_at, finished_at in broadcasts:
+                state = {STATUS_RUNNING: 'идет', STATUS_CANCELLED: 'отменена'}.get(status, 'завершена')
+                lines.append(f'#{broadcast_id} от {format_timestamp(created_at, "%d.%m %H:%M")} ({state}): '
+                             f'отправлено {sent} из {total}, не доставлено {failed}')
+            reply(update, '\n'.join(lines))
+            return
+        
+        command_args = text.split()
+        if command_args[0].lower() == 'cancel' and len(command_args) == 2 and command_args[1].lstrip('#').isdigit():
+            broadcast_id = int(command_args[1].lstrip('#'))
+            if finish_broadcast(broadcast_id, STATUS_CANCELLED, STATUS_RUNNING):
+                reply(update, f'Рассылка #{broadcast_id} отменена.')
+                log_action(user_id, 'broadcast_cancel', f'broadcast_id:{broadcast_id}')
+            else:
+                reply(update, f'Рассылка #{broadcast_id} не выполняется.')
+            return
+        
+        broadcast_id, total = create_broadcast(text, user_id, STATUS_RUNNING)
+    except Exception as e:
+        reply(update, f'Произошла ошибка: {str(e)}')
+        return
+    
+    # Рассылки выполняет ведущий экземпляр; на остальных он подхватит ее по расписанию
+    if leader_election.is_leader:
+        broadcaster.start()
+    reply(update, f'Рассылка #{broadcast_id} запущена, получателей: {total}. Состояние: /broadcast')
+    log_action(user_id, 'broadcast', f'broadcast_id:{broadcast_id}, total:{total}')
 
 def update_video(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     if len(context.args) < 3:
-        update.message.reply_text(
+        reply(
+            update,
             'Пожалуйста, укажите все необходимые параметры: '
             '/updatevideo <номер> <название> <ссылка>'
         )
@@ -981,60 +1444,56 @@ def update_video(update: Update, context: CallbackContext) -> None:
         title = context.args[1]
         url = context.args[2]
         
-        conn = sqlite3.connect('filmschool.db')
-        cursor = conn.cursor()
-        
-        # Get current videos
-        cursor.execute("SELECT id FROM videos ORDER BY upload_date DESC LIMIT 2")
-        videos = cursor.fetchall()
-        
-        now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
-        
-        if len(videos) < 2:
-            # Less than 2 videos in database, add new ones
-            for i in range(2 - len(videos)):
-                cursor.execute("INSERT INTO videos (title, url, upload_date) VALUES (?, ?, ?)", 
-                               ("Новое занятие", "https://example.com", now))
-        
-        # Get videos again after possible insertion
-        cursor.execute("SELECT id FROM videos ORDER BY upload_date DESC LIMIT 2")
-        videos = cursor.fetchall()
-        
-        # Update the selected video
-        video_id = videos[video_num - 1][0]
-        cursor.execute("UPDATE videos SET title = ?, url = ?, upload_date = ? WHERE id = ?", 
-                       (title, url, now, video_id))
-        
-        conn.commit()
-        conn.close()
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
+            
+            # Get current videos
+            cursor.execute("SELECT id FROM videos ORDER BY upload_date DESC LIMIT 2")
+            videos = cursor.fetchall()
+            
+            now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
+            
+            if len(videos) < 2:
+                # Less than 2 videos in database, add new ones
+                for i in range(2 - len(videos)):
+                    execute_statement(cursor, db_type, 'video_insert', ('Новое занятие', 'https://example.com', now))
+            
+            # Get videos again after possible insertion
+            cursor.execute("SELECT id FROM videos ORDER BY upload_date DESC LIMIT 2")
+            videos = cursor.fetchall()
+            
+            # Update the selected video
+            video_id = videos[video_num - 1][0]
+            execute_statement(cursor, db_type, 'video_update', (title, url, now, video_id))
+            
+            conn.commit()
         
-        update.message.reply_text(f'Ссылка на {"последнее" if video_num == 1 else "предыдущее"} занятие успешно обновлена.')
+        reply(update, f'Ссылка на {"последнее" if video_num == 1 else "предыдущее"} занятие успешно обновлена.')
         log_action(user_id, 'update_video', f'video_num:{video_num}')
         
     except ValueError as e:
-        update.message.reply_text(str(e))
+        reply(update, str(e))
     except Exception as e:
-        update.message.reply_text(f'Произошла ошибка: {str(e)}')
+        reply(update, f'Произошла ошибка: {str(e)}')
 
 def show_actions(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
-        return
-    
-    conn = sqlite3.connect('filmschool.db')
-    cursor = conn.cursor()
-    
-    # Last 20 actions
-    cursor.execute("""
-    SELECT l.username, l.user_id, l.action, l.action_data, l.timestamp 
-    FROM logs l 
-    ORDER BY l.timestamp DESC LIMIT 20
-    """)
-    recent_actions = cursor.fetchall()
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
+        return
     
-    conn.close()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        
+        # Last 20 actions
+        cursor.execute("""
+        SELECT u.username, l.user_id, l.action, l.action_data, l.timestamp 
+        FROM logs l 
+        LEFT JOIN users u ON l.user_id = u.user_id
+        ORDER BY l.timestamp DESC LIMIT 20
+        """)
+        recent_actions = cursor.fetchall()
     
     # Format actions list
     actions_text = f'*Последние действия:*\n\n'
@@ -1047,102 +1506,100 @@ def show_actions(update: Update, context: CallbackContext) -> None:
             # Экранируем специальные символы Markdown
             safe_action_data = action_data.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`')
             action_info += f' ({safe_action_data})'
-        actions_text += f'- {user_display}: {action_info} ({timestamp})\n'
+        actions_text += f'- {user_display}: {action_info} ({format_timestamp(timestamp)})\n'
     
-    update.message.reply_text(actions_text, parse_mode=ParseMode.MARKDOWN)
+    reply(update, actions_text, parse_mode=ParseMode.MARKDOWN)
     log_action(user_id, 'show_actions', 'admin_command')
 
 def init_db_command(update: Update, context: CallbackContext) -> None:
     """Инициализация базы данных через команду бота"""
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     try:
         # Вызываем функцию инициализации базы данных
         from init_db import init_database
         init_database()
-        update.message.reply_text("✅ База данных успешно инициализирована! Все необходимые таблицы созданы.")
+        reply(update, "✅ База данных успешно инициализирована! Все необходимые таблицы созданы.")
     except Exception as e:
-        update.message.reply_text(f"❌ Ошибка при инициализации базы данных: {str(e)}")
+        reply(update, f"❌ Ошибка при инициализации базы данных: {str(e)}")
 
 def diagnose_db(update: Update, context: CallbackContext) -> None:
     """Диагностика базы данных для проверки структуры и наличия пользователей"""
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     # Подключаемся к базе данных
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Получаем информацию о таблицах
-    if db_type == 'postgres':
-        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
-    else:
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    
-    tables = cursor.fetchall()
-    table_names = [table[0] for table in tables]
-    
-    # Получаем информацию о структуре таблицы users
-    if 'users' in table_names:
-        if db_type == 'postgres':
-            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'users'")
-        else:
-            cursor.execute("PRAGMA table_info(users)")
-            
-        columns_info = cursor.fetchall()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
         
+        # Получаем информацию о таблицах
         if db_type == 'postgres':
-            columns = [col[0] for col in columns_info]
+            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
         else:
-            columns = [col[1] for col in columns_info]  # SQLite returns (id, name, type, notnull, default, pk)
-        
-        # Проверяем наличие колонки username
-        has_username_column = 'username' in columns
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         
-        # Получаем количество пользователей
-        cursor.execute("SELECT COUNT(*) FROM users")
-        users_count = cursor.fetchone()[0]
+        tables = cursor.fetchall()
+        table_names = [table[0] for table in tables]
         
-        # Получаем первых 5 пользователей
-        cursor.execute("SELECT user_id, username FROM users LIMIT 5")
-        sample_users = cursor.fetchall()
-    else:
-        has_username_column = False
-        users_count = 0
-        sample_users = []
-    
-    # Получаем информацию о структуре таблицы pending_users
-    if 'pending_users' in table_names:
-        if db_type == 'postgres':
-            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'pending_users'")
-        else:
-            cursor.execute("PRAGMA table_info(pending_users)")
+        # Получаем информацию о структуре таблицы users
+        if 'users' in table_names:
+            if db_type == 'postgres':
+                cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'users'")
+            else:
+                cursor.execute("PRAGMA table_info(users)")
             
-        columns_info = cursor.fetchall()
-        
-        if db_type == 'postgres':
-            pending_columns = [col[0] for col in columns_info]
+            columns_info = cursor.fetchall()
+            
+            if db_type == 'postgres':
+                columns = [col[0] for col in columns_info]
+            else:
+                columns = [col[1] for col in columns_info]  # SQLite returns (id, name, type, notnull, default, pk)
+            
+            # Проверяем наличие колонки username
+            has_username_column = 'username' in columns
+            
+            # Получаем количество пользователей
+            cursor.execute("SELECT COUNT(*) FROM users")
+            users_count = cursor.fetchone()[0]
+            
+            # Получаем первых 5 пользователей
+            cursor.execute("SELECT user_id, username FROM users LIMIT 5")
+            sample_users = cursor.fetchall()
         else:
-            pending_columns = [col[1] for col in columns_info]  # SQLite returns (id, name, type, notnull, default, pk)
+            has_username_column = False
+            users_count = 0
+            sample_users = []
         
-        # Проверяем наличие колонки username
-        has_pending_username_column = 'username' in pending_columns
-        
-        # Получаем количество пользователей
-        cursor.execute("SELECT COUNT(*) FROM pending_users")
-        pending_users_count = cursor.fetchone()[0]
-    else:
-        has_pending_username_column = False
-        pending_users_count = 0
-    
-    conn.close()
+        # Получаем информацию о структуре таблицы pending_users
+        if 'pending_users' in table_names:
+            if db_type == 'postgres':
+                cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'pending_users'")
+            else:
+                cursor.execute("PRAGMA table_info(pending_users)")
+            
+            columns_info = cursor.fetchall()
+            
+            if db_type == 'postgres':
+                pending_columns = [col[0] for col in columns_info]
+            else:
+                pending_columns = [col[1] for col in columns_info]  # SQLite returns (id, name, type, notnull, default, pk)
+            
+            # Проверяем наличие колонки username
+            has_pending_username_column = 'username' in pending_columns
+            
+            # Получаем количество пользователей
+            cursor.execute("SELECT COUNT(*) FROM pending_users")
+            pending_users_count = cursor.fetchone()[0]
+        else:
+            has_pending_username_column = False
+            pending_users_count = 0
     
     # Формируем отчет
     report = f"*Диагностика базы данных:*\n\n"
@@ -1171,19 +1628,19 @@ def diagnose_db(update: Update, context: CallbackContext) -> None:
     else:
         report += "\n*Таблица pending_users не найдена*\n"
     
-    update.message.reply_text(report, parse_mode=ParseMode.MARKDOWN)
+    reply(update, report, parse_mode=ParseMode.MARKDOWN)
     log_action(user_id, 'diagnose_db', 'admin_command')
 
 def check_users(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     # Получаем список пользователей для проверки
     if not context.args:
-        update.message.reply_text('Пожалуйста, укажите список никнеймов для проверки.')
+        reply(update, 'Пожалуйста, укажите список никнеймов для проверки.')
         return
     
     # Получаем текст после команды
@@ -1201,48 +1658,40 @@ def check_users(update: Update, context: CallbackContext) -> None:
             clean_usernames.append(username.lower())  # Приводим к нижнему регистру
     
     if not clean_usernames:
-        update.message.reply_text('Не удалось найти допустимые никнеймы в вашем списке.')
+        reply(update, 'Не удалось найти допустимые никнеймы в вашем списке.')
         return
     
     # Подключаемся к базе данных
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Статистика проверки
-    found_in_users = 0
-    found_in_pending = 0
-    not_found = 0
-    not_found_usernames = []
-    
-    # Проходим по всем никнеймам
-    for username in clean_usernames:
-        # Проверяем, есть ли пользователь в таблице users
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM users WHERE LOWER(username) = LOWER(%s) OR LOWER(username) = LOWER('@' || %s)", (username, username))
-        else:
-            cursor.execute("SELECT user_id FROM users WHERE LOWER(username) = LOWER(?) OR LOWER(username) = LOWER('@' || ?)", (username, username))
-            
-        user_result = cursor.fetchone()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
         
-        if user_result:
-            found_in_users += 1
-            continue
+        # Статистика проверки
+        found_in_users = 0
+        found_in_pending = 0
+        not_found = 0
+        not_found_usernames = []
         
-        # Проверяем, есть ли пользователь в таблице pending_users
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id FROM pending_users WHERE LOWER(username) = LOWER(%s) OR LOWER(username) = LOWER('@' || %s)", (username, username))
-        else:
-            cursor.execute("SELECT user_id FROM pending_users WHERE LOWER(username) = LOWER(?) OR LOWER(username) = LOWER('@' || ?)", (username, username))
+        # Проходим по всем никнеймам
+        for username in clean_usernames:
+            # Проверяем, есть ли пользователь в таблице users
+            execute_statement(cursor, db_type, 'user_by_username', (normalize_username(username),))
             
-        pending_result = cursor.fetchone()
-        
-        if pending_result:
-            found_in_pending += 1
-        else:
-            not_found += 1
-            not_found_usernames.append(username)
-    
-    conn.close()
+            user_result = cursor.fetchone()
+            
+            if user_result:
+                found_in_users += 1
+                continue
+            
+            # Проверяем, есть ли пользователь в таблице pending_users
+            execute_statement(cursor, db_type, 'pending_by_username', (normalize_username(username),))
+            
+            pending_result = cursor.fetchone()
+            
+            if pending_result:
+                found_in_pending += 1
+            else:
+                not_found += 1
+                not_found_usernames.append(username)
     
     # Формируем отчет
     report = f"*Результаты проверки {len(clean_usernames)} пользователей:*\n\n"
@@ -1260,31 +1709,79 @@ def check_users(update: Update, context: CallbackContext) -> None:
         if len(not_found_usernames) > 10:
             report += f"... и еще {len(not_found_usernames) - 10} пользователей"
     
-    update.message.reply_text(report, parse_mode=ParseMode.MARKDOWN)
+    reply(update, report, parse_mode=ParseMode.MARKDOWN)
     log_action(user_id, 'check_users', 'admin_command')
 
-def list_users(update: Update, context: CallbackContext) -> None:
+def handle_lesson_callback(update: Update, context: CallbackContext) -> None:
+    """
+    Нажатие встроенной клавиатуры. Занятие находится по ID из callback_data, ответ
+    показывается редактированием того же сообщения, а устаревшая клавиатура
+    (версия каталога в callback_data не совпадает с текущей) заменяется актуальной.
+    """
+    query = update.callback_query
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_authorized:
+        query.answer(MSG_NOT_AUTHORIZED, show_alert=True)
         return
     
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
+    keyboard = current_keyboard(KEYBOARD_INLINE)
+    parts = (query.data or '').split(':')
     
-    # Получаем общее количество пользователей
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
-    
-    # Получаем список пользователей с ограничением
-    if db_type == 'postgres':
-        cursor.execute("SELECT user_id, username, first_name, last_name, is_admin FROM users ORDER BY username LIMIT %s", (10,))
+    if parts[0] == CALLBACK_LESSON and len(parts) == 3 and parts[2].lstrip('-').isdigit():
+        stale = parts[1] != str(button_registry.version or 0)
+        button_action = LESSON_ACTIONS_BY_ID.get(int(parts[2]))
+        if button_action is None or not is_lesson_shown(button_action.published_at, button_action.expires_at):
+            # Занятие уже снято с показа: сообщаем и показываем актуальные кнопки
+            query.answer(MSG_LESSON_UNAVAILABLE, show_alert=True)
+            edit_callback_message(query, reply_markup=keyboard.markup)
+            return
+        # Кнопка с прошлой версией каталога: ответ тот же, а клавиатура под ним обновится
+        query.answer('Кнопки обновлены.' if stale else None)
+        edit_callback_message(query, text=button_action.reply, reply_markup=keyboard.markup)
+        log_action(user_id, button_action.action, button_action.action_data, lesson_id=button_action.lesson_id)
+    elif parts[0] == CALLBACK_REFRESH:
+        query.answer('Данные обновлены.')
+        edit_callback_message(query, reply_markup=keyboard.markup)
+        log_action(user_id, 'refresh_keyboard_button', 'inline')
     else:
-        cursor.execute("SELECT user_id, username, first_name, last_name, is_admin FROM users ORDER BY username LIMIT ?", (10,))
+        query.answer()
+
+def edit_callback_message(query, text=None, reply_markup=None):
+    """
+    Редактирует сообщение со встроенной клавиатурой через планировщик отправки;
+    отсутствие изменений не считается ошибкой.
+    """
+    def edit():
+        try:
+            if text is not None:
+                return query.edit_message_text(text, reply_markup=reply_markup)
+            return query.edit_message_reply_markup(reply_markup=reply_markup)
+        except BadRequest as e:
+            # Telegram отвечает ошибкой, если текст и клавиатура не изменились
+            if 'not modified' not in str(e).lower():
+                raise
+    
+    return send_scheduler.submit(query.message.chat_id, edit)
+
+def list_users(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
+        return
     
-    users = cursor.fetchall()
-    conn.close()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        
+        # Получаем общее количество пользователей
+        cursor.execute("SELECT COUNT(*) FROM users")
+        total_users = cursor.fetchone()[0]
+        
+        # Получаем список пользователей с ограничением
+        execute_statement(cursor, db_type, 'users_page', (10,))
+        
+        users = cursor.fetchall()
     
     # Формируем текст сообщения
     message = f"*Список пользователей*\n\nВсего пользователей: {total_users}\n\n"
@@ -1317,174 +1814,121 @@ def list_users(update: Update, context: CallbackContext) -> None:
     else:
         message += "Пользователи не найдены."
     
-    update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    reply(update, message, parse_mode=ParseMode.MARKDOWN)
     log_action(user_id, 'list_users', 'admin_command')
 
 def show_stats(update: Update, context: CallbackContext) -> None:
     """Показать статистику использования бота"""
     # Проверяем, является ли пользователь администратором
     user_id = update.effective_user.id
-    if not is_admin(user_id):
-        update.message.reply_text("Эта команда доступна только администраторам.")
+    if not get_principal(update, context).is_admin:
+        reply(update, "Эта команда доступна только администраторам.")
         return
 
     try:
         # Подключаемся к базе данных и получаем тип базы
-        conn, db_type = get_db_connection()
-        cursor = conn.cursor()
-
-        # Получаем общее количество пользователей
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-
-        # Получаем количество активных пользователей (по логам)
-        cursor.execute("SELECT COUNT(DISTINCT user_id) FROM logs")
-        active_users = cursor.fetchone()[0]
-
-        # Получаем количество администраторов
-        if db_type == 'postgres':
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_admin = TRUE")
-        else:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_admin = 1")
-        admin_count = cursor.fetchone()[0]
-
-        # Получаем количество неактивных пользователей
-        inactive_users = total_users - active_users
-
-        # Формируем текст статистики
-        stats_text = f"Статистика бота:\n"
-        stats_text += f"Всего пользователей: {total_users}\n"
-        stats_text += f"Запустили бота: {active_users}\n"
-        stats_text += f"Администраторов: {admin_count}\n"
-        stats_text += f"Добавлено, но не запустили бота: {inactive_users}\n\n"
-
-        # Получаем список администраторов
-        if db_type == 'postgres':
-            cursor.execute("SELECT username, first_name, last_name FROM users WHERE is_admin = TRUE")
-        else:
-            cursor.execute("SELECT username, first_name, last_name FROM users WHERE is_admin = 1")
-        admins = cursor.fetchall()
-
-        # Добавляем список администраторов
-        stats_text += "Список администраторов:\n"
-        for admin in admins:
-            username, first_name, last_name = admin
-            if username:
-                admin_display = "@" + username
-            else:
-                admin_display = first_name + (" " + last_name if last_name else "")
-            stats_text += f"- {admin_display}\n"
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
+
+            # Получаем общее количество пользователей
+            cursor.execute("SELECT COUNT(*) FROM users")
+            total_users = cursor.fetchone()[0]
+
+            # Получаем количество активных пользователей: тех, у кого есть хотя бы одна запись в логах
+            # (проверка по индексу logs.user_id, без просмотра всей таблицы логов)
+            active_users = execute_statement(cursor, db_type, 'active_users_count').fetchone()[0]
+
+            # Получаем количество администраторов
+            execute_statement(cursor, db_type, 'admins_count')
+            admin_count = cursor.fetchone()[0]
+
+            # Получаем количество неактивных пользователей
+            inactive_users = total_users - active_users
+
+            # Формируем текст статистики
+            stats_text = f"Статистика бота:\n"
+            stats_text += f"Всего пользователей: {total_users}\n"
+            stats_text += f"Запустили бота: {active_users}\n"
+            stats_text += f"Администраторов: {admin_count}\n"
+            stats_text += f"Добавлено, но не запустили бота: {inactive_users}\n\n"
+
+            # Получаем список администраторов
+            execute_statement(cursor, db_type, 'admins_list')
+            admins = cursor.fetchall()
+
+            # Добавляем список администраторов
+            stats_text += "Список администраторов:\n"
+            for admin in admins:
+                username, _, first_name, last_name = admin
+                if username:
+                    admin_display = "@" + username
+                else:
+                    admin_display = first_name + (" " + last_name if last_name else "")
+                stats_text += f"- {admin_display}\n"
 
-        stats_text += "\n"
+            stats_text += "\n"
 
-        # Используем VideoDownloadsAnalyzer для получения статистики по видео
-        print(f"Тип базы данных: {db_type}")
-        
-        # Создаем экземпляр анализатора с правильными параметрами подключения
-        if db_type == 'postgres':
-            # Получаем параметры подключения из переменных окружения
-            import os
-            import dj_database_url
-            
-            database_url = os.environ.get('DATABASE_URL')
-            print(f"DATABASE_URL: {database_url}")
-            
-            if database_url:
-                config = dj_database_url.parse(database_url)
-                analyzer = VideoDownloadsAnalyzer(
-                    db_type='postgresql',
-                    host=config['HOST'],
-                    database=config['NAME'],
-                    user=config['USER'],
-                    password=config['PASSWORD'],
-                    port=config['PORT']
-                )
-                print(f"Создан анализатор с параметрами: {config['HOST']}, {config['NAME']}, {config['USER']}")
-            else:
-                print("DATABASE_URL не найден, используем значения по умолчанию")
-                # Используем значения по умолчанию
-                analyzer = VideoDownloadsAnalyzer(
-                    db_type='postgresql',
-                    host='localhost',
-                    database='postgres',
-                    user='postgres',
-                    password='',
-                    port=5432
-                )
-        else:
-            # Для SQLite
+            # Используем VideoDownloadsAnalyzer для получения статистики по видео
+            # Анализатор работает на том же соединении из пула, а не открывает свое
             analyzer = VideoDownloadsAnalyzer(
-                db_type='sqlite',
-                database='filmschool.db'  # Используем файл базы данных по умолчанию
+                db_type='postgresql' if db_type == 'postgres' else 'sqlite',
+                connection=conn
             )
-        
-        # Получаем данные о скачиваниях видео
-        try:
-            analyzer.connect()
-            video_downloads = analyzer.get_video_downloads()
             
-            # Добавляем статистику по видео в общий отчет
-            for date in ['18 мая', '22 мая', '25 мая']:
-                users = video_downloads.get(date, [])
-                stats_text += f"Запись занятия {date} получили: {len(users)}\n"
+            # Получаем данные о скачиваниях видео
+            try:
+                video_downloads = analyzer.get_video_downloads()
+            
+                # Добавляем статистику по видео в общий отчет
+                for date in analyzer.known_dates:
+                    users = video_downloads.get(date, [])
+                    stats_text += f"Запись занятия {date} получили: {len(users)}\n"
                 
-                # Добавляем список пользователей
-                for user in users:
-                    # Проверяем, есть ли полное имя из CSV
-                    if 'full_name_from_csv' in user and user['full_name_from_csv']:
-                        # Если есть полное имя, добавляем его к никнейму
-                        if user['username']:
-                            stats_text += f"- @{user['username']} ({user['full_name_from_csv']})\n"
+                    # Добавляем список пользователей
+                    for user in users:
+                        # Проверяем, есть ли полное имя из CSV
+                        if 'full_name_from_csv' in user and user['full_name_from_csv']:
+                            # Если есть полное имя, добавляем его к никнейму
+                            if user['username']:
+                                stats_text += f"- @{user['username']} ({user['full_name_from_csv']})\n"
+                            else:
+                                # Используем имя из CSV без никнейма
+                                stats_text += f"- {user['full_name_from_csv']}\n"
                         else:
-                            # Используем имя из CSV без никнейма
-                            stats_text += f"- {user['full_name_from_csv']}\n"
-                    else:
-                        # Используем стандартное отображение
-                        stats_text += f"- {user['display_name']}\n"
+                            # Используем стандартное отображение
+                            stats_text += f"- {user['display_name']}\n"
                 
-                stats_text += "\n"
-        finally:
-            # Закрываем соединение анализатора
-            analyzer.disconnect()
+                    stats_text += "\n"
+            finally:
+                # Освобождаем курсор анализатора, само соединение вернется в пул
+                analyzer.disconnect()
 
         # Send statistics
-        update.message.reply_text(stats_text)
+        reply(update, stats_text)
         log_action(user_id, 'show_stats', 'admin_command')
-        
-        # Close database connection
-        cursor.close()
-        conn.close()
     except Exception as e:
         error_message = "Ошибка при получении статистики: " + str(e)
-        update.message.reply_text(error_message)
+        reply(update, error_message)
         print("Error in show_stats: " + str(e))
-        
-        # Закрываем соединение с базой данных в случае ошибки, если оно еще открыто
-        try:
-            if conn:
-                conn.close()
-        except:
-            pass
 
 def get_previous_video(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     user_id = user.id
-    username = user.username
     
-    if not is_user_authorized(user_id, username):
-        update.message.reply_text(MSG_NOT_AUTHORIZED)
+    if not get_principal(update, context).is_authorized:
+        reply(update, MSG_NOT_AUTHORIZED)
         return
     
-    conn = sqlite3.connect('filmschool.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT title, url, upload_date FROM videos ORDER BY upload_date DESC LIMIT 2")
-    videos = cursor.fetchall()
-    conn.close()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT title, url, upload_date FROM videos ORDER BY upload_date DESC LIMIT 2")
+        videos = cursor.fetchall()
     
     if len(videos) >= 2:
         title, url, date = videos[1]  # Second video is the previous one
-        update.message.reply_text(
+        reply(
+            update,
             f'*{title}*\n\n'
             f'Дата загрузки: {date}\n\n'
             f'Ссылка: {url}',
@@ -1492,78 +1936,57 @@ def get_previous_video(update: Update, context: CallbackContext) -> None:
         )
         log_action(user_id, 'get_previous_video', 'database_access')
     else:
-        update.message.reply_text('Предыдущее занятие пока не доступно. Пожалуйста, попробуйте позже.')
+        reply(update, 'Предыдущее занятие пока не доступно. Пожалуйста, попробуйте позже.')
 
 # Message handler
 def handle_message(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     user_id = user.id
-    username = user.username
     
     # Разрешаем доступ к кнопкам как авторизованным пользователям, так и администраторам
-    if not (is_user_authorized(user_id, username) or is_admin(user_id)):
-        update.message.reply_text(MSG_NOT_AUTHORIZED)
+    if not get_principal(update, context).is_authorized:
+        reply(update, MSG_NOT_AUTHORIZED)
         return
     
     text = update.message.text
     
-    # Загружаем актуальные настройки кнопок из базы данных
-    buttons_data = load_buttons()
-    
-    # Проверяем нажатие на кнопку 1 (последнее занятие)
-    if text == BUTTON_LATEST_LESSON:
-        # Используем индивидуальный текст сообщения для этой кнопки
-        # Используем обычный текст без Markdown, чтобы ссылки отображались корректно
-        update.message.reply_text(MSG_LATEST_LESSON)
-        # Извлекаем дату из текста кнопки
-        date_match = re.search(r'\d{1,2} \w+', BUTTON_LATEST_LESSON)
-        if date_match:
-            lesson_date = date_match.group(0)
-            # Логируем с указанием конкретной даты
-            log_action(user_id, f'get_video_{lesson_date}', BUTTON_LATEST_LESSON)
-        else:
-            # Если не удалось извлечь дату, используем стандартное логирование
-            log_action(user_id, 'get_latest_video', BUTTON_LATEST_LESSON)
-    # Проверяем нажатие на кнопку 2 (предыдущее занятие)
-    elif text == BUTTON_PREVIOUS_LESSON:
-        # Используем индивидуальный текст сообщения для этой кнопки
+    # Кнопка занятия: ответ, занятие и действие для лога вычислены заранее
+    button_action = BUTTON_ACTIONS.get(text)
+    if button_action is not None:
+        if not is_lesson_shown(button_action.published_at, button_action.expires_at):
+            # Кнопка осталась на старой клавиатуре, а занятие уже снято с показа
+            reply(update, MSG_LESSON_UNAVAILABLE)
+            return
         # Используем обычный текст без Markdown, чтобы ссылки отображались корректно
-        update.message.reply_text(MSG_PREVIOUS_LESSON)
-        # Извлекаем дату из текста кнопки
-        date_match = re.search(r'\d{1,2} \w+', BUTTON_PREVIOUS_LESSON)
-        if date_match:
-            lesson_date = date_match.group(0)
-            # Логируем с указанием конкретной даты
-            log_action(user_id, f'get_video_{lesson_date}', BUTTON_PREVIOUS_LESSON)
-        else:
-            # Если не удалось извлечь дату, используем стандартное логирование
-            log_action(user_id, 'get_previous_video', BUTTON_PREVIOUS_LESSON)
+        reply(update, button_action.reply)
+        log_action(user_id, button_action.action, button_action.action_data,
+                   lesson_id=button_action.lesson_id)
     # Проверяем нажатие на кнопку "Обновить"
     elif text == BUTTON_REFRESH:
         # Если нажата кнопка "Обновить", вызываем функцию refresh_keyboard
         refresh_keyboard(update, context)
         log_action(user_id, 'refresh_keyboard_button', 'button_click')
     else:
-        update.message.reply_text(
+        reply(
+            update,
             'Пожалуйста, используйте кнопки для доступа к записям занятий.'
         )
 
 def list_users(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
-    conn = sqlite3.connect('filmschool.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT user_id, username, first_name, last_name, is_admin FROM users ORDER BY is_admin DESC, registration_date DESC")
-    users = cursor.fetchall()
-    conn.close()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT user_id, username, first_name, last_name, is_admin FROM users ORDER BY is_admin DESC, registration_date DESC")
+        users = cursor.fetchall()
     
     if not users:
-        update.message.reply_text('В системе нет зарегистрированных пользователей.')
+        reply(update, 'В системе нет зарегистрированных пользователей.')
         return
     
     message = "*Список пользователей:*\n\n"
@@ -1589,25 +2012,24 @@ def list_users(update: Update, context: CallbackContext) -> None:
         
         message += f"{user_info}\n"
     
-    update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    reply(update, message, parse_mode=ParseMode.MARKDOWN)
     log_action(user_id, 'list_users', 'admin_command')
 
 def pending_users(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
-    conn = sqlite3.connect('filmschool.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT user_id, username, first_name, last_name, request_date FROM pending_users ORDER BY request_date DESC")
-    users = cursor.fetchall()
-    conn.close()
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT user_id, username, first_name, last_name, request_date FROM pending_users ORDER BY request_date DESC")
+        users = cursor.fetchall()
     
     if not users:
-        update.message.reply_text('Нет пользователей, ожидающих регистрации.')
+        reply(update, 'Нет пользователей, ожидающих регистрации.')
         return
     
     message = "*Пользователи, запросившие доступ:*\n\n"
@@ -1628,248 +2050,154 @@ def pending_users(update: Update, context: CallbackContext) -> None:
         if name:
             user_info += f"Имя: {name}\n"
         
-        user_info += f"Дата запроса: {request_date}\n"
+        user_info += f"Дата запроса: {format_timestamp(request_date)}\n"
         user_info += f"Добавить: `/adduser {user_id}`\n"
         
         message += f"{user_info}\n"
     
-    update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    reply(update, message, parse_mode=ParseMode.MARKDOWN)
     log_action(user_id, 'pending_users', 'admin_command')
 
 def make_admin(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
     # Проверяем, что команду выполняет администратор
-    if not is_admin(user_id):
-        update.message.reply_text('У вас нет прав для выполнения этой команды.')
+    if not get_principal(update, context).is_admin:
+        reply(update, 'У вас нет прав для выполнения этой команды.')
         return
     
     # Проверяем, что указан пользователь для повышения до администратора
     if not context.args:
-        update.message.reply_text('Пожалуйста, укажите Telegram ID или @username пользователя, которого вы хотите сделать администратором.')
+        reply(update, 'Пожалуйста, укажите Telegram ID или @username пользователя, которого вы хотите сделать администратором.')
         return
     
     user_identifier = context.args[0]
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Определяем, является ли идентификатор числом (ID) или именем пользователя
-    if user_identifier.isdigit():
-        # Если это ID
-        target_user_id = int(user_identifier)
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
         
-        # Проверяем, существует ли пользователь с таким ID
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id, username, is_admin FROM users WHERE user_id = %s", (target_user_id,))
-        else:
-            cursor.execute("SELECT user_id, username, is_admin FROM users WHERE user_id = ?", (target_user_id,))
+        # Определяем, является ли идентификатор числом (ID) или именем пользователя
+        if user_identifier.isdigit():
+            # Если это ID
+            target_user_id = int(user_identifier)
             
-        user_data = cursor.fetchone()
-        
-        if not user_data:
-            update.message.reply_text(f'Пользователь с ID {target_user_id} не найден.')
-            conn.close()
-            return
+            # Проверяем, существует ли пользователь с таким ID
+            execute_statement(cursor, db_type, 'user_admin_flag', (target_user_id,))
             
-        user_id, username, is_admin_flag = user_data
-        
-        # Проверяем, не является ли пользователь уже администратором
-        if db_type == 'postgres':
-            is_admin_value = is_admin_flag is True
-        else:
-            is_admin_value = is_admin_flag == 1
+            user_data = cursor.fetchone()
             
-        if is_admin_value:
-            update.message.reply_text(f'Пользователь с ID {target_user_id} уже является администратором.')
-            conn.close()
-            return
-        
-        # Делаем пользователя администратором
-        if db_type == 'postgres':
-            cursor.execute("UPDATE users SET is_admin = TRUE WHERE user_id = %s", (target_user_id,))
-        else:
-            cursor.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (target_user_id,))
-        conn.commit()
-        
-        username_str = f'@{username}' if username else ''
-        
-        # Создаем сообщение о назначении администратором
-        admin_message = f'''✅ Пользователь {username_str} (ID: {target_user_id}) успешно назначен администратором.
+            if not user_data:
+                reply(update, f'Пользователь с ID {target_user_id} не найден.')
+                return
+            
+            user_id, username, is_admin_flag = user_data
+            
+            # Проверяем, не является ли пользователь уже администратором
+            is_admin_value = bool(is_admin_flag)
+            
+            if is_admin_value:
+                reply(update, f'Пользователь с ID {target_user_id} уже является администратором.')
+                return
+            
+            # Делаем пользователя администратором
+            execute_statement(cursor, db_type, 'user_make_admin', (target_user_id,))
+            conn.commit()
+            auth_cache.invalidate(target_user_id)
+            
+            username_str = f'@{username}' if username else ''
+            
+            # Создаем сообщение о назначении администратором
+            admin_message = f'''✅ Пользователь {username_str} (ID: {target_user_id}) успешно назначен администратором.
 
-ℹ️ Для получения кнопок пользователь должен выполнить команду /start'''
-        
-        update.message.reply_text(admin_message)
-        log_action(user_id, 'make_admin', f'target_user_id:{target_user_id}')
+    ℹ️ Для получения кнопок пользователь должен выполнить команду /start'''
         
-    elif user_identifier.startswith('@'):
-        # Если это @username
-        username = user_identifier[1:]  # Убираем символ @
+            reply(update, admin_message)
+            log_action(user_id, 'make_admin', f'target_user_id:{target_user_id}')
         
-        # Находим пользователя по имени
-        if db_type == 'postgres':
-            cursor.execute("SELECT user_id, is_admin FROM users WHERE username = %s", (username,))
-        else:
-            cursor.execute("SELECT user_id, is_admin FROM users WHERE username = ?", (username,))
+        elif user_identifier.startswith('@'):
+            # Если это @username
+            username = user_identifier[1:]  # Убираем символ @
             
-        user_data = cursor.fetchone()
-        
-        if not user_data:
-            update.message.reply_text(f'Пользователь @{username} не найден.')
-            conn.close()
-            return
+            # Находим пользователя по имени
+            execute_statement(cursor, db_type, 'user_by_username', (normalize_username(username),))
             
-        target_user_id, is_admin_flag = user_data
-        
-        # Проверяем, не является ли пользователь уже администратором
-        if db_type == 'postgres':
-            is_admin_value = is_admin_flag is True
-        else:
-            is_admin_value = is_admin_flag == 1
+            user_data = cursor.fetchone()
             
-        if is_admin_value:
-            update.message.reply_text(f'Пользователь @{username} уже является администратором.')
-            conn.close()
-            return
-        
-        # Делаем пользователя администратором
-        if db_type == 'postgres':
-            cursor.execute("UPDATE users SET is_admin = TRUE WHERE user_id = %s", (target_user_id,))
-        else:
-            cursor.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (target_user_id,))
-        conn.commit()
-        
-        # Создаем сообщение о назначении администратором
-        admin_message = f'''✅ Пользователь @{username} (ID: {target_user_id}) успешно назначен администратором.
+            if not user_data:
+                reply(update, f'Пользователь @{username} не найден.')
+                return
+            
+            target_user_id, is_admin_flag = user_data
+            
+            # Проверяем, не является ли пользователь уже администратором
+            is_admin_value = bool(is_admin_flag)
+            
+            if is_admin_value:
+                reply(update, f'Пользователь @{username} уже является администратором.')
+                return
+            
+            # Делаем пользователя администратором
+            execute_statement(cursor, db_type, 'user_make_admin', (target_user_id,))
+            conn.commit()
+            auth_cache.invalidate(target_user_id)
+            
+            # Создаем сообщение о назначении администратором
+            admin_message = f'''✅ Пользователь @{username} (ID: {target_user_id}) успешно назначен администратором.
 
-ℹ️ Для получения кнопок пользователь должен выполнить команду /start'''
+    ℹ️ Для получения кнопок пользователь должен выполнить команду /start'''
         
-        update.message.reply_text(admin_message)
-        log_action(user_id, 'make_admin', f'target_username:@{username}')
+            reply(update, admin_message)
+            log_action(user_id, 'make_admin', f'target_username:@{username}')
         
-    else:
-        update.message.reply_text('Пожалуйста, укажите корректный Telegram ID или @username пользователя.')
-    
-    conn.close()
+        else:
+            reply(update, 'Пожалуйста, укажите корректный Telegram ID или @username пользователя.')
 
 def whois(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text("У вас нет прав для выполнения этой команды.")
+    if not get_principal(update, context).is_admin:
+        reply(update, "У вас нет прав для выполнения этой команды.")
         return
     
     # Проверяем, что передан параметр
     if not context.args:
-        update.message.reply_text("Укажите ID или @username пользователя. Например: /whois 123456789 или /whois @username")
+        reply(update, "Укажите ID или @username пользователя. Например: /whois 123456789 или /whois @username")
         return
     
     user_identifier = context.args[0]
     
     try:
-        conn, db_type = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Определяем, это ID или username
-        if user_identifier.isdigit():
-            # Это ID
-            if db_type == 'postgres':
-                cursor.execute("""
-                    SELECT user_id, username, first_name, last_name, registration_date, is_admin, 
-                    (SELECT COUNT(*) FROM logs WHERE user_id = %s) as log_count
-                    FROM users WHERE user_id = %s
-                """, (user_identifier, user_identifier))
-            else:
-                cursor.execute("""
-                    SELECT user_id, username, first_name, last_name, registration_date, is_admin, 
-                    (SELECT COUNT(*) FROM logs WHERE user_id = ?) as log_count
-                    FROM users WHERE user_id = ?
-                """, (user_identifier, user_identifier))
-        elif user_identifier.startswith('@'):
-            # Это username
-            username = user_identifier[1:]  # Убираем @
-            if db_type == 'postgres':
-                cursor.execute("""
-                    SELECT user_id, username, first_name, last_name, registration_date, is_admin, 
-                    (SELECT COUNT(*) FROM logs WHERE user_id = users.user_id) as log_count
-                    FROM users WHERE username = %s
-                """, (username,))
-            else:
-                cursor.execute("""
-                    SELECT user_id, username, first_name, last_name, registration_date, is_admin, 
-                    (SELECT COUNT(*) FROM logs WHERE user_id = users.user_id) as log_count
-                    FROM users WHERE username = ?
-                """, (username,))
-        else:
-            # Попробуем найти по username без @
-            if db_type == 'postgres':
-                cursor.execute("""
-                    SELECT user_id, username, first_name, last_name, registration_date, is_admin, 
-                    (SELECT COUNT(*) FROM logs WHERE user_id = users.user_id) as log_count
-                    FROM users WHERE username = %s
-                """, (user_identifier,))
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
+            
+            # Определяем, это ID или username
+            if user_identifier.isdigit():
+                # Это ID
+                execute_statement(cursor, db_type, 'whois_by_id', (int(user_identifier),))
+            elif user_identifier.startswith('@'):
+                # Это username
+                username = user_identifier[1:]  # Убираем @
+                execute_statement(cursor, db_type, 'whois_by_username', (normalize_username(username),))
             else:
-                cursor.execute("""
-                    SELECT user_id, username, first_name, last_name, registration_date, is_admin, 
-                    (SELECT COUNT(*) FROM logs WHERE user_id = users.user_id) as log_count
-                    FROM users WHERE username = ?
-                """, (user_identifier,))
-        
-        user_data = cursor.fetchone()
-        
-        if not user_data:
-            update.message.reply_text(f"Пользователь {user_identifier} не найден.")
-            conn.close()
-            return
-        
-        user_id, username, first_name, last_name, registration_date, is_admin, log_count = user_data
-        
-        # Получаем дополнительную информацию о действиях пользователя
-        # Последние 5 действий
-        if db_type == 'postgres':
-            cursor.execute("""
-                SELECT action, action_data, timestamp 
-                FROM logs 
-                WHERE user_id = %s 
-                ORDER BY timestamp DESC 
-                LIMIT 5
-            """, (user_id,))
-        else:
-            cursor.execute("""
-                SELECT action, action_data, timestamp 
-                FROM logs 
-                WHERE user_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT 5
-            """, (user_id,))
-        
-        recent_actions = cursor.fetchall()
-        
-        # Получаем статистику по записям занятий
-        if db_type == 'postgres':
-            cursor.execute("""
-                SELECT COUNT(*) FROM logs 
-                WHERE user_id = %s AND action = 'get_latest_video'
-            """, (user_id,))
-        else:
-            cursor.execute("""
-                SELECT COUNT(*) FROM logs 
-                WHERE user_id = ? AND action = 'get_latest_video'
-            """, (user_id,))
-        latest_video_count = cursor.fetchone()[0]
-        
-        if db_type == 'postgres':
-            cursor.execute("""
-                SELECT COUNT(*) FROM logs 
-                WHERE user_id = %s AND action = 'get_previous_video'
-            """, (user_id,))
-        else:
-            cursor.execute("""
-                SELECT COUNT(*) FROM logs 
-                WHERE user_id = ? AND action = 'get_previous_video'
-            """, (user_id,))
-        previous_video_count = cursor.fetchone()[0]
-        
-        conn.close()
+                # Попробуем найти по username без @
+                execute_statement(cursor, db_type, 'whois_by_username', (normalize_username(user_identifier),))
+            
+            user_data = cursor.fetchone()
+            
+            if not user_data:
+                reply(update, f"Пользователь {user_identifier} не найден.")
+                return
+            
+            user_id, username, first_name, last_name, registration_date, is_admin, log_count = user_data
+            
+            # Получаем дополнительную информацию о действиях пользователя
+            # Последние 5 действий
+            execute_statement(cursor, db_type, 'user_recent_actions', (user_id,))
+            
+            recent_actions = cursor.fetchall()
+            
+            # Получаем статистику по записям занятий
+            execute_statement(cursor, db_type, 'user_lesson_counts', (user_id,))
+            lesson_counts = cursor.fetchall()
         
         # Формируем сообщение с информацией о пользователе
         message_text = f"Информация о пользователе:\n\n"
@@ -1883,7 +2211,7 @@ def whois(update: Update, context: CallbackContext) -> None:
             message_text += f"Имя: {full_name}\n"
         
         if registration_date:
-            message_text += f"Дата регистрации: {registration_date}\n"
+            message_text += f"Дата регистрации: {format_timestamp(registration_date)}\n"
         
         # Проверяем статус администратора
         is_admin_text = "Да" if (is_admin == 1 or is_admin is True) else "Нет"
@@ -1891,59 +2219,41 @@ def whois(update: Update, context: CallbackContext) -> None:
         
         # Статистика активности
         message_text += f"Всего действий: {log_count}\n"
-        message_text += f"Запросов записи 18 мая: {latest_video_count}\n"
-        message_text += f"Запросов записи 22 мая: {previous_video_count}\n\n"
+        for lesson_title, lesson_count in lesson_counts:
+            message_text += f"Запросов записи {lesson_title}: {lesson_count}\n"
+        message_text += "\n"
         
         # Последние действия
         if recent_actions:
             message_text += "Последние действия:\n"
             for action, action_data, timestamp in recent_actions:
-                message_text += f"- {timestamp}: {action}\n"
+                message_text += f"- {format_timestamp(timestamp)}: {action}\n"
         
-        update.message.reply_text(message_text)
+        reply(update, message_text)
         log_action(user_id, 'whois', f'target:{user_identifier}')
     except Exception as e:
         error_message = f"Ошибка при получении информации о пользователе: {e}"
-        update.message.reply_text(error_message)
+        reply(update, error_message)
         print(f"Error in whois: {e}")
 
 def show_user_lists(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        update.message.reply_text("У вас нет прав для выполнения этой команды.")
+    if not get_principal(update, context).is_admin:
+        reply(update, "У вас нет прав для выполнения этой команды.")
         return
     
     try:
-        conn, db_type = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get list of administrators with all fields
-        if db_type == 'postgres':
-            cursor.execute("SELECT username, user_id, first_name, last_name FROM users WHERE is_admin = TRUE ORDER BY username")
-        else:
-            cursor.execute("SELECT username, user_id, first_name, last_name FROM users WHERE is_admin = 1 ORDER BY username")
-        admins_list = cursor.fetchall()
-        
-        # Get list of users who started the bot
-        if db_type == 'postgres':
-            cursor.execute("""
-                SELECT DISTINCT u.username, u.user_id, u.first_name, u.last_name 
-                FROM logs l 
-                JOIN users u ON l.user_id = u.user_id 
-                ORDER BY u.username NULLS LAST, u.first_name NULLS LAST, u.user_id
-            """)
-        else:
-            # SQLite не поддерживает NULLS LAST, используем более простой запрос
-            cursor.execute("""
-                SELECT DISTINCT u.username, u.user_id, u.first_name, u.last_name 
-                FROM logs l 
-                JOIN users u ON l.user_id = u.user_id 
-                ORDER BY u.username, u.first_name, u.user_id
-            """)
-        active_users = cursor.fetchall()
-        
-        conn.close()
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
+            
+            # Get list of administrators with all fields
+            execute_statement(cursor, db_type, 'admins_list')
+            admins_list = cursor.fetchall()
+            
+            # Get list of users who started the bot
+            execute_statement(cursor, db_type, 'active_users_list')
+            active_users = cursor.fetchall()
         
         # Format the message
         message_text = "Списки пользователей\n\n"
@@ -1994,81 +2304,122 @@ def show_user_lists(update: Update, context: CallbackContext) -> None:
                 message_text += "- " + user_display + "\n"
         
         # Send the message
-        update.message.reply_text(message_text)
+        reply(update, message_text)
         log_action(user_id, 'show_user_lists', 'admin_command')
     except Exception as e:
         error_message = "Ошибка при получении списков пользователей: " + str(e)
-        update.message.reply_text(error_message)
+        reply(update, error_message)
         print("Error in show_user_lists: " + str(e))
 
+# Сколько секунд ждать каждый этап остановки (разбор обновлений, обработчики, отправка, логи)
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', '10'))
+shutdown_started = threading.Event()
+
 # Глобальная переменная для хранения экземпляра Updater
 global_updater = None
 
 # Функция для корректного завершения работы бота
-def shutdown_bot(signal_number=None, frame=None):
+def shutdown_bot(signal_number=None, frame=None, exit_code=0):
+    if shutdown_started.is_set():
+        return
+    shutdown_started.set()
     print("Получен сигнал завершения. Корректно завершаем работу бота...")
     global global_updater
     
-    # Удаляем файл блокировки
-    remove_lock_file()
+    if global_updater and global_updater.dispatcher.running:
+        # Перестаем получать обновления и дожидаемся, пока диспетчер разберет уже полученные
+        print("Дообрабатываем полученные обновления...")
+        global_updater.stop_receiving()
+        drained = DrainMarker()
+        global_updater.dispatcher.update_queue.put(drained)
+        if not drained.done.wait(SHUTDOWN_TIMEOUT):
+            logger.warning("Диспетчер не успел разобрать все полученные обновления")
+    
+    # Дообрабатываем обновления, уже принятые в очереди пользователей
+    update_sequencer.stop(timeout=SHUTDOWN_TIMEOUT)
+    if TRACK_UPDATE_OFFSET:
+        update_tracker.save()
+    
+    # Останавливаем рассылку: она продолжится с сохраненной порции после перезапуска
+    broadcaster.stop(timeout=SHUTDOWN_TIMEOUT)
+    
+    # Обновления разобраны, ID последнего сохранен, рассылка остановлена - отдаем
+    # роль ведущего резервному экземпляру, не дожидаясь окончания остановки
+    leader_election.stop()
+    
+    # Отправляем ответы, уже поставленные в очередь
+    send_scheduler.stop(timeout=SHUTDOWN_TIMEOUT)
+    
+    # Дописываем накопленные логи, пока соединения с базой еще открыты
+    log_writer.stop(timeout=SHUTDOWN_TIMEOUT)
     
     if global_updater:
+        # Updater.stop() не используется: он ждал бы, пока поток опроса получит ответ
+        # getUpdates (до POLL_TIMEOUT секунд). Эта пачка не подтверждена и придет снова
         print("Останавливаем бота...")
-        global_updater.stop()
+        global_updater.job_queue.stop()
+        global_updater.dispatcher.stop()
         print("Бот остановлен.")
-    sys.exit(0)
-
-# Путь к файлу блокировки
-LOCK_FILE = '/tmp/tombot_lock'
-
-# Функция для проверки и создания файла блокировки
-def check_lock_file():
-    # Проверяем, существует ли файл блокировки
-    if os.path.exists(LOCK_FILE):
-        try:
-            # Проверяем время создания файла
-            file_time = os.path.getmtime(LOCK_FILE)
-            current_time = time.time()
-            
-            # Если файл старше 1 часа, удаляем его (считаем, что предыдущий процесс завис)
-            if current_time - file_time > 3600:  # 3600 секунд = 1 час
-                os.remove(LOCK_FILE)
-                logger.warning(f'Удален устаревший файл блокировки ({current_time - file_time:.1f} сек. назад)')
-            else:
-                # Если файл свежий, значит другой экземпляр бота уже запущен
-                logger.error(f'Обнаружен файл блокировки ({current_time - file_time:.1f} сек. назад). Возможно, другой экземпляр бота уже запущен.')
-                sys.exit(1)
-        except Exception as e:
-            logger.error(f'Ошибка при проверке файла блокировки: {e}')
-            # Удаляем файл блокировки в случае ошибки
-            try:
-                os.remove(LOCK_FILE)
-            except:
-                pass
     
-    # Создаем новый файл блокировки
-    try:
-        with open(LOCK_FILE, 'w') as f:
-            f.write(str(os.getpid()))
-        logger.info(f'Создан файл блокировки: {LOCK_FILE}')
-    except Exception as e:
-        logger.error(f'Ошибка при создании файла блокировки: {e}')
+    # Закрываем соединения пула с базой данных
+    close_db_connections()
+    logging.shutdown()
+    sys.stdout.flush()
+    os._exit(exit_code)
+
+def become_leader():
+    """Экземпляр стал ведущим: продолжает рассылки, прерванные перезапуском или сменой ведущего"""
+    broadcaster.start()
+    if UPDATE_MODE == UPDATE_MODE_WEBHOOK and global_updater:
+        # Вебхук принимают все экземпляры, и рассылку могли запустить командой на другом
+        global_updater.job_queue.run_repeating(check_broadcasts, interval=BROADCAST_CHECK_INTERVAL,
+                                               first=BROADCAST_CHECK_INTERVAL)
+
+def check_broadcasts(context: CallbackContext) -> None:
+    """Периодическая задача ведущего: подхватывает рассылки, запущенные на других экземплярах"""
+    broadcaster.start()
+
+def lose_leadership():
+    """
+    Роль ведущего потеряна (например, разорвалось соединение с блокировкой): завершаем
+    работу, чтобы не получать обновления вместе с новым ведущим. После перезапуска
+    экземпляр вернется в резерв
+    """
+    logger.error('Роль ведущего перешла к другому экземпляру. Завершаем работу...')
+    shutdown_bot(exit_code=1)
+
+# Обновления получает и рассылки выполняет только ведущий экземпляр; остальные
+# ждут в резерве и занимают его место, как только роль освобождается
+leader_election = LeaderElection(become_leader, lose_leadership)
+
+# Какие типы обновлений нужны обработчикам каждого вида. Отредактированные сообщения
+# не запрашиваются: повторно выполнять команду или нажатие при правке не нужно
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: (Update.MESSAGE,),
+    MessageHandler: (Update.MESSAGE,),
+    CallbackQueryHandler: (Update.CALLBACK_QUERY,),
+    # Предобработчики групп -3 и -2 видят все, что получено для основных обработчиков
+    TypeHandler: (),
+}
 
-# Функция для удаления файла блокировки при завершении работы бота
-def remove_lock_file():
-    try:
-        if os.path.exists(LOCK_FILE):
-            os.remove(LOCK_FILE)
-            logger.info(f'Файл блокировки удален: {LOCK_FILE}')
-    except Exception as e:
-        logger.error(f'Ошибка при удалении файла блокировки: {e}')
+def handled_update_types(dispatcher):
+    """
+    Типы обновлений, которые нужно запрашивать у Telegram для зарегистрированных
+    обработчиков; если вид обработчика неизвестен - все типы
+    """
+    update_types = set()
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler_types = HANDLER_UPDATE_TYPES.get(type(handler))
+            if handler_types is None:
+                logger.warning(f"Неизвестный вид обработчика {type(handler).__name__}: запрашиваем все обновления")
+                return Update.ALL_TYPES
+            update_types.update(handler_types)
+    return sorted(update_types)
 
 def main() -> None:
     global global_updater
     
-    # Проверяем и создаем файл блокировки
-    check_lock_file()
-    
     # Регистрируем обработчики сигналов для корректного завершения работы
     signal.signal(signal.SIGINT, shutdown_bot)  # Ctrl+C
     signal.signal(signal.SIGTERM, shutdown_bot)  # Сигнал завершения от системы
@@ -2086,19 +2437,59 @@ def main() -> None:
     # Load button settings from database
     load_buttons_from_db()
     
+    # Запускаем фоновую запись логов
+    log_writer.start()
+    
     # Get token from environment variable
     token = os.environ.get('TELEGRAM_TOKEN')
     if not token:
         logger.error("No token provided. Set the TELEGRAM_TOKEN environment variable.")
         return
     
-    # Create the Updater with increased timeout and retry settings
-    updater = Updater(token, request_kwargs={'read_timeout': 30, 'connect_timeout': 30}, use_context=True)
+    # Адрес Bot API можно подменить, например на локальный fake_telegram.py
+    base_url = os.environ.get('TELEGRAM_API_URL') or None
+    
+    # Create the Updater with increased timeout and retry settings. Соединений с Bot API
+    # хватает на все потоки, которые обращаются к нему одновременно: отправку,
+    # обработчики и получение обновлений
+    request_kwargs = {'read_timeout': 30, 'connect_timeout': 30,
+                      'con_pool_size': SEND_CONCURRENCY + UPDATE_WORKERS + 4}
+    if UPDATE_MODE == UPDATE_MODE_WEBHOOK:
+        if not WEBHOOK_URL:
+            logger.error("Для UPDATE_MODE=webhook укажите публичный адрес в WEBHOOK_URL.")
+            return
+        if not WEBHOOK_SECRET_TOKEN:
+            logger.warning("WEBHOOK_SECRET_TOKEN не задан: вебхук принимает запросы без проверки отправителя")
+        updater = WebhookUpdater(token, base_url=base_url, secret_token=WEBHOOK_SECRET_TOKEN,
+                                 request_kwargs=request_kwargs, use_context=True)
+    else:
+        updater = PollingUpdater(token, base_url=base_url, request_kwargs=request_kwargs, use_context=True)
     global_updater = updater
     
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
     
+    # Сверяем версию кнопок с базой, чтобы подхватить изменения других процессов
+    updater.job_queue.run_repeating(check_buttons_version, interval=BUTTONS_VERSION_CHECK_INTERVAL,
+                                    first=BUTTONS_VERSION_CHECK_INTERVAL)
+    
+    # Публикации и снятия занятий выполняются по расписанию; дальше расписание
+    # обновляется после каждой перезагрузки каталога
+    schedule_lesson_rotation()
+    
+    # Сохраняем ID последнего обработанного обновления, чтобы продолжить с него после перезапуска
+    if TRACK_UPDATE_OFFSET:
+        updater.job_queue.run_repeating(save_update_offset, interval=UPDATE_OFFSET_SAVE_INTERVAL,
+                                        first=UPDATE_OFFSET_SAVE_INTERVAL)
+    
+    # Учет обновлений идет первым, а его завершение - после всех обработчиков
+    dispatcher.add_handler(TypeHandler(Update, track_update), group=-3)
+    dispatcher.add_handler(TypeHandler(Update, finish_update), group=1)
+    dispatcher.add_handler(TypeHandler(DrainMarker, mark_drained), group=-3)
+    
+    # Частота запросов ограничивается раньше всего остального, без обращения к базе
+    dispatcher.add_handler(TypeHandler(Update, rate_limit), group=-2)
+    
     # Register command handlers
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("help", help_command))
@@ -2107,6 +2498,9 @@ def main() -> None:
     dispatcher.add_handler(CommandHandler("addusers", add_users))
     dispatcher.add_handler(CommandHandler("removeuser", remove_user))
     dispatcher.add_handler(CommandHandler("updatevideo", update_video))
+    dispatcher.add_handler(CommandHandler("publish", publish_command))
+    dispatcher.add_handler(CommandHandler("retire", retire_command))
+    dispatcher.add_handler(CommandHandler("broadcast", broadcast_command))
     dispatcher.add_handler(CommandHandler("stats", show_stats))
     dispatcher.add_handler(CommandHandler("actions", show_actions))
     dispatcher.add_handler(CommandHandler("listusers", list_users))
@@ -2120,47 +2514,73 @@ def main() -> None:
     dispatcher.add_handler(CommandHandler("whois", whois))
     
     # Register button update command handlers
-    dispatcher.add_handler(CommandHandler("button1", update_button))
-    dispatcher.add_handler(CommandHandler("button2", update_button))
+    for button_number in range(1, LESSON_BUTTONS_COUNT + 1):
+        dispatcher.add_handler(CommandHandler(f"button{button_number}", update_button))
     
     # Register message handler
+    dispatcher.add_handler(CallbackQueryHandler(handle_lesson_callback,
+                                                pattern=f'^({CALLBACK_LESSON}:|{CALLBACK_REFRESH}$)'))
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
     
+    # Основные обработчики выполняются в пуле update_sequencer вместе с определением прав
+    # автора; ограничение частоты (группа -2) по-прежнему работает в потоке диспетчера
+    for handler in dispatcher.handlers[0]:
+        handler.callback = sequenced(handler.callback)
+    
     # Добавляем обработчик ошибок для обработки конфликтов
     def error_handler(update, context):
         error = context.error
         logger.error(f'Ошибка при обработке обновления: {error}')
         
-        # Проверяем, является ли ошибка конфликтом
+        # Конфликт означает, что обновления запрашивает еще кто-то (например, прежний ведущий
+        # в момент смены); опрос повторяется с увеличивающейся паузой, бот не останавливается
         if 'Conflict' in str(error):
-            logger.warning('Обнаружен конфликт с другим экземпляром бота. Завершаем работу...')
-            shutdown_bot()
+            logger.warning('Обнаружен конфликт с другим экземпляром бота, повторяем запрос')
     
     # Регистрируем обработчик ошибок
     dispatcher.add_error_handler(error_handler)
     
+    # Telegram присылает только те обновления, которые обрабатывает бот
+    allowed_updates = handled_update_types(dispatcher)
+    logger.info(f"Запрашиваемые типы обновлений: {', '.join(allowed_updates)}")
+    
     # Start the Bot with error handling
     try:
-        # Увеличиваем время между повторными попытками при ошибках и очищаем очередь обновлений
-        updater.start_polling(poll_interval=1.0, timeout=30, drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+        leader_election.start()
+        if UPDATE_MODE != UPDATE_MODE_WEBHOOK and not leader_election.acquired.wait(1):
+            # Резервный экземпляр: все уже готово, опрос начнется сразу после смены ведущего
+            logger.info('Ожидаем, пока экземпляр станет ведущим...')
+            leader_election.acquired.wait()
+        
+        # Продолжаем с обновления, следующего за последним обработанным (в том числе прежним ведущим)
+        if TRACK_UPDATE_OFFSET:
+            update_tracker.restore()
+            if update_tracker.resume_from is not None:
+                updater.last_update_id = update_tracker.resume_from + 1
+                logger.info(f"Продолжаем с обновления {updater.last_update_id}")
+        
+        if UPDATE_MODE == UPDATE_MODE_WEBHOOK:
+            # Telegram сам доставляет обновления на локальный HTTP-сервер, без задержки опроса
+            updater.start_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                                  webhook_url=webhook_url(), drop_pending_updates=False,
+                                  allowed_updates=allowed_updates, max_connections=WEBHOOK_MAX_CONNECTIONS)
+            logger.info(f"Вебхук слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        else:
+            # Длинный опрос: Telegram держит запрос до POLL_TIMEOUT секунд и отвечает, как только
+            # появятся обновления. Накопившиеся за время перезапуска обновления обрабатываются
+            # (кроме слишком старых, см. track_update)
+            updater.start_polling(poll_interval=POLL_INTERVAL, timeout=POLL_TIMEOUT, drop_pending_updates=False,
+                                  allowed_updates=allowed_updates)
         
         # Log that the bot has started
         logger.info('Bot started')
         
-        # Run the bot until you press Ctrl-C or the process receives SIGINT,
-        # SIGTERM or SIGABRT. This should be used most of the time, since
-        # start_polling() is non-blocking and will stop the bot gracefully.
-        updater.idle()
+        # Работаем до сигнала SIGINT или SIGTERM. Сигналы обрабатывает shutdown_bot, а не
+        # Updater: он остановил бы диспетчер, не дообработав уже полученные обновления
+        updater.idle(stop_signals=())
     except Exception as e:
         logger.error(f'Ошибка при запуске бота: {e}')
-        # Если произошла ошибка конфликта, попробуем корректно завершить работу
-        if 'Conflict' in str(e):
-            logger.warning('Обнаружен конфликт с другим экземпляром бота. Завершаем работу...')
-            shutdown_bot()
-        else:
-            # Для других ошибок просто логируем и завершаем
-            logger.error(f'Неожиданная ошибка: {e}')
-            shutdown_bot()
+        shutdown_bot(exit_code=1)
 
 if __name__ == '__main__':
     main()
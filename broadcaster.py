@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+
+from db_utils import (get_broadcasts_with_status, get_broadcast_status, get_broadcast_recipients,
+                      save_broadcast_progress, finish_broadcast)
+
+logger = logging.getLogger(__name__)
+
+# Сколько получателей читать из базы и отправлять за один шаг рассылки
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', '100'))
+# Как часто (в секундах) ведущий экземпляр проверяет рассылки, запущенные на других экземплярах
+BROADCAST_CHECK_INTERVAL = float(os.environ.get('BROADCAST_CHECK_INTERVAL', '30'))
+
+# Статусы рассылки в таблице broadcasts
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_CANCELLED = 'cancelled'
+
+
+class Broadcaster:
+    """
+    Фоновое выполнение рассылок из таблицы broadcasts.
+
+    Получатели читаются порциями по возрастанию user_id. send(user_id, message)
+    возвращает Future (сообщения ставятся в планировщик отправки, который
+    соблюдает лимиты Telegram); после каждой порции курсор и счетчики сохраняются,
+    поэтому после перезапуска рассылка продолжается с последней сохраненной порции
+    (сообщения незавершенной порции могут прийти повторно). По окончании
+    вызывается on_finish(broadcast, status, sent, failed).
+    """
+
+    def __init__(self, send, on_finish=None, batch_size=BROADCAST_BATCH_SIZE):
+        self._send = send
+        self._on_finish = on_finish
+        self.batch_size = max(1, batch_size)
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Запускает фоновый поток и продолжает незавершенные рассылки"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='broadcaster', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        """Останавливает рассылку после текущей порции"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                for broadcast in get_broadcasts_with_status(STATUS_RUNNING):
+                    if self._stopping.is_set():
+                        return
+                    self._process(broadcast)
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении рассылок: {e}")
+
+    def _process(self, broadcast):
+        last_user_id, sent, failed = broadcast.last_user_id, broadcast.sent, broadcast.failed
+        logger.info(f"Рассылка #{broadcast.id}: продолжаем после user_id {last_user_id}")
+        while not self._stopping.is_set():
+            # Рассылку могли отменить командой, пока шла предыдущая порция
+            if get_broadcast_status(broadcast.id) != STATUS_RUNNING:
+                return
+
+            user_ids = get_broadcast_recipients(last_user_id, self.batch_size)
+            if not user_ids:
+                if finish_broadcast(broadcast.id, STATUS_DONE, STATUS_RUNNING):
+                    logger.info(f"Рассылка #{broadcast.id} завершена: отправлено {sent}, ошибок {failed}")
+                    if self._on_finish is not None:
+                        self._on_finish(broadcast, STATUS_DONE, sent, failed)
+                return
+
+            futures = [(user_id, self._send(user_id, broadcast.message)) for user_id in user_ids]
+            for user_id, future in futures:
+                try:
+                    future.result()
+                    sent += 1
+                except Exception as e:
+                    # Пользователь заблокировал бота или не начинал с ним диалог
+                    logger.info(f"Рассылка #{broadcast.id}: не доставлено пользователю {user_id}: {e}")
+                    failed += 1
+
+            last_user_id = user_ids[-1]
+            save_broadcast_progress(broadcast.id, last_user_id, sent, failed)
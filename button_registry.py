@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Как часто (в секундах) сверять версию кнопок с базой, чтобы заметить изменения,
+# сделанные другим процессом или напрямую в базе
+BUTTONS_VERSION_CHECK_INTERVAL = float(os.environ.get('BUTTONS_VERSION_CHECK_INTERVAL', '60'))
+
+
+class ButtonRegistry:
+    """
+    Кнопки в памяти процесса вместе с номером их версии в базе.
+
+    Нажатия кнопок читают только память. Набор перечитывается из базы через
+    load() -> (версия, кнопки) после записи (reload) или когда check_version()
+    обнаруживает, что версия в базе изменилась. Подписчики on_change получают
+    новый набор после каждой перезагрузки.
+    """
+
+    def __init__(self, load, get_version):
+        self._load = load
+        self._get_version = get_version
+        self.version = None
+        self.buttons = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def on_change(self, callback):
+        """Регистрирует callback(buttons), вызываемый после каждой перезагрузки"""
+        self._listeners.append(callback)
+
+    def reload(self):
+        """Перечитывает кнопки из базы и оповещает подписчиков"""
+        with self._lock:
+            version, buttons = self._load()
+            self._apply(version, buttons)
+        logger.info(f"Кнопки загружены, версия {version}")
+        return buttons
+
+    def install(self, version, buttons):
+        """Устанавливает заранее загруженный набор кнопок без обращения к базе"""
+        with self._lock:
+            self._apply(version, buttons)
+        logger.info(f"Установлен подготовленный набор кнопок, версия {version}")
+
+    def _apply(self, version, buttons):
+        self.buttons = buttons
+        for callback in self._listeners:
+            callback(buttons)
+        # Версия меняется последней: все, что закэшировано по новой версии,
+        # построено уже из нового набора
+        self.version = version
+
+    def check_version(self):
+        """Перезагружает кнопки, если их версия в базе отличается от версии в памяти"""
+        try:
+            version = self._get_version()
+        except Exception as e:
+            logger.error(f"Не удалось проверить версию кнопок: {e}")
+            return False
+        if version == self.version:
+            return False
+        self.reload()
+        return True
@@ -1,6 +1,12 @@
 import os
 import sqlite3
+import threading
+import time
+import datetime
+from collections import namedtuple
+from contextlib import contextmanager
 import psycopg2
+import pytz
 import dj_database_url
 from dotenv import load_dotenv
 import logging
@@ -16,10 +22,254 @@ logger = logging.getLogger(__name__)
 DB_TYPE_SQLITE = 'sqlite'
 DB_TYPE_POSTGRES = 'postgres'
 
+# Наборы данных, версия которых хранится в таблице data_versions
+DATA_VERSION_BUTTONS = 'buttons'
+DATA_VERSION_LESSONS = 'lessons'
+DATA_VERSIONS = (DATA_VERSION_BUTTONS, DATA_VERSION_LESSONS)
+
+# Ключ таблицы bot_state с ID последнего обработанного обновления Telegram
+STATE_LAST_UPDATE_ID = 'last_update_id'
+
+# Ключ advisory-блокировки PostgreSQL и имя строки leader_lease (SQLite), за которые
+# соревнуются экземпляры бота при выборе ведущего
+LEADER_LOCK_KEY = 0x746f6d626f74
+LEADER_LOCK_NAME = 'leader'
+
+# Параметры пула соединений PostgreSQL (можно переопределить переменными окружения)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+# Сколько секунд ждать свободное соединение, прежде чем выдать ошибку
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+# Соединения сверх минимума, простаивающие дольше этого времени, закрываются
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+# Соединение, простаивавшее дольше этого времени, проверяется запросом SELECT 1 перед выдачей
+DB_POOL_PING_INTERVAL = float(os.environ.get('DB_POOL_PING_INTERVAL', '30'))
+
+
+class PoolTimeoutError(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+
+class ConnectionPool:
+    """
+    Потокобезопасный пул соединений с ограничением размера.
+
+    Соединения создаются лениво функцией connect, перед выдачей соединение,
+    долго пролежавшее без дела, проверяется запросом SELECT 1, а лишние
+    простаивающие соединения закрываются при возврате в пул.
+    """
+
+    def __init__(self, connect, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 idle_timeout=DB_POOL_IDLE_TIMEOUT, ping_interval=DB_POOL_PING_INTERVAL):
+        self._connect = connect
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        # Свободные соединения: список пар (соединение, время возврата в пул)
+        self._idle = []
+        # Количество открытых соединений (свободных и выданных)
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def getconn(self):
+        """Берет соединение из пула, при необходимости открывая новое"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeoutError("Пул соединений закрыт")
+                    if self._idle:
+                        # Берем последнее возвращенное соединение: оно с большей вероятностью живое
+                        conn, released_at = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        conn, released_at = None, None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeoutError(
+                            f"Нет свободных соединений в пуле ({self.maxconn}) в течение {self.timeout} сек."
+                        )
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+
+            if self._is_alive(conn, released_at):
+                return conn
+            # Соединение оборвалось, пока лежало в пуле - выбрасываем и пробуем снова
+            logger.warning("Discarding broken pooled database connection")
+            self._discard(conn)
+
+    def putconn(self, conn, discard=False):
+        """Возвращает соединение в пул (или закрывает его, если оно испорчено)"""
+        if discard or getattr(conn, 'closed', 0):
+            self._discard(conn)
+            return
+        try:
+            # Откатываем незавершенную транзакцию, как это делал бы conn.close()
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                self._close_quietly(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._reap_locked()
+            self._cond.notify()
+
+    def closeall(self):
+        """Закрывает все свободные соединения и запрещает выдачу новых"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def _is_alive(self, conn, released_at):
+        if getattr(conn, 'closed', 0):
+            return False
+        if time.monotonic() - released_at < self.ping_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _reap_locked(self):
+        # Закрываем соединения сверх минимума, которые слишком долго не использовались
+        now = time.monotonic()
+        while len(self._idle) > self.minconn and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self._close_quietly(conn)
+
+    def _discard(self, conn):
+        self._close_quietly(conn)
+        self._forget()
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class PooledConnection:
+    """
+    Обертка над соединением из пула.
+
+    Ведет себя как обычное соединение, но close() возвращает его в пул,
+    поэтому старый код вида conn, db_type = get_db_connection(); ...; conn.close()
+    продолжает работать без изменений.
+    """
+
+    def __init__(self, conn, release):
+        self._conn = conn
+        self._release = release
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._release(conn)
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise AttributeError(f"Соединение уже возвращено в пул: {name}")
+        return getattr(self._conn, name)
+
+
+_postgres_pool = None
+_postgres_pool_lock = threading.Lock()
+_sqlite_local = threading.local()
+
+
+def _connect_postgres(config, **kwargs):
+    return psycopg2.connect(
+        dbname=config['NAME'],
+        user=config['USER'],
+        password=config['PASSWORD'],
+        host=config['HOST'],
+        port=config['PORT'],
+        **kwargs
+    )
+
+
+def _get_postgres_pool(database_url):
+    """Создает пул PostgreSQL один раз на процесс (URL разбирается только здесь)"""
+    global _postgres_pool
+    if _postgres_pool is None:
+        with _postgres_pool_lock:
+            if _postgres_pool is None:
+                config = dj_database_url.parse(database_url)
+
+                def connect():
+                    conn = _connect_postgres(config, connection_factory=PreparingConnection)
+                    logger.info("Opened new PostgreSQL connection for the pool")
+                    return conn
+
+                _postgres_pool = ConnectionPool(connect)
+    return _postgres_pool
+
+
+def _get_sqlite_connection():
+    """Возвращает SQLite-соединение, закрепленное за текущим потоком"""
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is None:
+        db_path = get_sqlite_path()
+        conn = sqlite3.connect(db_path)
+        _sqlite_local.conn = conn
+        _sqlite_local.depth = 0
+        logger.info(f"Connected to SQLite database at {db_path}")
+    # Считаем вложенные выдачи, чтобы внутренний close() не откатил изменения внешнего кода
+    _sqlite_local.depth += 1
+    return conn
+
+
+def _release_sqlite_connection(conn):
+    # Соединение остается открытым для следующего вызова в этом же потоке,
+    # незафиксированные изменения отбрасываются, как при conn.close()
+    _sqlite_local.depth -= 1
+    if _sqlite_local.depth > 0:
+        return
+    try:
+        conn.rollback()
+    except Exception:
+        _sqlite_local.conn = None
+
+
 def get_db_connection():
     """
     Возвращает соединение с базой данных в зависимости от окружения.
     В Railway используется PostgreSQL, локально - SQLite.
+
+    Соединение берется из пула (PostgreSQL) или из кэша потока (SQLite);
+    conn.close() возвращает его обратно, а не разрывает.
     """
     # Проверяем наличие переменной окружения DATABASE_URL (устанавливается Railway)
     database_url = os.environ.get('DATABASE_URL')
@@ -27,29 +277,335 @@ def get_db_connection():
     if database_url:
         # Используем PostgreSQL на Railway
         try:
-            # Парсим URL базы данных
-            config = dj_database_url.parse(database_url)
-            
-            # Создаем соединение с PostgreSQL
-            conn = psycopg2.connect(
-                dbname=config['NAME'],
-                user=config['USER'],
-                password=config['PASSWORD'],
-                host=config['HOST'],
-                port=config['PORT']
-            )
-            logger.info("Connected to PostgreSQL database")
-            return conn, DB_TYPE_POSTGRES
+            pool = _get_postgres_pool(database_url)
+            conn = pool.getconn()
+            return PooledConnection(conn, pool.putconn), DB_TYPE_POSTGRES
+        except PoolTimeoutError:
+            # База доступна, но все соединения заняты: запасная SQLite здесь не поможет,
+            # запросы ушли бы не в ту базу
+            raise
         except Exception as e:
             logger.error(f"Error connecting to PostgreSQL: {e}")
             # Если не удалось подключиться к PostgreSQL, используем SQLite как запасной вариант
             logger.info("Falling back to SQLite database")
     
     # Используем SQLite локально или как запасной вариант
-    db_path = get_sqlite_path()
-    conn = sqlite3.connect(db_path)
-    logger.info(f"Connected to SQLite database at {db_path}")
-    return conn, DB_TYPE_SQLITE
+    conn = _get_sqlite_connection()
+    return PooledConnection(conn, _release_sqlite_connection), DB_TYPE_SQLITE
+
+
+@contextmanager
+def db_connection():
+    """
+    Контекстный менеджер для работы с базой данных:
+
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
+            ...
+            conn.commit()
+
+    При выходе из блока соединение возвращается в пул, незафиксированные
+    изменения откатываются.
+    """
+    conn, db_type = get_db_connection()
+    try:
+        yield conn, db_type
+    finally:
+        conn.close()
+
+
+def close_db_connections():
+    """Закрывает пул соединений PostgreSQL при завершении работы"""
+    global _postgres_pool
+    with _postgres_pool_lock:
+        pool, _postgres_pool = _postgres_pool, None
+    if pool is not None:
+        pool.closeall()
+
+def open_leader_connection(dead_peer_timeout):
+    """
+    Отдельное соединение PostgreSQL (не из пула) для advisory-блокировки ведущего
+    экземпляра или None, если DATABASE_URL не задан. Блокировка держится, пока
+    открыто соединение, поэтому оно живет весь срок работы процесса. Keepalive
+    настроен так, чтобы сервер закрыл сессию исчезнувшего процесса (и снял его
+    блокировку) примерно через dead_peer_timeout секунд.
+    """
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return None
+    probe = max(1, int(dead_peer_timeout // 4))
+    conn = _connect_postgres(
+        dj_database_url.parse(database_url),
+        keepalives=1, keepalives_idle=probe, keepalives_interval=probe, keepalives_count=3,
+        options=f'-c tcp_keepalives_idle={probe} -c tcp_keepalives_interval={probe} -c tcp_keepalives_count=3'
+    )
+    # Без открытой транзакции сессия не висит в состоянии idle in transaction
+    conn.autocommit = True
+    logger.info("Opened PostgreSQL connection for leader election")
+    return conn
+
+def try_leader_lock(conn):
+    """Пытается взять advisory-блокировку ведущего на соединении conn, не дожидаясь ее"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (LEADER_LOCK_KEY,))
+        return cursor.fetchone()[0]
+
+def check_leader_lock(conn):
+    """Проверяет, что сессия, держащая блокировку ведущего, жива (иначе psycopg2.Error)"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+
+def release_leader_lock(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (LEADER_LOCK_KEY,))
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Соединение PostgreSQL, которое помнит, какие запросы на нем уже подготовлены (PREPARE)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class Statement:
+    """
+    Именованный запрос, записанный один раз с плейсхолдерами ?.
+
+    Текст для каждой базы готовится при создании объекта: для SQLite запрос
+    используется как есть, для PostgreSQL плейсхолдеры заменяются на %s,
+    а для подготовленного запроса - на $1, $2, ...
+    Знак ? внутри строковых литералов в запросах не допускается.
+    """
+
+    def __init__(self, name, sql, postgres_sql=None):
+        self.name = name
+        self.sqlite_sql = sql
+        pg_sql = postgres_sql or sql
+        parts = pg_sql.split('?')
+        self.param_count = len(parts) - 1
+        self.postgres_sql = '%s'.join(part.replace('%', '%%') for part in parts)
+        numbered = parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+        self.prepare_sql = f"PREPARE {name} AS {numbered}"
+        self.execute_sql = f"EXECUTE {name}"
+        if self.param_count:
+            self.execute_sql += " (" + ", ".join(['%s'] * self.param_count) + ")"
+
+
+# Реестр именованных запросов: имя -> Statement
+STATEMENTS = {}
+
+
+def register_statement(name, sql, postgres_sql=None):
+    """Добавляет запрос в реестр (postgres_sql - если синтаксис PostgreSQL отличается)"""
+    if name in STATEMENTS:
+        raise ValueError(f"Запрос {name} уже зарегистрирован")
+    STATEMENTS[name] = Statement(name, sql, postgres_sql)
+    return STATEMENTS[name]
+
+
+def execute_statement(cursor, db_type, name, params=()):
+    """
+    Выполняет именованный запрос и возвращает курсор.
+
+    На соединениях из пула PostgreSQL запрос подготавливается (PREPARE) при первом
+    использовании и дальше выполняется через EXECUTE, поэтому разбирается и
+    планируется один раз на соединение, а не при каждом вызове.
+    """
+    statement = STATEMENTS[name]
+    if db_type != DB_TYPE_POSTGRES:
+        cursor.execute(statement.sqlite_sql, params)
+        return cursor
+    
+    prepared = getattr(cursor.connection, 'prepared', None)
+    if prepared is None:
+        # Соединение открыто не через пул (например, анализатором напрямую)
+        cursor.execute(statement.postgres_sql, params)
+        return cursor
+    if name not in prepared:
+        cursor.execute(statement.prepare_sql)
+        prepared.add(name)
+    cursor.execute(statement.execute_sql, params)
+    return cursor
+
+
+# Пользователи
+register_statement('principal_lookup', """
+    SELECT user_id, username, first_name, last_name, is_admin FROM users
+    WHERE user_id = ? OR username_key = ? OR phone_number = ?
+    ORDER BY CASE WHEN user_id = ? THEN 0 ELSE 1 END LIMIT 1
+""")
+register_statement('user_exists', "SELECT user_id FROM users WHERE user_id = ?")
+register_statement('user_by_username', "SELECT user_id, is_admin FROM users WHERE username_key = ?")
+register_statement('user_by_phone', "SELECT user_id FROM users WHERE phone_number = ?")
+register_statement('user_admin_flag', "SELECT user_id, username, is_admin FROM users WHERE user_id = ?")
+register_statement('user_insert', "INSERT INTO users (user_id, username, registration_date) VALUES (?, ?, ?)")
+register_statement('user_insert_phone', "INSERT INTO users (user_id, phone_number, registration_date) VALUES (?, ?, ?)")
+register_statement('user_insert_from_pending', """
+    INSERT INTO users (user_id, username, first_name, last_name, phone_number, registration_date)
+    VALUES (?, ?, ?, ?, ?, ?)
+""")
+register_statement('user_activate', "UPDATE users SET user_id = ?, first_name = ?, last_name = ? WHERE user_id = ?")
+register_statement('user_release_username', """
+    UPDATE users SET username = NULL WHERE username_key = ? AND user_id > 0 AND user_id <> ?
+""")
+# Строка с временным ID, добавленная по никнейму пользователя, у которого уже есть своя строка
+register_statement('user_inherit_temp_admin', """
+    UPDATE users SET is_admin = TRUE WHERE user_id = ?
+    AND EXISTS (SELECT 1 FROM users WHERE username_key = ? AND user_id < 0 AND is_admin = TRUE)
+""")
+register_statement('user_delete_temp_duplicate', "DELETE FROM users WHERE username_key = ? AND user_id < 0")
+register_statement('user_update_profile', "UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?")
+register_statement('user_make_admin', "UPDATE users SET is_admin = TRUE WHERE user_id = ?")
+register_statement('user_delete', "DELETE FROM users WHERE user_id = ?")
+register_statement('users_page', "SELECT user_id, username, first_name, last_name, is_admin FROM users ORDER BY username LIMIT ?")
+register_statement('admins_count', "SELECT COUNT(*) FROM users WHERE is_admin = TRUE")
+register_statement('admins_list', "SELECT username, user_id, first_name, last_name FROM users WHERE is_admin = TRUE ORDER BY username")
+register_statement('active_users_count', """
+    SELECT COUNT(*) FROM users u WHERE EXISTS (SELECT 1 FROM logs l WHERE l.user_id = u.user_id)
+""")
+register_statement('active_users_list', """
+    SELECT u.username, u.user_id, u.first_name, u.last_name FROM users u
+    WHERE EXISTS (SELECT 1 FROM logs l WHERE l.user_id = u.user_id)
+    ORDER BY u.username NULLS LAST, u.first_name NULLS LAST, u.user_id
+""")
+register_statement('whois_by_id', """
+    SELECT user_id, username, first_name, last_name, registration_date, is_admin,
+    (SELECT COUNT(*) FROM logs WHERE user_id = users.user_id) as log_count
+    FROM users WHERE user_id = ?
+""")
+register_statement('whois_by_username', """
+    SELECT user_id, username, first_name, last_name, registration_date, is_admin,
+    (SELECT COUNT(*) FROM logs WHERE user_id = users.user_id) as log_count
+    FROM users WHERE username_key = ?
+""")
+
+# Пользователи, ожидающие добавления
+register_statement('pending_exists', "SELECT user_id FROM pending_users WHERE user_id = ?")
+register_statement('pending_by_username', "SELECT user_id FROM pending_users WHERE username_key = ?")
+register_statement('pending_by_phone', "SELECT user_id FROM pending_users WHERE phone_number = ?")
+register_statement('pending_get', """
+    SELECT user_id, username, first_name, last_name, phone_number, request_date
+    FROM pending_users WHERE user_id = ?
+""")
+register_statement('pending_upsert', """
+    INSERT INTO pending_users (user_id, username, first_name, last_name, request_date)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name,
+    last_name = excluded.last_name, request_date = excluded.request_date
+""")
+register_statement('pending_delete', "DELETE FROM pending_users WHERE user_id = ?")
+
+# Логи и занятия
+register_statement('user_recent_actions', """
+    SELECT action, action_data, timestamp FROM logs
+    WHERE user_id = ? ORDER BY timestamp DESC LIMIT 5
+""")
+register_statement('user_lesson_counts', """
+    SELECT ls.title, d.count FROM lesson_downloads d
+    JOIN lessons ls ON ls.id = d.lesson_id
+    WHERE d.user_id = ? ORDER BY ls.id
+""")
+register_statement('lesson_recipients', """
+    SELECT ls.title, u.username, d.user_id, u.first_name, u.last_name
+    FROM lesson_downloads d
+    JOIN lessons ls ON ls.id = d.lesson_id
+    LEFT JOIN users u ON d.user_id = u.user_id
+    ORDER BY u.username
+""")
+register_statement('top_active_users', """
+    SELECT l.user_id, u.username, u.first_name, u.last_name, COUNT(*) as action_count
+    FROM logs l
+    LEFT JOIN users u ON l.user_id = u.user_id
+    GROUP BY l.user_id, u.username, u.first_name, u.last_name
+    ORDER BY action_count DESC
+    LIMIT ?
+""")
+register_statement('lesson_insert', "INSERT INTO lessons (title) VALUES (?) ON CONFLICT (title) DO NOTHING")
+register_statement('lesson_id_by_title', "SELECT id FROM lessons WHERE title = ?")
+
+# Каталог занятий: опубликованные занятия с датами показа и порядком на клавиатуре
+register_statement('catalog_current', """
+    SELECT id, title, message, published_at, expires_at, position
+    FROM lessons
+    WHERE published_at IS NOT NULL AND (expires_at IS NULL OR expires_at > ?)
+    ORDER BY position DESC
+""")
+register_statement('catalog_titles', """
+    SELECT title FROM lessons WHERE published_at IS NOT NULL ORDER BY position DESC
+""")
+register_statement('catalog_next_position', "SELECT COALESCE(MAX(position), 0) + 1 FROM lessons")
+# Освобождает место: занятия с позицией не ниже указанной поднимаются на одну
+register_statement('catalog_shift_up', "UPDATE lessons SET position = position + 1 WHERE position >= ? AND title <> ?")
+register_statement('lesson_set_position', "UPDATE lessons SET position = ? WHERE title = ?")
+register_statement('lesson_publish', """
+    INSERT INTO lessons (title, message, published_at, expires_at, position)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (title) DO UPDATE SET message = excluded.message, expires_at = excluded.expires_at,
+    published_at = excluded.published_at, position = COALESCE(lessons.position, excluded.position)
+""")
+register_statement('lesson_retire', """
+    UPDATE lessons SET expires_at = ?
+    WHERE title = ? AND published_at IS NOT NULL AND (expires_at IS NULL OR expires_at > ?)
+""")
+
+# Кнопки и видео
+register_statement('buttons_all', "SELECT button_key, button_text, button_url FROM buttons")
+register_statement('button_upsert', """
+    INSERT INTO buttons (button_key, button_text, button_url, last_updated)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (button_key) DO UPDATE SET button_text = excluded.button_text,
+    button_url = excluded.button_url, last_updated = excluded.last_updated
+""")
+
+# Версии наборов данных, которые процессы держат в памяти
+register_statement('data_version_init', "INSERT INTO data_versions (name, version) VALUES (?, 0) ON CONFLICT (name) DO NOTHING")
+register_statement('data_version_get', "SELECT version FROM data_versions WHERE name = ?")
+register_statement('data_version_bump', "UPDATE data_versions SET version = version + 1 WHERE name = ?")
+
+# Состояние бота между перезапусками
+register_statement('bot_state_get', "SELECT value, updated_at FROM bot_state WHERE name = ?")
+# Значение только растет; сохраненное раньше указанного момента перезаписывается в любом случае
+register_statement('bot_state_raise', """
+    INSERT INTO bot_state (name, value, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT (name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+    WHERE bot_state.value <= excluded.value OR bot_state.updated_at IS NULL OR bot_state.updated_at < ?
+""")
+
+# Аренда роли ведущего экземпляра (SQLite; в PostgreSQL - advisory-блокировка)
+register_statement('leader_lease_acquire', """
+    INSERT INTO leader_lease (name, holder, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+    WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+""")
+register_statement('leader_lease_release', "DELETE FROM leader_lease WHERE name = ? AND holder = ?")
+
+# Рассылки
+register_statement('broadcast_create', """
+    INSERT INTO broadcasts (message, created_by, created_at, status, total)
+    VALUES (?, ?, ?, ?, (SELECT COUNT(*) FROM users WHERE user_id > 0))
+    RETURNING id, total
+""")
+register_statement('broadcast_with_status', """
+    SELECT id, message, created_by, last_user_id, sent, failed
+    FROM broadcasts WHERE status = ? ORDER BY id
+""")
+register_statement('broadcast_status', "SELECT status FROM broadcasts WHERE id = ?")
+register_statement('broadcast_recipients', """
+    SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?
+""")
+register_statement('broadcast_progress', "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ? WHERE id = ?")
+register_statement('broadcast_finish', """
+    UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = ?
+""")
+register_statement('broadcast_recent', """
+    SELECT id, status, total, sent, failed, created_at, finished_at
+    FROM broadcasts ORDER BY id DESC LIMIT ?
+""")
+
+register_statement('video_insert', "INSERT INTO videos (title, url, upload_date) VALUES (?, ?, ?)")
+register_statement('video_update', "UPDATE videos SET title = ?, url = ?, upload_date = ? WHERE id = ?")
+
 
 def get_sqlite_path():
     """
@@ -88,23 +644,19 @@ def setup_database():
             username TEXT,
             first_name TEXT,
             last_name TEXT,
-            registration_date TIMESTAMP,
+            registration_date TIMESTAMPTZ,
             is_admin BOOLEAN DEFAULT FALSE
         )
         """)
         
-        # Таблица логов
+        # Таблица логов (имена пользователей берутся из users при чтении)
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS logs (
             id SERIAL PRIMARY KEY,
             user_id BIGINT,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
             action TEXT,
             action_data TEXT,
-            timestamp TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
+            timestamp TIMESTAMPTZ
         )
         """)
         
@@ -115,7 +667,7 @@ def setup_database():
             username TEXT,
             first_name TEXT,
             last_name TEXT,
-            request_date TIMESTAMP
+            request_date TIMESTAMPTZ
         )
         """)
         
@@ -129,32 +681,70 @@ def setup_database():
             last_updated TIMESTAMP
         )
         """)
+        
+        # Версии наборов данных: меняются при каждой записи, чтобы процессы
+        # могли дешево проверить, не устарела ли их копия в памяти
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name VARCHAR(255) PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        """)
+        
+        # Состояние бота, которое переживает перезапуск (например, ID последнего обновления)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            name VARCHAR(255) PRIMARY KEY,
+            value BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ
+        )
+        """)
+        
+        # Рассылки: сообщение, курсор по user_id и счетчики, чтобы продолжить после перезапуска
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            message TEXT NOT NULL,
+            created_by BIGINT,
+            created_at TIMESTAMPTZ,
+            finished_at TIMESTAMPTZ,
+            status VARCHAR(20) NOT NULL,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        
+        # Таблица занятий: на нее ссылаются события скачивания в logs.lesson_id
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lessons (
+            id SERIAL PRIMARY KEY,
+            title TEXT UNIQUE NOT NULL
+        )
+        """)
     else:
         # SQLite синтаксис
-        # Таблица пользователей
+        # Таблица пользователей (даты хранятся как Unix-время в секундах)
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             first_name TEXT,
             last_name TEXT,
-            registration_date TEXT,
+            registration_date INTEGER,
             is_admin INTEGER DEFAULT 0
         )
         """)
         
-        # Таблица логов
+        # Таблица логов (имена пользователей берутся из users при чтении)
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS logs (
             id INTEGER PRIMARY KEY,
             user_id INTEGER,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
             action TEXT,
             action_data TEXT,
-            timestamp TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
+            timestamp INTEGER
         )
         """)
         
@@ -165,7 +755,7 @@ def setup_database():
             username TEXT,
             first_name TEXT,
             last_name TEXT,
-            request_date TEXT
+            request_date INTEGER
         )
         """)
         
@@ -179,6 +769,58 @@ def setup_database():
             last_updated TEXT
         )
         """)
+        
+        # Версии наборов данных: меняются при каждой записи, чтобы процессы
+        # могли дешево проверить, не устарела ли их копия в памяти
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        
+        # Состояние бота, которое переживает перезапуск (например, ID последнего обновления)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL,
+            updated_at INTEGER
+        )
+        """)
+        
+        # Аренда роли ведущего экземпляра: держатель продлевает ее, пока работает
+        # (в PostgreSQL вместо нее используется advisory-блокировка)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS leader_lease (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """)
+        
+        # Рассылки: сообщение, курсор по user_id и счетчики, чтобы продолжить после перезапуска
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message TEXT NOT NULL,
+            created_by BIGINT,
+            created_at INTEGER,
+            finished_at INTEGER,
+            status TEXT NOT NULL,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        
+        # Таблица занятий: на нее ссылаются события скачивания в logs.lesson_id
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lessons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT UNIQUE NOT NULL
+        )
+        """)
     
     # Вставляем администратора по умолчанию, если он не существует
     admin_id = os.environ.get('ADMIN_ID', None)
@@ -194,88 +836,700 @@ def setup_database():
                 (int(admin_id), 1)
             )
     
+    for name in DATA_VERSIONS:
+        execute_statement(cursor, db_type, 'data_version_init', (name,))
+    
     conn.commit()
+    
+    # Переводим старую таблицу логов на компактный формат
+    migrate_logs_to_slim(conn, db_type)
+    
+    # Переводим текстовые даты на собственный тип базы данных
+    migrate_timestamps(conn, db_type)
+    
+    # Проставляем занятие в старых записях о скачиваниях
+    migrate_log_lessons(conn, db_type)
+    
+    # Добавляем в таблицу занятий колонки каталога
+    migrate_lesson_catalog(conn, db_type)
+    
+    # Строим сводку скачиваний по занятиям, если ее еще нет
+    build_lesson_downloads(conn, db_type)
+    
+    # Создаем нормализованные колонки и индексы для частых запросов
+    ensure_indexes(conn, db_type)
+    
     conn.close()
 
-def load_buttons():
+def get_table_columns(cursor, db_type, table):
+    """Возвращает список колонок таблицы"""
+    if db_type == DB_TYPE_POSTGRES:
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position",
+            (table,)
+        )
+        return [row[0] for row in cursor.fetchall()]
+    # table_xinfo, в отличие от table_info, показывает и генерируемые колонки
+    cursor.execute(f"PRAGMA table_xinfo({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+# Размер порции при переносе строк логов
+LOGS_MIGRATION_CHUNK = int(os.environ.get('LOGS_MIGRATION_CHUNK', '5000'))
+
+def migrate_logs_to_slim(conn, db_type, chunk_size=LOGS_MIGRATION_CHUNK):
     """
-    Загружает настройки кнопок из базы данных.
-    Возвращает словарь с настройками кнопок.
+    Убирает из logs копии имен пользователей (username, first_name, last_name).
+
+    Строки переносятся в новую таблицу порциями по chunk_size с коммитом после
+    каждой порции, поэтому миграция не держит длинную блокировку на большой таблице.
+    В конце остаток дописывается и таблицы меняются местами в одной транзакции.
     """
-    conn, db_type = get_db_connection()
     cursor = conn.cursor()
+    columns = get_table_columns(cursor, db_type, 'logs')
+    if not {'username', 'first_name', 'last_name'} & set(columns):
+        return
     
-    buttons = {}
+    logger.info("Migrating logs table to the slim format")
+    p = '%s' if db_type == DB_TYPE_POSTGRES else '?'
     
-    # Проверяем, есть ли кнопки в базе данных
-    try:
-        if db_type == DB_TYPE_POSTGRES:
-            cursor.execute("SELECT button_key, button_text, button_url FROM buttons")
+    cursor.execute("DROP TABLE IF EXISTS logs_slim")
+    if db_type == DB_TYPE_POSTGRES:
+        cursor.execute("""
+        CREATE TABLE logs_slim (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            action TEXT,
+            action_data TEXT,
+            timestamp TIMESTAMP
+        )
+        """)
+    else:
+        cursor.execute("""
+        CREATE TABLE logs_slim (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            action TEXT,
+            action_data TEXT,
+            timestamp TEXT
+        )
+        """)
+    conn.commit()
+    
+    copy_sql = (
+        "INSERT INTO logs_slim (id, user_id, action, action_data, timestamp) "
+        f"SELECT id, user_id, action, action_data, timestamp FROM logs WHERE id > {p} AND id <= {p}"
+    )
+    
+    last_id = 0
+    copied = 0
+    while True:
+        # Определяем верхнюю границу очередной порции
+        cursor.execute(f"SELECT MAX(id) FROM (SELECT id FROM logs WHERE id > {p} ORDER BY id LIMIT {p}) chunk",
+                       (last_id, chunk_size))
+        upper_id = cursor.fetchone()[0]
+        if upper_id is None:
+            break
+        cursor.execute(copy_sql, (last_id, upper_id))
+        copied += cursor.rowcount
+        conn.commit()
+        last_id = upper_id
+    
+    # Дописываем строки, появившиеся во время переноса, и подменяем таблицу
+    cursor.execute(copy_sql.replace(f" AND id <= {p}", ""), (last_id,))
+    cursor.execute("DROP TABLE logs")
+    cursor.execute("ALTER TABLE logs_slim RENAME TO logs")
+    if db_type == DB_TYPE_POSTGRES:
+        # Последовательность новой таблицы должна продолжать старые ID
+        cursor.execute("SELECT setval(pg_get_serial_sequence('logs', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM logs")
+    conn.commit()
+    logger.info(f"Logs table migrated, {copied} rows copied")
+
+# Часовой пояс, в котором даты показываются пользователям
+DISPLAY_TIMEZONE = pytz.timezone(os.environ.get('DISPLAY_TIMEZONE', 'Europe/Moscow'))
+# Размер порции при переводе дат на собственный тип базы данных
+TIMESTAMPS_MIGRATION_CHUNK = int(os.environ.get('TIMESTAMPS_MIGRATION_CHUNK', '5000'))
+
+# Колонки с датами: (таблица, ключ для порционного обхода, колонка)
+TIMESTAMP_COLUMNS = [
+    ('logs', 'id', 'timestamp'),
+    ('users', 'user_id', 'registration_date'),
+    ('pending_users', 'user_id', 'request_date'),
+]
+
+def db_timestamp(db_type, ts=None):
+    """
+    Значение даты для записи в базу: datetime в UTC для PostgreSQL (TIMESTAMPTZ)
+    и целое Unix-время для SQLite. По умолчанию - текущий момент.
+    """
+    if ts is None:
+        ts = time.time()
+    if db_type == DB_TYPE_POSTGRES:
+        return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+    return int(ts)
+
+def format_timestamp(value, fmt='%Y-%m-%d %H:%M:%S'):
+    """Форматирует дату из базы для показа пользователю в DISPLAY_TIMEZONE"""
+    if value is None or value == '':
+        return ''
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+    elif isinstance(value, (int, float)):
+        value = datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    else:
+        # Строка старого формата выводится как есть
+        return str(value)
+    return value.astimezone(DISPLAY_TIMEZONE).strftime(fmt)
+
+def parse_display_time(text):
+    """
+    Unix-время для даты, введенной в DISPLAY_TIMEZONE: "ДД.ММ.ГГГГ ЧЧ:ММ" или "ДД.ММ ЧЧ:ММ"
+    (текущий год). Для неверного формата вызывает ValueError.
+    """
+    for fmt in ('%d.%m.%Y %H:%M', '%d.%m %H:%M'):
+        try:
+            value = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == '%d.%m %H:%M':
+            value = value.replace(year=datetime.datetime.now(DISPLAY_TIMEZONE).year)
+        return DISPLAY_TIMEZONE.localize(value).timestamp()
+    raise ValueError(f"Неверный формат даты: {text}")
+
+def timestamp_to_epoch(value):
+    """Unix-время (float) для даты из базы: datetime из PostgreSQL или число из SQLite"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+def parse_legacy_timestamp(value):
+    """
+    Разбирает дату старого формата: московское время текстом 'YYYY-MM-DD HH:MM:SS'
+    (или TIMESTAMP без часового пояса). Возвращает datetime в UTC или None.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        local = value
+    elif isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    else:
+        text = str(value).strip()
+        if text.isdigit():
+            return datetime.datetime.fromtimestamp(int(text), datetime.timezone.utc)
+        try:
+            local = datetime.datetime.fromisoformat(text)
+        except ValueError:
+            logger.warning(f"Cannot parse timestamp {text!r}, leaving it empty")
+            return None
+    if local.tzinfo is None:
+        local = pytz.timezone('Europe/Moscow').localize(local)
+    return local.astimezone(datetime.timezone.utc)
+
+def get_column_type(cursor, db_type, table, column):
+    """Возвращает тип колонки в нижнем регистре или None, если колонки нет"""
+    if db_type == DB_TYPE_POSTGRES:
+        cursor.execute(
+            "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+            (table, column)
+        )
+        row = cursor.fetchone()
+        return row[0].lower() if row else None
+    cursor.execute(f"PRAGMA table_xinfo({table})")
+    for row in cursor.fetchall():
+        if row[1] == column:
+            return (row[2] or '').lower()
+    return None
+
+def migrate_timestamps(conn, db_type, chunk_size=TIMESTAMPS_MIGRATION_CHUNK):
+    """Переводит все колонки из TIMESTAMP_COLUMNS на TIMESTAMPTZ / Unix-время"""
+    for table, key, column in TIMESTAMP_COLUMNS:
+        migrate_timestamp_column(conn, db_type, table, key, column, chunk_size)
+
+def migrate_timestamp_column(conn, db_type, table, key, column, chunk_size=TIMESTAMPS_MIGRATION_CHUNK):
+    """
+    Переводит колонку с датой на собственный тип базы данных.
+
+    Рядом создается новая колонка, которая заполняется порциями по chunk_size
+    с коммитом после каждой порции; затем старая колонка удаляется, а новая
+    получает ее имя. Прерванная миграция продолжится при следующем запуске.
+    """
+    target_type = 'timestamp with time zone' if db_type == DB_TYPE_POSTGRES else 'integer'
+    cursor = conn.cursor()
+    current_type = get_column_type(cursor, db_type, table, column)
+    if current_type is None or current_type == target_type:
+        return
+    
+    logger.info(f"Migrating {table}.{column} to {target_type}")
+    p = '%s' if db_type == DB_TYPE_POSTGRES else '?'
+    new_column = f"{column}_native"
+    
+    if get_column_type(cursor, db_type, table, new_column) is None:
+        column_type = 'TIMESTAMPTZ' if db_type == DB_TYPE_POSTGRES else 'INTEGER'
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {new_column} {column_type}")
+        conn.commit()
+    
+    update_sql = f"UPDATE {table} SET {new_column} = {p} WHERE {key} = {p}"
+    
+    def convert(rows):
+        values = []
+        for row_key, value in rows:
+            parsed = parse_legacy_timestamp(value)
+            if parsed is not None and db_type != DB_TYPE_POSTGRES:
+                parsed = int(parsed.timestamp())
+            values.append((parsed, row_key))
+        cursor.executemany(update_sql, values)
+    
+    last_key = None
+    converted = 0
+    while True:
+        if last_key is None:
+            cursor.execute(f"SELECT {key}, {column} FROM {table} ORDER BY {key} LIMIT {p}", (chunk_size,))
         else:
-            cursor.execute("SELECT button_key, button_text, button_url FROM buttons")
-        
-        for row in cursor.fetchall():
-            button_key, button_text, button_url = row
-            # Преобразуем button_key в номер кнопки (например, 'button1' -> 1)
-            if button_key.startswith('button') and button_key[6:].isdigit():
-                button_number = int(button_key[6:])
-                buttons[button_number] = {'text': button_text, 'message': button_url}
-    except Exception as e:
-        print(f"Error loading buttons: {e}")
+            cursor.execute(f"SELECT {key}, {column} FROM {table} WHERE {key} > {p} ORDER BY {key} LIMIT {p}",
+                           (last_key, chunk_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        convert(rows)
+        conn.commit()
+        converted += len(rows)
+        last_key = rows[-1][0]
     
-    conn.close()
-    return buttons
+    # Индексы по старой колонке мешают ее удалению в SQLite; ensure_indexes создаст их заново
+    for name, index_table, columns, _, _ in INDEXES:
+        if index_table == table and column in [c.strip() for c in columns.split(',')]:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+            cursor.execute(f"DROP INDEX IF EXISTS {name.replace('ux_', 'ix_', 1)}")
+    
+    # Дописываем строки, появившиеся во время переноса, и меняем колонки в одной транзакции
+    cursor.execute(f"SELECT {key}, {column} FROM {table} WHERE {new_column} IS NULL AND {column} IS NOT NULL")
+    convert(cursor.fetchall())
+    cursor.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+    cursor.execute(f"ALTER TABLE {table} RENAME COLUMN {new_column} TO {column}")
+    conn.commit()
+    logger.info(f"{table}.{column} migrated, {converted} rows converted")
 
-def save_button(button_number, button_text, button_url):
+# Действия старого формата и даты занятий, к которым они относятся
+LEGACY_LESSON_ACTIONS = {
+    'get_video_18 мая': '18 мая',
+    'get_latest_video': '18 мая',  # Последнее видео - это 18 мая
+    'get_video_22 мая': '22 мая',
+    'get_previous_video': '22 мая',  # Предыдущее видео - это 22 мая
+    'get_video_25 мая': '25 мая'
+}
+# Префикс действия с датой занятия: get_video_<дата>
+LESSON_ACTION_PREFIX = 'get_video_'
+
+def lesson_title_for_action(action):
+    """Название (дата) занятия по действию из logs или None, если это не скачивание"""
+    if action in LEGACY_LESSON_ACTIONS:
+        return LEGACY_LESSON_ACTIONS[action]
+    if action and action.startswith(LESSON_ACTION_PREFIX):
+        return action[len(LESSON_ACTION_PREFIX):] or None
+    return None
+
+def get_or_create_lesson(conn, db_type, title):
+    """Возвращает ID занятия, создавая его при необходимости (коммит - за вызывающим)"""
+    cursor = conn.cursor()
+    execute_statement(cursor, db_type, 'lesson_insert', (title,))
+    return execute_statement(cursor, db_type, 'lesson_id_by_title', (title,)).fetchone()[0]
+
+def migrate_log_lessons(conn, db_type, chunk_size=LOGS_MIGRATION_CHUNK):
     """
-    Сохраняет настройки кнопки в базу данных.
+    Добавляет в logs колонку lesson_id и заполняет ее для старых записей
+    о скачиваниях, определяя занятие по названию действия.
+
+    Записи обновляются порциями по chunk_size с коммитом после каждой порции.
+    Повторный запуск проверяет только действия-скачивания и ничего не меняет,
+    если все они уже размечены.
     """
-    conn, db_type = get_db_connection()
     cursor = conn.cursor()
+    if 'lesson_id' not in get_table_columns(cursor, db_type, 'logs'):
+        cursor.execute("ALTER TABLE logs ADD COLUMN lesson_id INTEGER")
+        conn.commit()
     
-    # Текущая дата и время
-    if db_type == DB_TYPE_POSTGRES:
-        # PostgreSQL использует NOW() для текущей даты и времени
-        now = "NOW()"
+    p = '%s' if db_type == DB_TYPE_POSTGRES else '?'
+    update_sql = (
+        f"UPDATE logs SET lesson_id = {p} WHERE id IN "
+        f"(SELECT id FROM logs WHERE action = {p} AND lesson_id IS NULL LIMIT {p})"
+    )
+    
+    cursor.execute("SELECT DISTINCT action FROM logs")
+    actions = [row[0] for row in cursor.fetchall()]
+    for action in actions:
+        title = lesson_title_for_action(action)
+        if title is None:
+            continue
         
-        # Проверяем, существует ли кнопка
-        cursor.execute("SELECT id FROM buttons WHERE button_key = %s", (f'button{button_number}',))
-        button_id = cursor.fetchone()
+        lesson_id = get_or_create_lesson(conn, db_type, title)
+        conn.commit()
         
-        if button_id:
-            # Обновляем существующую кнопку
-            cursor.execute(
-                "UPDATE buttons SET button_text = %s, button_url = %s, last_updated = " + now + " WHERE button_key = %s",
-                (button_text, button_url, f'button{button_number}')
-            )
-        else:
-            # Вставляем новую кнопку
-            cursor.execute(
-                "INSERT INTO buttons (button_key, button_text, button_url, last_updated) VALUES (%s, %s, %s, " + now + ")",
-                (f'button{button_number}', button_text, button_url)
-            )
+        updated = 0
+        while True:
+            cursor.execute(update_sql, (lesson_id, action, chunk_size))
+            conn.commit()
+            if cursor.rowcount <= 0:
+                break
+            updated += cursor.rowcount
+        if updated:
+            logger.info(f"Linked {updated} '{action}' log rows to lesson '{title}'")
+
+def migrate_lesson_catalog(conn, db_type):
+    """
+    Добавляет в lessons колонки каталога: текст ответа, даты публикации и снятия
+    и позицию на клавиатуре. Занятия без даты публикации (например, известные
+    только по старым логам) в каталог не входят.
+    """
+    cursor = conn.cursor()
+    columns = get_table_columns(cursor, db_type, 'lessons')
+    date_type = 'TIMESTAMPTZ' if db_type == DB_TYPE_POSTGRES else 'INTEGER'
+    for column, column_type in (('message', 'TEXT'), ('published_at', date_type),
+                                ('expires_at', date_type), ('position', 'INTEGER')):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE lessons ADD COLUMN {column} {column_type}")
+    conn.commit()
+
+def build_lesson_downloads(conn, db_type):
+    """
+    Создает сводную таблицу lesson_downloads (занятие, студент, первое
+    скачивание, число скачиваний) и заполняет ее по logs.
+
+    Дальше таблица поддерживается при каждой записи логов (см. write_log_batch
+    в bot.py). Сводка собирается во временной таблице по одному занятию
+    за коммит и переименовывается в конце, поэтому прерванная сборка
+    просто начнется заново при следующем запуске.
+    """
+    cursor = conn.cursor()
+    if get_table_columns(cursor, db_type, 'lesson_downloads'):
+        return
+    
+    logger.info("Building lesson_downloads from logs")
+    p = '%s' if db_type == DB_TYPE_POSTGRES else '?'
+    
+    cursor.execute("DROP TABLE IF EXISTS lesson_downloads_build")
+    if db_type == DB_TYPE_POSTGRES:
+        cursor.execute("""
+        CREATE TABLE lesson_downloads_build (
+            lesson_id INTEGER NOT NULL,
+            user_id BIGINT NOT NULL,
+            first_seen TIMESTAMPTZ,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (lesson_id, user_id)
+        )
+        """)
     else:
-        # SQLite использует datetime('now') для текущей даты и времени
-        import datetime
-        import pytz
-        now = datetime.datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
+        cursor.execute("""
+        CREATE TABLE lesson_downloads_build (
+            lesson_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            first_seen INTEGER,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (lesson_id, user_id)
+        )
+        """)
+    conn.commit()
+    
+    cursor.execute("SELECT id FROM lessons ORDER BY id")
+    lesson_ids = [row[0] for row in cursor.fetchall()]
+    for lesson_id in lesson_ids:
+        cursor.execute(
+            "INSERT INTO lesson_downloads_build (lesson_id, user_id, first_seen, count) "
+            f"SELECT lesson_id, user_id, MIN(timestamp), COUNT(*) FROM logs WHERE lesson_id = {p} "
+            "GROUP BY lesson_id, user_id",
+            (lesson_id,)
+        )
+        conn.commit()
+    
+    cursor.execute("ALTER TABLE lesson_downloads_build RENAME TO lesson_downloads")
+    conn.commit()
+    logger.info(f"lesson_downloads built for {len(lesson_ids)} lessons")
+
+def normalize_username(username):
+    """Приводит никнейм к виду, хранящемуся в username_key: без @ и в нижнем регистре"""
+    if not username:
+        return None
+    return username.strip().lstrip('@').lower() or None
+
+# Выражение для генерируемой колонки username_key (совпадает с normalize_username)
+USERNAME_KEY_EXPR = "nullif(lower(ltrim(trim(username), '@')), '')"
+
+# Индексы для частых запросов: (имя, таблица, колонки, уникальный, условие)
+INDEXES = [
+    ('ux_users_username_key', 'users', 'username_key', True, 'username_key IS NOT NULL'),
+    ('ix_users_phone_number', 'users', 'phone_number', False, None),
+    ('ix_pending_users_username_key', 'pending_users', 'username_key', False, None),
+    ('ix_pending_users_phone_number', 'pending_users', 'phone_number', False, None),
+    ('ix_logs_user_id_timestamp', 'logs', 'user_id, timestamp', False, None),
+    ('ix_logs_action', 'logs', 'action', False, None),
+    ('ix_logs_lesson_id_user_id', 'logs', 'lesson_id, user_id', False, None),
+    ('ix_lesson_downloads_user_id', 'lesson_downloads', 'user_id', False, None),
+    ('ix_logs_timestamp', 'logs', 'timestamp', False, None),
+    ('ix_lessons_expires_at', 'lessons', 'expires_at', False, 'published_at IS NOT NULL'),
+]
+
+def ensure_indexes(conn, db_type):
+    """
+    Создает (если их еще нет) колонку username_key в users и pending_users
+    и набор индексов для поиска по никнейму, телефону и для выборок из logs.
+
+    username_key - генерируемая колонка, ее значение поддерживает сама база,
+    поэтому код, записывающий username, менять не нужно.
+    """
+    cursor = conn.cursor()
+    
+    for table in ('users', 'pending_users'):
+        columns = get_table_columns(cursor, db_type, table)
         
-        # Проверяем, существует ли кнопка
-        cursor.execute("SELECT id FROM buttons WHERE button_key = ?", (f'button{button_number}',))
-        button_id = cursor.fetchone()
+        # В старых базах колонки phone_number может не быть
+        if 'phone_number' not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN phone_number TEXT")
         
-        if button_id:
-            # Обновляем существующую кнопку
-            cursor.execute(
-                "UPDATE buttons SET button_text = ?, button_url = ?, last_updated = ? WHERE button_key = ?",
-                (button_text, button_url, now, f'button{button_number}')
-            )
-        else:
-            # Вставляем новую кнопку
-            cursor.execute(
-                "INSERT INTO buttons (button_key, button_text, button_url, last_updated) VALUES (?, ?, ?, ?)",
-                (f'button{button_number}', button_text, button_url, now)
-            )
+        if 'username_key' not in columns:
+            if db_type == DB_TYPE_POSTGRES:
+                cursor.execute(
+                    f"ALTER TABLE {table} ADD COLUMN username_key TEXT GENERATED ALWAYS AS ({USERNAME_KEY_EXPR}) STORED"
+                )
+            else:
+                cursor.execute(
+                    f"ALTER TABLE {table} ADD COLUMN username_key TEXT GENERATED ALWAYS AS ({USERNAME_KEY_EXPR}) VIRTUAL"
+                )
+        conn.commit()
     
-    conn.commit()
-    conn.close()
+    for name, table, columns, unique, where in INDEXES:
+        sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+        if where:
+            sql += f" WHERE {where}"
+        try:
+            cursor.execute(sql)
+            conn.commit()
+        except (sqlite3.IntegrityError, psycopg2.IntegrityError) as e:
+            # В базе уже есть дубликаты: создаем обычный индекс, чтобы поиск все равно был быстрым
+            conn.rollback()
+            logger.warning(f"Cannot create unique index {name}, duplicates found: {e}")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name.replace('ux_', 'ix_', 1)} ON {table} ({columns})")
+            conn.commit()
+
+def read_buttons(cursor, db_type):
+    """
+    Читает настройки кнопок через переданный курсор.
+    Возвращает словарь {номер кнопки: {'text': ..., 'message': ...}}.
+    """
+    buttons = {}
+    execute_statement(cursor, db_type, 'buttons_all')
+    for row in cursor.fetchall():
+        button_key, button_text, button_url = row
+        # Преобразуем button_key в номер кнопки (например, 'button1' -> 1)
+        if button_key.startswith('button') and button_key[6:].isdigit():
+            button_number = int(button_key[6:])
+            buttons[button_number] = {'text': button_text, 'message': button_url}
+    return buttons
+
+def read_data_version(cursor, db_type, name):
+    """Возвращает текущую версию набора данных (0, если записи еще нет)"""
+    row = execute_statement(cursor, db_type, 'data_version_get', (name,)).fetchone()
+    return row[0] if row else 0
+
+def get_data_version(name):
+    """Дешевая проверка версии набора данных: один запрос по первичному ключу"""
+    with db_connection() as (conn, db_type):
+        return read_data_version(conn.cursor(), db_type, name)
+
+def load_buttons():
+    """
+    Загружает настройки кнопок из базы данных.
+    Возвращает словарь с настройками кнопок.
+    """
+    return load_buttons_versioned()[1]
+
+def load_buttons_versioned():
+    """
+    Загружает настройки кнопок вместе с их версией.
+    Возвращает пару (версия, словарь с настройками кнопок).
+    """
+    version, buttons = None, {}
+    try:
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
+            # Версию читаем первой: если кнопки изменятся между запросами,
+            # следующая проверка увидит новую версию и перечитает их еще раз
+            version = read_data_version(cursor, db_type, DATA_VERSION_BUTTONS)
+            buttons = read_buttons(cursor, db_type)
+    except Exception as e:
+        logger.error(f"Error loading buttons: {e}")
+    return version, buttons
+
+def save_button(button_number, button_text, button_url):
+    """
+    Сохраняет настройки кнопки в базу данных и увеличивает версию кнопок.
+    """
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        # Создаем кнопку или обновляем существующую (дата изменения ставится самой базой)
+        execute_statement(cursor, db_type, 'button_upsert', (f'button{button_number}', button_text, button_url))
+        # Версия меняется в той же транзакции, что и сама кнопка
+        execute_statement(cursor, db_type, 'data_version_bump', (DATA_VERSION_BUTTONS,))
+        conn.commit()
+
+# Занятие из каталога; даты - Unix-время (None - без ограничения)
+Lesson = namedtuple('Lesson', ['id', 'title', 'message', 'published_at', 'expires_at', 'position'])
+
+def load_lesson_catalog_versioned(at=None):
+    """
+    Загружает занятия каталога, не снятые к моменту at (по умолчанию - сейчас),
+    новые первыми, вместе с версией каталога. Возвращает пару (версия, список Lesson).
+    """
+    version, lessons = None, []
+    try:
+        with db_connection() as (conn, db_type):
+            cursor = conn.cursor()
+            version = read_data_version(cursor, db_type, DATA_VERSION_LESSONS)
+            execute_statement(cursor, db_type, 'catalog_current', (db_timestamp(db_type, at),))
+            for lesson_id, title, message, published_at, expires_at, position in cursor.fetchall():
+                lessons.append(Lesson(lesson_id, title, message, timestamp_to_epoch(published_at),
+                                      timestamp_to_epoch(expires_at), position))
+    except Exception as e:
+        logger.error(f"Error loading lesson catalog: {e}")
+    return version, lessons
+
+def publish_lesson(title, message, expires_at=None, published_at=None, slot=None):
+    """
+    Публикует занятие (или обновляет уже опубликованное) и увеличивает версию каталога.
+    Показ начинается в момент published_at (по умолчанию - сразу). Новое занятие
+    встает на клавиатуре первым, уже опубликованное остается на своем месте; slot
+    (1 - первое место) ставит занятие на указанное место среди показываемых сейчас.
+    Возвращает ID занятия.
+    """
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        position = execute_statement(cursor, db_type, 'catalog_next_position').fetchone()[0]
+        execute_statement(cursor, db_type, 'lesson_publish', (
+            title, message, db_timestamp(db_type, published_at),
+            db_timestamp(db_type, expires_at) if expires_at is not None else None, position
+        ))
+        if slot is not None:
+            place_lesson(cursor, db_type, title, slot, position)
+        lesson_id = execute_statement(cursor, db_type, 'lesson_id_by_title', (title,)).fetchone()[0]
+        execute_statement(cursor, db_type, 'data_version_bump', (DATA_VERSION_LESSONS,))
+        conn.commit()
+    return lesson_id
+
+def place_lesson(cursor, db_type, title, slot, next_position):
+    """
+    Ставит занятие title на место slot среди показываемых сейчас занятий: сразу
+    под занятием, которое стоит на месте slot - 1, или последним, если выше него
+    меньше занятий
+    """
+    execute_statement(cursor, db_type, 'catalog_current', (db_timestamp(db_type),))
+    shown = [row[5] for row in cursor.fetchall() if row[1] != title and row[5] is not None]
+    if slot <= 1 or not shown:
+        position = next_position
+    elif len(shown) >= slot - 1:
+        # Занятие на месте slot - 1 и все выше него поднимаются, освобождая его позицию
+        position = shown[slot - 2]
+        execute_statement(cursor, db_type, 'catalog_shift_up', (position, title))
+    else:
+        position = shown[-1] - 1
+    execute_statement(cursor, db_type, 'lesson_set_position', (position, title))
+
+def retire_lesson(title):
+    """Снимает занятие с показа; возвращает False, если такого показываемого занятия нет"""
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        now = db_timestamp(db_type)
+        retired = execute_statement(cursor, db_type, 'lesson_retire', (now, title, now)).rowcount > 0
+        if retired:
+            execute_statement(cursor, db_type, 'data_version_bump', (DATA_VERSION_LESSONS,))
+        conn.commit()
+    return retired
+
+# Рассылка, которую нужно продолжить: курсор last_user_id и уже набранные счетчики
+Broadcast = namedtuple('Broadcast', ['id', 'message', 'created_by', 'last_user_id', 'sent', 'failed'])
+
+def create_broadcast(message, created_by, status):
+    """Создает рассылку со статусом status всем пользователям с настоящим ID; возвращает (ID, число получателей)"""
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        broadcast_id, total = execute_statement(cursor, db_type, 'broadcast_create',
+                                                (message, created_by, db_timestamp(db_type), status)).fetchone()
+        conn.commit()
+    return broadcast_id, total
+
+def get_broadcasts_with_status(status):
+    """Рассылки со статусом status (для выполняемых - в том числе прерванные перезапуском)"""
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        rows = execute_statement(cursor, db_type, 'broadcast_with_status', (status,)).fetchall()
+    return [Broadcast(*row) for row in rows]
+
+def get_broadcast_status(broadcast_id):
+    with db_connection() as (conn, db_type):
+        row = execute_statement(conn.cursor(), db_type, 'broadcast_status', (broadcast_id,)).fetchone()
+    return row[0] if row else None
+
+def get_broadcast_recipients(after_user_id, limit):
+    """Следующая порция получателей по возрастанию user_id (курсор по первичному ключу)"""
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        rows = execute_statement(cursor, db_type, 'broadcast_recipients', (after_user_id, limit)).fetchall()
+    return [row[0] for row in rows]
+
+def save_broadcast_progress(broadcast_id, last_user_id, sent, failed):
+    with db_connection() as (conn, db_type):
+        execute_statement(conn.cursor(), db_type, 'broadcast_progress', (last_user_id, sent, failed, broadcast_id))
+        conn.commit()
+
+def finish_broadcast(broadcast_id, status, running_status):
+    """Переводит рассылку из running_status в status; возвращает False, если она уже не выполнялась"""
+    with db_connection() as (conn, db_type):
+        cursor = conn.cursor()
+        finished = execute_statement(cursor, db_type, 'broadcast_finish',
+                                     (status, db_timestamp(db_type), broadcast_id, running_status)).rowcount > 0
+        conn.commit()
+    return finished
+
+def get_recent_broadcasts(limit=5):
+    with db_connection() as (conn, db_type):
+        return execute_statement(conn.cursor(), db_type, 'broadcast_recent', (limit,)).fetchall()
+
+def get_last_update_id():
+    """ID последнего обработанного обновления и момент его сохранения (Unix-время) или None"""
+    with db_connection() as (conn, db_type):
+        row = execute_statement(conn.cursor(), db_type, 'bot_state_get', (STATE_LAST_UPDATE_ID,)).fetchone()
+    if row is None:
+        return None
+    return row[0], timestamp_to_epoch(row[1])
+
+def save_last_update_id(update_id, replace_after=86400):
+    """
+    Сохраняет ID последнего обработанного обновления, если он не меньше сохраненного.
+    ID, сохраненный больше replace_after секунд назад, заменяется любым: после долгого
+    перерыва Telegram может начать нумерацию обновлений заново
+    """
+    now = time.time()
+    with db_connection() as (conn, db_type):
+        execute_statement(conn.cursor(), db_type, 'bot_state_raise',
+                          (STATE_LAST_UPDATE_ID, update_id, db_timestamp(db_type, now),
+                           db_timestamp(db_type, now - replace_after)))
+        conn.commit()
+
+def acquire_leader_lease(holder, lease_seconds):
+    """
+    Берет или продлевает аренду роли ведущего на lease_seconds секунд. Возвращает
+    False, если ее держит другой экземпляр и срок аренды еще не истек.
+    """
+    now = time.time()
+    with db_connection() as (conn, db_type):
+        acquired = execute_statement(conn.cursor(), db_type, 'leader_lease_acquire',
+                                     (LEADER_LOCK_NAME, holder, now + lease_seconds, now)).rowcount > 0
+        conn.commit()
+    return acquired
+
+def release_leader_lease(holder):
+    with db_connection() as (conn, db_type):
+        execute_statement(conn.cursor(), db_type, 'leader_lease_release', (LEADER_LOCK_NAME, holder))
+        conn.commit()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Локальная замена Telegram Bot API для проверки бота.
+
+Сервер отвечает на вызовы Bot API (getMe, setWebhook, getUpdates, sendMessage и др.),
+а строки, введенные в консоли, передает боту как сообщения пользователя: на адрес
+вебхука (с секретом из setWebhook), если он установлен, иначе - в ответ на getUpdates.
+Для каждого ответа бота печатается время от доставки обновления до отправки ответа.
+
+Запуск:
+    python fake_telegram.py --port 8081
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot TELEGRAM_TOKEN=123:test python bot.py
+
+Для режима вебхука боту дополнительно задаются UPDATE_MODE=webhook,
+WEBHOOK_URL=http://127.0.0.1:8443 и WEBHOOK_SECRET_TOKEN.
+
+Строка консоли: "<текст>" от пользователя --user или "@<user_id> <текст>".
+"""
+
+import argparse
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {'id': 1000000, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+state = {'webhook_url': None, 'secret_token': None, 'allowed_updates': None}
+# Обновления, ожидающие getUpdates
+pending_updates = []
+pending_cond = threading.Condition()
+# chat_id -> момент доставки последнего обновления
+delivered_at = {}
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def make_message(chat_id, text):
+    return {'message_id': next(message_ids), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'setWebhook':
+            state['webhook_url'] = data.get('url')
+            state['secret_token'] = data.get('secret_token')
+            print(f"[api] setWebhook {data.get('url')} max_connections={data.get('max_connections')} "
+                  f"allowed_updates={data.get('allowed_updates')}")
+            result = True
+        elif method == 'deleteWebhook':
+            state['webhook_url'] = None
+            result = True
+        elif method == 'getUpdates':
+            result = get_updates(data)
+        elif method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            chat_id = int(data.get('chat_id') or 0)
+            text = data.get('text', '')
+            started = delivered_at.pop(chat_id, None)
+            latency = f' ({(time.monotonic() - started) * 1000:.0f} мс)' if started is not None else ''
+            print(f"[bot -> {chat_id}]{latency} {text}")
+            result = make_message(chat_id, text)
+        else:
+            result = True
+
+        response = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_updates(data):
+    """Ответ на getUpdates: ожидающие обновления начиная с offset, не больше limit"""
+    if data.get('allowed_updates') != state['allowed_updates']:
+        state['allowed_updates'] = data.get('allowed_updates')
+        print(f"[api] getUpdates limit={data.get('limit')} timeout={data.get('timeout')} "
+              f"allowed_updates={data.get('allowed_updates')}")
+    offset = int(data.get('offset') or 0)
+    limit = int(data.get('limit') or 100)
+    deadline = time.monotonic() + float(data.get('timeout') or 0)
+    with pending_cond:
+        # Обновления до offset подтверждены ботом
+        pending_updates[:] = [update for update in pending_updates if update['update_id'] >= offset]
+        while not pending_updates and time.monotonic() < deadline:
+            pending_cond.wait(deadline - time.monotonic())
+        return pending_updates[:limit]
+
+
+def deliver(user_id, text):
+    """Передает боту сообщение пользователя: на адрес вебхука или в очередь getUpdates"""
+    message = make_message(user_id, text)
+    message['from'] = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    update = {'update_id': next(update_ids), 'message': message}
+
+    url = state['webhook_url']
+    if not url:
+        with pending_cond:
+            pending_updates.append(update)
+            delivered_at[user_id] = time.monotonic()
+            pending_cond.notify_all()
+        return
+
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    if state['secret_token']:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', state['secret_token'])
+    delivered_at[user_id] = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError as e:
+        print(f"Вебхук недоступен: {e.reason}")
+        return
+    if status != 200:
+        print(f"Вебхук ответил {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальная замена Telegram Bot API')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--user', type=int, default=1, help='ID пользователя для строк без @<user_id>')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), FakeBotApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Bot API: http://127.0.0.1:{args.port}/bot (TELEGRAM_API_URL)")
+
+    try:
+        while True:
+            line = input().strip()
+            if not line:
+                continue
+            user_id = args.user
+            if line.startswith('@'):
+                user, _, line = line[1:].partition(' ')
+                user_id = int(user)
+            deliver(user_id, line)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
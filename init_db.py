@@ -7,7 +7,7 @@ from datetime import datetime
 import pytz
 
 # Импортируем функцию для подключения к базе данных
-from db_utils import get_db_connection
+from db_utils import get_db_connection, db_timestamp
 
 def init_database():
     print("Инициализация базы данных...")
@@ -25,7 +25,7 @@ def init_database():
             first_name VARCHAR(255),
             last_name VARCHAR(255),
             phone_number VARCHAR(20),
-            registration_date TIMESTAMP,
+            registration_date TIMESTAMPTZ,
             is_admin BOOLEAN DEFAULT FALSE
         )
         """)
@@ -37,7 +37,7 @@ def init_database():
             first_name TEXT,
             last_name TEXT,
             phone_number TEXT,
-            registration_date TEXT,
+            registration_date INTEGER,
             is_admin INTEGER DEFAULT 0
         )
         """)
@@ -51,7 +51,7 @@ def init_database():
             first_name VARCHAR(255),
             last_name VARCHAR(255),
             phone_number VARCHAR(20),
-            request_date TIMESTAMP
+            request_date TIMESTAMPTZ
         )
         """)
     else:
@@ -62,7 +62,7 @@ def init_database():
             first_name TEXT,
             last_name TEXT,
             phone_number TEXT,
-            request_date TEXT
+            request_date INTEGER
         )
         """)
     
@@ -72,10 +72,9 @@ def init_database():
         CREATE TABLE IF NOT EXISTS logs (
             id SERIAL PRIMARY KEY,
             user_id BIGINT,
-            username VARCHAR(255),
             action VARCHAR(255),
             action_data TEXT,
-            timestamp TIMESTAMP
+            timestamp TIMESTAMPTZ
         )
         """)
     else:
@@ -83,10 +82,9 @@ def init_database():
         CREATE TABLE IF NOT EXISTS logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
-            username TEXT,
             action TEXT,
             action_data TEXT,
-            timestamp TEXT
+            timestamp INTEGER
         )
         """)
     
@@ -147,7 +145,7 @@ def init_database():
     if admin_count == 0:
         print("Добавление первого администратора...")
         admin_id = int(os.environ.get('ADMIN_ID', '123456789'))  # ID администратора из переменной окружения или значение по умолчанию
-        now = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
+        now = db_timestamp(db_type)
         
         if db_type == 'postgres':
             cursor.execute(
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+# Для скольких пользователей помнить, какую клавиатуру им отправили последней
+KEYBOARD_USERS_MAX_SIZE = int(os.environ.get('KEYBOARD_USERS_MAX_SIZE', '10000'))
+
+# Готовая клавиатура: markup - уже сериализованный JSON для параметра reply_markup,
+# token - отпечаток содержимого (одинаковые кнопки дают одинаковый token)
+Keyboard = namedtuple('Keyboard', ['token', 'markup'])
+
+
+def make_keyboard(reply_markup):
+    """Сериализует клавиатуру telegram в Keyboard"""
+    # Поля со значением false Telegram подставляет сам, их не передаем
+    data = reply_markup.to_dict()
+    markup = json.dumps({k: v for k, v in data.items() if v is not False})
+    return Keyboard(zlib.crc32(markup.encode('utf-8')), markup)
+
+
+class KeyboardCache:
+    """
+    Кэш клавиатур: (версия кнопок, вид клавиатуры) -> Keyboard.
+
+    build(version, layout) возвращает (объект клавиатуры telegram, момент, до которого она
+    не изменится, или None). Клавиатура строится и сериализуется один раз на версию и вид.
+    Кроме того, кэш помнит token последней клавиатуры каждого пользователя,
+    чтобы не отправлять ему ту же клавиатуру повторно.
+    """
+
+    def __init__(self, build, max_users=KEYBOARD_USERS_MAX_SIZE):
+        self._build = build
+        self.max_users = max_users
+        # (версия, вид) -> (Keyboard, момент устаревания или None)
+        self._keyboards = {}
+        # user_id -> token последней отправленной клавиатуры
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version, layout):
+        """Возвращает клавиатуру для версии и вида, при необходимости строя ее"""
+        key = (version, layout)
+        item = self._keyboards.get(key)
+        if item is not None and (item[1] is None or item[1] > time.time()):
+            return item[0]
+
+        reply_markup, valid_until = self._build(version, layout)
+        keyboard = make_keyboard(reply_markup)
+        with self._lock:
+            # Клавиатуры прошлых версий больше не понадобятся
+            self._keyboards = {k: v for k, v in self._keyboards.items() if k[0] == version}
+            self._keyboards[key] = (keyboard, valid_until)
+        return keyboard
+
+    def install(self, version, keyboards):
+        """
+        Заменяет все клавиатуры кэша заранее построенными:
+        keyboards - словарь {вид: (Keyboard, момент устаревания или None)}.
+        """
+        prepared = {(version, layout): item for layout, item in keyboards.items()}
+        with self._lock:
+            self._keyboards = prepared
+
+    def is_current(self, user_id, keyboard):
+        """Видит ли пользователь уже эту клавиатуру"""
+        with self._lock:
+            return self._users.get(user_id) == keyboard.token
+
+    def remember(self, user_id, keyboard):
+        """Запоминает, что пользователю отправлена клавиатура"""
+        with self._lock:
+            self._users[user_id] = keyboard.token
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
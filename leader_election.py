@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from db_utils import (open_leader_connection, try_leader_lock, check_leader_lock, release_leader_lock,
+                      acquire_leader_lease, release_leader_lease)
+
+logger = logging.getLogger(__name__)
+
+# Срок аренды роли ведущего (SQLite) и время, за которое PostgreSQL замечает
+# исчезнувший процесс и снимает его блокировку
+LEADER_LEASE_SECONDS = float(os.environ.get('LEADER_LEASE_SECONDS', '15'))
+# Как часто (в секундах) ведущий продлевает аренду или проверяет соединение с блокировкой
+LEADER_HEARTBEAT_INTERVAL = float(os.environ.get('LEADER_HEARTBEAT_INTERVAL', '5'))
+# Как часто (в секундах) резервный экземпляр пытается стать ведущим
+LEADER_RETRY_INTERVAL = float(os.environ.get('LEADER_RETRY_INTERVAL', '2'))
+
+
+class AdvisoryLock:
+    """
+    Сессионная advisory-блокировка PostgreSQL на отдельном соединении.
+
+    Блокировку снимает сам сервер, когда сессия заканчивается, поэтому после
+    падения ведущего резервный экземпляр получает ее при следующей попытке.
+    """
+
+    def __init__(self, dead_peer_timeout=LEADER_LEASE_SECONDS):
+        self.dead_peer_timeout = dead_peer_timeout
+        self._conn = None
+
+    def acquire(self):
+        if self._conn is None:
+            self._conn = open_leader_connection(self.dead_peer_timeout)
+        try:
+            return try_leader_lock(self._conn)
+        except Exception:
+            self._close()
+            raise
+
+    def renew(self):
+        # Пока сессия жива, блокировка за ней; с разрывом соединения она потеряна
+        try:
+            check_leader_lock(self._conn)
+            return True
+        except Exception as e:
+            logger.error(f"Соединение с блокировкой ведущего потеряно: {e}")
+            self._close()
+            return False
+
+    def release(self):
+        if self._conn is None:
+            return
+        try:
+            release_leader_lock(self._conn)
+        finally:
+            self._close()
+
+    def _close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class LeaseLock:
+    """Аренда роли ведущего в таблице leader_lease (SQLite), продлеваемая держателем"""
+
+    def __init__(self, holder, lease_seconds=LEADER_LEASE_SECONDS):
+        self.holder = holder
+        self.lease_seconds = lease_seconds
+
+    def acquire(self):
+        return acquire_leader_lease(self.holder, self.lease_seconds)
+
+    def renew(self):
+        return acquire_leader_lease(self.holder, self.lease_seconds)
+
+    def release(self):
+        release_leader_lease(self.holder)
+
+
+def make_leader_lock(holder):
+    """Advisory-блокировка, если бот работает с PostgreSQL, иначе аренда в SQLite"""
+    if os.environ.get('DATABASE_URL'):
+        return AdvisoryLock()
+    return LeaseLock(holder)
+
+
+class LeaderElection:
+    """
+    Выбор ведущего экземпляра бота через базу данных.
+
+    Фоновый поток раз в retry_interval секунд пытается взять блокировку; получив
+    ее, устанавливает событие acquired и вызывает on_acquired(), а затем раз
+    в heartbeat_interval секунд продлевает ее. Если блокировка перешла к другому
+    экземпляру или не продлевалась дольше срока аренды, вызывается on_lost().
+    """
+
+    def __init__(self, on_acquired=None, on_lost=None, lease_seconds=LEADER_LEASE_SECONDS,
+                 heartbeat_interval=LEADER_HEARTBEAT_INTERVAL, retry_interval=LEADER_RETRY_INTERVAL):
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._on_acquired = on_acquired
+        self._on_lost = on_lost
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.retry_interval = retry_interval
+        self.acquired = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = None
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self.acquired.is_set()
+
+    def start(self):
+        """Запускает фоновый поток выбора (повторный вызов ничего не делает)"""
+        if self._thread is not None:
+            return
+        self._lock = make_leader_lock(self.holder)
+        self._thread = threading.Thread(target=self._run, name='leader-election', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает поток и освобождает блокировку, чтобы резервный экземпляр занял место сразу"""
+        self._stopping.set()
+        # При потере роли stop вызывается из самого потока выбора
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.heartbeat_interval + 1)
+        if self.acquired.is_set():
+            self.acquired.clear()
+            try:
+                self._lock.release()
+                logger.info("Роль ведущего освобождена")
+            except Exception as e:
+                logger.error(f"Не удалось освободить роль ведущего: {e}")
+
+    def _run(self):
+        waiting_logged = False
+        while not self._stopping.is_set():
+            try:
+                if self._lock.acquire():
+                    break
+                if not waiting_logged:
+                    logger.info("Ведущий экземпляр уже работает, ждем своей очереди")
+                    waiting_logged = True
+            except Exception as e:
+                logger.error(f"Ошибка при выборе ведущего экземпляра: {e}")
+            self._stopping.wait(self.retry_interval)
+        else:
+            return
+        if self._stopping.is_set():
+            # Блокировку получили, когда бот уже останавливался
+            self._lock.release()
+            return
+
+        renewed_at = time.monotonic()
+        self.acquired.set()
+        logger.info(f"Экземпляр {self.holder} стал ведущим")
+        if self._on_acquired is not None:
+            self._on_acquired()
+
+        while not self._stopping.wait(self.heartbeat_interval):
+            try:
+                held = self._lock.renew()
+            except Exception as e:
+                # Временная ошибка базы: аренда еще действует, пробуем снова
+                logger.error(f"Не удалось продлить роль ведущего: {e}")
+                held = time.monotonic() - renewed_at < self.lease_seconds - self.heartbeat_interval
+            else:
+                if held:
+                    renewed_at = time.monotonic()
+            if not held:
+                if self._stopping.is_set():
+                    return
+                self.acquired.clear()
+                logger.error("Экземпляр перестал быть ведущим")
+                if self._on_lost is not None:
+                    self._on_lost()
+                return
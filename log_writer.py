@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Максимальное количество записей, ожидающих сохранения
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+# Записи сохраняются пачкой, как только их накопится столько...
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', '100'))
+# ...или когда с момента первой записи в пачке пройдет столько миллисекунд
+LOG_FLUSH_INTERVAL_MS = int(os.environ.get('LOG_FLUSH_INTERVAL_MS', '500'))
+# Что делать при переполненной очереди: 'drop' - отбросить запись, 'block' - ждать места
+LOG_QUEUE_POLICY = os.environ.get('LOG_QUEUE_POLICY', 'drop')
+
+POLICY_DROP = 'drop'
+POLICY_BLOCK = 'block'
+
+
+class _Marker:
+    """Служебный элемент очереди: просьба сохранить накопленное (и, возможно, остановиться)"""
+
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.done = threading.Event()
+
+
+class LogWriter:
+    """
+    Фоновая запись логов в базу данных.
+
+    Обработчики только кладут запись в ограниченную очередь, а отдельный поток
+    сохраняет накопленные записи одной транзакцией через write_batch(rows).
+    """
+
+    def __init__(self, write_batch, queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 flush_interval_ms=LOG_FLUSH_INTERVAL_MS, policy=LOG_QUEUE_POLICY):
+        if policy not in (POLICY_DROP, POLICY_BLOCK):
+            raise ValueError(f"Неизвестная политика очереди логов: {policy}")
+        self._write_batch = write_batch
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.policy = policy
+        self.dropped = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Запускает фоновый поток (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+
+    def enqueue(self, row):
+        """Ставит запись в очередь; возвращает False, если запись отброшена"""
+        self.start()
+        if self.policy == POLICY_BLOCK:
+            self._queue.put(row)
+            return True
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            # Не засоряем журнал: сообщаем о каждой сотой потерянной записи
+            if self.dropped % 100 == 1:
+                logger.warning(f"Очередь логов переполнена, отброшено записей: {self.dropped}")
+            return False
+
+    def flush(self, timeout=None):
+        """Ждет, пока все поставленные в очередь записи будут сохранены"""
+        return self._send_marker(_Marker(), timeout)
+
+    def stop(self, timeout=None):
+        """Сохраняет оставшиеся записи и останавливает фоновый поток"""
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        return self._send_marker(_Marker(stop=True), timeout)
+
+    def _send_marker(self, marker, timeout):
+        self.start()
+        # Маркер ставится в очередь даже при политике 'drop', иначе flush может потеряться
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=wait)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, _Marker):
+                self._save(batch)
+                batch, deadline = [], None
+                item.done.set()
+                if item.stop:
+                    return
+                continue
+
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._save(batch)
+                batch, deadline = [], None
+
+    def _save(self, batch):
+        if not batch:
+            return
+        try:
+            self._write_batch(batch)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении {len(batch)} записей лога: {e}")
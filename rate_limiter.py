@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Лимиты по классам запросов в формате "<запас>/<секунд>": запас запросов подряд
+# и время, за которое он восстанавливается полностью
+RATE_LIMIT_BUTTON = os.environ.get('RATE_LIMIT_BUTTON', '5/10')
+RATE_LIMIT_START = os.environ.get('RATE_LIMIT_START', '3/30')
+RATE_LIMIT_COMMAND = os.environ.get('RATE_LIMIT_COMMAND', '10/20')
+# Одинаковые запросы пользователя в пределах этого окна (секунд) молча отбрасываются
+RATE_LIMIT_DUPLICATE_WINDOW = float(os.environ.get('RATE_LIMIT_DUPLICATE_WINDOW', '2'))
+# Максимальное количество пользователей, для которых хранится состояние (самые давние вытесняются)
+RATE_LIMIT_MAX_USERS = int(os.environ.get('RATE_LIMIT_MAX_USERS', '10000'))
+
+# Классы запросов
+CLASS_BUTTON = 'button'
+CLASS_START = 'start'
+CLASS_COMMAND = 'command'
+
+# Решения ограничителя
+ALLOW = 'allow'
+DUPLICATE = 'duplicate'
+SHED = 'shed'
+# Запрос отброшен, и это первый отброшенный запрос с момента исчерпания запаса
+SHED_NOTIFY = 'shed_notify'
+
+
+def parse_rate_limit(value):
+    """Разбирает лимит "<запас>/<секунд>" в пару (запас, пополнение в секунду)"""
+    capacity, period = value.split('/', 1)
+    capacity, period = float(capacity), float(period)
+    if capacity <= 0 or period <= 0:
+        raise ValueError(f"Некорректный лимит запросов: {value}")
+    return capacity, capacity / period
+
+
+DEFAULT_LIMITS = {
+    CLASS_BUTTON: parse_rate_limit(RATE_LIMIT_BUTTON),
+    CLASS_START: parse_rate_limit(RATE_LIMIT_START),
+    CLASS_COMMAND: parse_rate_limit(RATE_LIMIT_COMMAND),
+}
+
+
+class _UserState:
+    """Корзины токенов пользователя по классам и его последний принятый запрос"""
+
+    __slots__ = ('buckets', 'last_payload', 'last_at', 'notified')
+
+    def __init__(self):
+        # класс -> [токены, момент последнего пополнения]
+        self.buckets = {}
+        self.last_payload = None
+        self.last_at = 0.0
+        # классы, о превышении лимита которых пользователю уже сообщили
+        self.notified = set()
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты запросов по алгоритму token bucket, в памяти процесса.
+
+    Для каждого пользователя и класса запросов хранится корзина: запрос тратит
+    один токен, токены пополняются с постоянной скоростью до запаса корзины.
+    Повтор того же запроса в пределах duplicate_window отбрасывается, не тратя токен.
+    """
+
+    def __init__(self, limits=None, duplicate_window=RATE_LIMIT_DUPLICATE_WINDOW,
+                 max_users=RATE_LIMIT_MAX_USERS):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.duplicate_window = duplicate_window
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, user_id, request_class, payload=None, now=None):
+        """Возвращает ALLOW, DUPLICATE, SHED или SHED_NOTIFY для очередного запроса"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is None:
+                state = self._users[user_id] = _UserState()
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+
+            if (payload is not None and payload == state.last_payload
+                    and now - state.last_at < self.duplicate_window):
+                return DUPLICATE
+
+            limit = self.limits.get(request_class)
+            if limit is not None:
+                capacity, rate = limit
+                bucket = state.buckets.get(request_class)
+                if bucket is None:
+                    bucket = state.buckets[request_class] = [capacity, now]
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                if bucket[0] < 1:
+                    if request_class in state.notified:
+                        return SHED
+                    state.notified.add(request_class)
+                    return SHED_NOTIFY
+                bucket[0] -= 1
+                state.notified.discard(request_class)
+
+            state.last_payload = payload
+            state.last_at = now
+            return ALLOW
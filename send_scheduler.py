@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Сколько сообщений в секунду отправлять во все чаты вместе (лимит Telegram - около 30)
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', '30'))
+# Минимальный интервал (секунд) между сообщениями в один личный чат
+SEND_CHAT_INTERVAL = float(os.environ.get('SEND_CHAT_INTERVAL', '1'))
+# Минимальный интервал (секунд) между сообщениями в одну группу (лимит Telegram - 20 в минуту)
+SEND_GROUP_INTERVAL = float(os.environ.get('SEND_GROUP_INTERVAL', '3'))
+# Сколько раз повторять отправку после ответа RetryAfter
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', '5'))
+# Сколько запросов к Telegram может выполняться одновременно (в один чат - всегда по одному)
+SEND_CONCURRENCY = int(os.environ.get('SEND_CONCURRENCY', '4'))
+
+# Очереди приоритета: ответы пользователям обгоняют массовые рассылки
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# После скольких запомненных чатов удалять сведения о давно обслуженных
+_CHAT_PRUNE_SIZE = 10000
+
+
+class _SendJob:
+    __slots__ = ('chat_id', 'send', 'priority', 'future', 'attempts', 'key')
+
+    def __init__(self, chat_id, send, priority):
+        self.chat_id = chat_id
+        self.send = send
+        self.priority = priority
+        self.future = Future()
+        self.attempts = 0
+        # (не раньше чем, порядковый номер) - место задания в очереди своего приоритета
+        self.key = None
+
+
+class SendScheduler:
+    """
+    Планировщик исходящих сообщений.
+
+    Обработчики передают в submit() функцию отправки, а фоновый поток выбирает
+    очередное сообщение, соблюдая общий лимит сообщений в секунду и интервал между
+    сообщениями в один чат, и передает его одному из concurrency отправляющих потоков,
+    чтобы медленный ответ Telegram не задерживал остальные чаты. В один чат сообщения
+    отправляются по одному и в порядке submit(). Ответы пользователям
+    (PRIORITY_INTERACTIVE) отправляются раньше рассылок (PRIORITY_BULK). Получив
+    RetryAfter, планировщик приостанавливает все отправки на указанное Telegram время
+    и повторяет сообщение.
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_interval=SEND_CHAT_INTERVAL,
+                 group_interval=SEND_GROUP_INTERVAL, max_retries=SEND_MAX_RETRIES,
+                 concurrency=SEND_CONCURRENCY):
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_retries = max_retries
+        self.concurrency = max(1, concurrency)
+        # приоритет -> куча (не раньше чем, порядковый номер, задание)
+        self._lanes = {PRIORITY_INTERACTIVE: [], PRIORITY_BULK: []}
+        # chat_id -> момент, раньше которого в чат нельзя отправлять следующее сообщение
+        self._chat_next = {}
+        # chat_id -> задание, которое сейчас отправляется в чат (или ждет повтора после RetryAfter)
+        self._sending = {}
+        # chat_id -> задания, ожидающие окончания отправки предыдущего сообщения в чат
+        self._waiting = {}
+        self._running = 0
+        self._executor = None
+        self._tokens = global_rate
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._pending = 0
+        self._seq = itertools.count()
+        self._stopping = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Запускает фоновый поток (повторный вызов ничего не делает)"""
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='send')
+                self._thread = threading.Thread(target=self._run, name='send-scheduler', daemon=True)
+                self._thread.start()
+
+    def submit(self, chat_id, send, priority=PRIORITY_INTERACTIVE):
+        """Ставит отправку в очередь; возвращает Future с результатом send()"""
+        self.start()
+        job = _SendJob(chat_id, send, priority)
+        with self._cond:
+            now = time.monotonic()
+            interval = self.group_interval if chat_id is not None and chat_id < 0 else self.chat_interval
+            not_before = max(now, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = not_before + interval
+            if len(self._chat_next) > _CHAT_PRUNE_SIZE:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+            job.key = (not_before, next(self._seq))
+            heapq.heappush(self._lanes[priority], (*job.key, job))
+            self._pending += 1
+            self._cond.notify()
+        return job.future
+
+    def flush(self, timeout=None):
+        """Ждет, пока все поставленные в очередь сообщения будут отправлены"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def stop(self, timeout=None):
+        """Отправляет оставшиеся сообщения и останавливает фоновый поток"""
+        done = self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        return done
+
+    def _next_job(self, now):
+        """Возвращает (задание, None) или (None, сколько секунд ждать)"""
+        if now < self._paused_until:
+            return None, self._paused_until - now
+
+        self._tokens = min(self.global_rate, self._tokens + (now - self._refilled_at) * self.global_rate)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return None, (1 - self._tokens) / self.global_rate
+
+        wait = None
+        for priority in sorted(self._lanes):
+            lane = self._lanes[priority]
+            while lane and lane[0][0] <= now:
+                job = heapq.heappop(lane)[2]
+                sending = self._sending.get(job.chat_id)
+                if sending is not None and sending is not job:
+                    # Предыдущее сообщение в этот чат еще отправляется
+                    self._waiting.setdefault(job.chat_id, deque()).append(job)
+                    continue
+                self._tokens -= 1
+                return job, None
+            if lane and (wait is None or lane[0][0] - now < wait):
+                wait = lane[0][0] - now
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping and self._pending == 0:
+                        self._executor.shutdown(wait=False)
+                        return
+                    if self._running >= self.concurrency:
+                        self._cond.wait()
+                        continue
+                    job, wait = self._next_job(time.monotonic())
+                    if job is not None:
+                        break
+                    self._cond.wait(wait)
+                self._running += 1
+                self._sending[job.chat_id] = job
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        try:
+            result = job.send()
+        except RetryAfter as e:
+            job.attempts += 1
+            with self._cond:
+                # Telegram просит подождать: приостанавливаем все отправки, а не только этот чат
+                self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+                if job.attempts <= self.max_retries:
+                    logger.warning(f"Flood control: пауза {e.retry_after} с, повтор сообщения в чат {job.chat_id}")
+                    # Чат остается за этим заданием, чтобы следующие сообщения не обогнали повтор
+                    heapq.heappush(self._lanes[job.priority],
+                                   (self._paused_until, next(self._seq), job))
+                    self._running -= 1
+                    self._cond.notify_all()
+                    return
+            logger.error(f"Сообщение в чат {job.chat_id} не отправлено после {job.attempts} попыток: {e}")
+            job.future.set_exception(e)
+            self._finish(job)
+            return
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения в чат {job.chat_id}: {e}")
+            job.future.set_exception(e)
+            self._finish(job)
+            return
+        job.future.set_result(result)
+        self._finish(job)
+
+    def _finish(self, job):
+        with self._cond:
+            self._running -= 1
+            self._pending -= 1
+            if self._sending.get(job.chat_id) is job:
+                del self._sending[job.chat_id]
+            # Следующее сообщение в этот чат возвращается в очередь на прежнее место, впереди
+            # более поздних сообщений в тот же чат, которые еще не выбраны из очереди
+            waiting = self._waiting.get(job.chat_id)
+            if waiting:
+                next_job = waiting.popleft()
+                if not waiting:
+                    del self._waiting[job.chat_id]
+                heapq.heappush(self._lanes[next_job.priority], (*next_job.key, next_job))
+            self._cond.notify_all()
@@ -40,8 +40,10 @@ try:
     if not admin_id:
         print("Предупреждение: Не указан ID администратора (ADMIN_ID)")
     
-    # Запускаем бот
-    subprocess.run([sys.executable, "bot.py"])
+    # Запускаем бот; код выхода передаем дальше, чтобы платформа перезапустила
+    # бот, завершившийся с ошибкой (например, потерявший роль ведущего)
+    result = subprocess.run([sys.executable, "bot.py"])
+    sys.exit(result.returncode)
     
 except Exception as e:
     print(f"Ошибка при запуске бота: {e}")
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import db_utils
+
+
+class TemporaryDatabaseTestCase(unittest.TestCase):
+    """Тест с отдельной базой SQLite во временном каталоге"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        environ = mock.patch.dict(os.environ, {'RAILWAY_VOLUME_MOUNT_PATH': directory.name})
+        environ.start()
+        os.environ.pop('DATABASE_URL', None)
+        self.addCleanup(environ.stop)
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(self.reset_connection)
+        self.reset_connection()
+        db_utils.setup_database()
+
+    @staticmethod
+    def reset_connection():
+        """Закрывает SQLite-соединение текущего потока, чтобы следующее открылось в новой базе"""
+        conn = getattr(db_utils._sqlite_local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        db_utils._sqlite_local.conn = None
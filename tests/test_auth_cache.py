@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from auth_cache import AuthCache, Principal, Profile
+
+
+class AuthCacheTest(unittest.TestCase):
+    def test_invalidate_by_temp_row_id(self):
+        cache = AuthCache(ttl=60)
+        # Пользователь с Telegram ID 42 найден по username в строке с временным ID -7
+        cache.set(Principal(42, True, False, Profile(-7, 'student', None, None)))
+        cache.set(Principal(43, True, False, Profile(43, 'other', None, None)))
+        cache.invalidate(-7)
+        self.assertIsNone(cache.get(42))
+        self.assertIsNotNone(cache.get(43))
+
+    def test_invalidate_by_telegram_id(self):
+        cache = AuthCache(ttl=60)
+        cache.set(Principal(42, True, False, Profile(42, 'student', None, None)))
+        cache.invalidate(42)
+        self.assertIsNone(cache.get(42))
+
+    def test_entries_expire(self):
+        cache = AuthCache(ttl=0)
+        cache.set(Principal(42, False, False, None))
+        self.assertIsNone(cache.get(42))
+
+
+if __name__ == '__main__':
+    unittest.main()
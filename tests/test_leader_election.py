@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from db_utils import acquire_leader_lease, db_connection
+from leader_election import LeaderElection, LeaseLock
+from tests.helpers import TemporaryDatabaseTestCase
+
+
+class LeaseLockTest(TemporaryDatabaseTestCase):
+    def test_only_one_holder_while_lease_is_valid(self):
+        first, second = LeaseLock('a', lease_seconds=60), LeaseLock('b', lease_seconds=60)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertTrue(first.renew())
+        self.assertFalse(second.acquire())
+
+    def test_expired_lease_is_taken_over(self):
+        first, second = LeaseLock('a', lease_seconds=0.2), LeaseLock('b', lease_seconds=60)
+        self.assertTrue(first.acquire())
+        time.sleep(0.3)
+        self.assertTrue(second.acquire())
+        # Прежний держатель узнает о смене при следующем продлении
+        self.assertFalse(first.renew())
+
+    def test_released_lease_is_free_at_once(self):
+        first, second = LeaseLock('a', lease_seconds=60), LeaseLock('b', lease_seconds=60)
+        self.assertTrue(first.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+
+    def test_release_does_not_drop_other_holder(self):
+        first, second = LeaseLock('a', lease_seconds=60), LeaseLock('b', lease_seconds=60)
+        self.assertTrue(first.acquire())
+        second.release()
+        self.assertFalse(second.acquire())
+
+
+class LeaderElectionTest(TemporaryDatabaseTestCase):
+    def election(self, **kwargs):
+        acquired, lost = threading.Event(), threading.Event()
+        election = LeaderElection(acquired.set, lost.set, lease_seconds=1,
+                                  heartbeat_interval=0.05, retry_interval=0.05, **kwargs)
+        self.addCleanup(election.stop)
+        return election, acquired, lost
+
+    def test_standby_takes_over_when_leader_stops(self):
+        leader, leader_acquired, _ = self.election()
+        leader.start()
+        self.assertTrue(leader_acquired.wait(5))
+        standby, standby_acquired, _ = self.election()
+        standby.start()
+        self.assertFalse(standby_acquired.wait(0.3))
+        self.assertFalse(standby.is_leader)
+
+        leader.stop()
+        self.assertFalse(leader.is_leader)
+        self.assertTrue(standby_acquired.wait(5))
+        self.assertTrue(standby.is_leader)
+
+    def test_leader_notices_lease_taken_by_another_instance(self):
+        leader, acquired, lost = self.election()
+        leader.start()
+        self.assertTrue(acquired.wait(5))
+        # Ведущий не продлил аренду вовремя (например, процесс был приостановлен),
+        # и ее занял другой экземпляр
+        with db_connection() as (conn, db_type):
+            conn.cursor().execute("UPDATE leader_lease SET holder = 'other'")
+            conn.commit()
+        self.assertTrue(lost.wait(5))
+        self.assertFalse(leader.is_leader)
+        self.assertFalse(acquire_leader_lease(leader.holder, 60))
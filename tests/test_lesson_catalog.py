@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from db_utils import publish_lesson, load_lesson_catalog_versioned
+from tests.helpers import TemporaryDatabaseTestCase
+
+
+class LessonSlotTest(TemporaryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for title in ('1 мая', '8 мая', '15 мая'):
+            publish_lesson(title, f'Запись {title}')
+
+    def titles(self):
+        return [lesson.title for lesson in load_lesson_catalog_versioned()[1]]
+
+    def test_publish_puts_new_lesson_first(self):
+        self.assertEqual(self.titles(), ['15 мая', '8 мая', '1 мая'])
+
+    def test_second_slot_goes_below_latest(self):
+        publish_lesson('22 мая', 'Запись', slot=2)
+        self.assertEqual(self.titles(), ['15 мая', '22 мая', '8 мая', '1 мая'])
+
+    def test_first_slot_moves_existing_lesson_to_top(self):
+        publish_lesson('1 мая', 'Запись', slot=1)
+        self.assertEqual(self.titles(), ['1 мая', '15 мая', '8 мая'])
+
+    def test_existing_lesson_moves_to_its_slot(self):
+        publish_lesson('15 мая', 'Запись', slot=2)
+        self.assertEqual(self.titles(), ['8 мая', '15 мая', '1 мая'])
+
+    def test_slot_beyond_catalog_goes_last(self):
+        publish_lesson('22 мая', 'Запись', slot=9)
+        self.assertEqual(self.titles(), ['15 мая', '8 мая', '1 мая', '22 мая'])
+
+    def test_republish_without_slot_keeps_place(self):
+        publish_lesson('8 мая', 'Новая ссылка')
+        self.assertEqual(self.titles(), ['15 мая', '8 мая', '1 мая'])
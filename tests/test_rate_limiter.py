@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from rate_limiter import (RateLimiter, parse_rate_limit, ALLOW, DUPLICATE, SHED, SHED_NOTIFY,
+                          CLASS_BUTTON, CLASS_COMMAND)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        # Запас 3 запроса, пополнение 1 токен в секунду
+        self.limiter = RateLimiter(limits={CLASS_BUTTON: (3, 1.0), CLASS_COMMAND: (1, 0.1)},
+                                   duplicate_window=2)
+
+    def test_burst_then_shed_with_single_notification(self):
+        verdicts = [self.limiter.check(1, CLASS_BUTTON, f'b{i}', now=100) for i in range(5)]
+        self.assertEqual(verdicts, [ALLOW, ALLOW, ALLOW, SHED_NOTIFY, SHED])
+
+    def test_tokens_refill_over_time(self):
+        for i in range(3):
+            self.limiter.check(1, CLASS_BUTTON, f'b{i}', now=100)
+        self.assertEqual(self.limiter.check(1, CLASS_BUTTON, 'x', now=100.5), SHED_NOTIFY)
+        self.assertEqual(self.limiter.check(1, CLASS_BUTTON, 'y', now=101), ALLOW)
+        self.assertEqual(self.limiter.check(1, CLASS_BUTTON, 'z', now=101.1), SHED_NOTIFY)
+
+    def test_refill_is_capped_by_burst(self):
+        for i in range(3):
+            self.limiter.check(1, CLASS_BUTTON, f'b{i}', now=100)
+        verdicts = [self.limiter.check(1, CLASS_BUTTON, f'c{i}', now=1000) for i in range(4)]
+        self.assertEqual(verdicts, [ALLOW, ALLOW, ALLOW, SHED_NOTIFY])
+
+    def test_duplicate_does_not_spend_tokens(self):
+        self.assertEqual(self.limiter.check(1, CLASS_BUTTON, 'same', now=100), ALLOW)
+        self.assertEqual(self.limiter.check(1, CLASS_BUTTON, 'same', now=101), DUPLICATE)
+        self.assertEqual(self.limiter.check(1, CLASS_BUTTON, 'other', now=101), ALLOW)
+        self.assertEqual(self.limiter.check(1, CLASS_BUTTON, 'same', now=101), ALLOW)
+
+    def test_users_and_classes_are_independent(self):
+        self.assertEqual(self.limiter.check(1, CLASS_COMMAND, 'a', now=100), ALLOW)
+        self.assertEqual(self.limiter.check(1, CLASS_COMMAND, 'b', now=100), SHED_NOTIFY)
+        self.assertEqual(self.limiter.check(2, CLASS_COMMAND, 'a', now=100), ALLOW)
+        self.assertEqual(self.limiter.check(1, CLASS_BUTTON, 'c', now=100), ALLOW)
+
+    def test_parse_rate_limit(self):
+        self.assertEqual(parse_rate_limit('5/10'), (5.0, 0.5))
+        with self.assertRaises(ValueError):
+            parse_rate_limit('0/10')
+
+
+if __name__ == '__main__':
+    unittest.main()
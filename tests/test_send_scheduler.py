@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from send_scheduler import SendScheduler
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Условие не выполнилось вовремя")
+        time.sleep(0.005)
+
+
+class SendSchedulerOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = SendScheduler(global_rate=1000, chat_interval=0.05, concurrency=2)
+        self.delivered = []
+        self.started = {}
+        self.release = {}
+
+    def tearDown(self):
+        for event in self.release.values():
+            event.set()
+        self.scheduler.stop(timeout=5)
+
+    def send(self, name, blocking=False):
+        self.started[name] = threading.Event()
+        self.release[name] = threading.Event()
+        if not blocking:
+            self.release[name].set()
+
+        def send():
+            self.started[name].set()
+            self.release[name].wait(5)
+            self.delivered.append(name)
+            return name
+        return send
+
+    def test_waiting_message_is_not_overtaken_by_later_one(self):
+        # A отправляется долго; B ждет окончания A; Y занимает второй поток, поэтому C
+        # остается в очереди. После A первой в чат 1 должна уйти B, а не C
+        self.scheduler.submit(1, self.send('A', blocking=True))
+        self.started['A'].wait(5)
+        self.scheduler.submit(1, self.send('B'))
+        wait_until(lambda: 1 in self.scheduler._waiting)
+        self.scheduler.submit(2, self.send('Y', blocking=True))
+        self.started['Y'].wait(5)
+        self.scheduler.submit(1, self.send('C'))
+        time.sleep(0.1)
+
+        self.release['A'].set()
+        wait_until(lambda: len(self.delivered) == 3)
+        self.release['Y'].set()
+        self.assertTrue(self.scheduler.flush(5))
+        self.assertEqual([name for name in self.delivered if name != 'Y'], ['A', 'B', 'C'])
+
+    def test_chats_are_sent_concurrently(self):
+        self.scheduler.submit(1, self.send('A', blocking=True))
+        self.started['A'].wait(5)
+        future = self.scheduler.submit(2, self.send('B'))
+        self.assertEqual(future.result(timeout=5), 'B')
+        self.assertEqual(self.delivered, ['B'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from update_sequencer import UpdateSequencer
+
+
+class UpdateSequencerTest(unittest.TestCase):
+    def setUp(self):
+        self.sequencer = UpdateSequencer(workers=4)
+
+    def tearDown(self):
+        self.sequencer.stop(timeout=5)
+
+    def test_tasks_of_one_key_run_in_order_and_never_overlap(self):
+        done = []
+        running = []
+        overlaps = []
+
+        def task(number):
+            def run():
+                if running:
+                    overlaps.append(number)
+                running.append(number)
+                time.sleep(0.002)
+                running.remove(number)
+                done.append(number)
+            return run
+
+        for number in range(50):
+            self.sequencer.submit('user', task(number))
+        self.assertTrue(self.sequencer.stop(timeout=5))
+        self.assertEqual(done, list(range(50)))
+        self.assertEqual(overlaps, [])
+
+    def test_different_keys_run_in_parallel(self):
+        # Задача первого пользователя ждет, пока не выполнится задача второго
+        second_done = threading.Event()
+        results = []
+        self.sequencer.submit(1, lambda: results.append(second_done.wait(5)))
+        self.sequencer.submit(2, second_done.set)
+        self.assertTrue(self.sequencer.stop(timeout=5))
+        self.assertEqual(results, [True])
+
+    def test_slow_key_does_not_block_others(self):
+        release = threading.Event()
+        finished = threading.Event()
+        self.sequencer.submit(1, lambda: release.wait(5))
+        self.sequencer.submit(1, lambda: None)
+        self.sequencer.submit(2, finished.set)
+        self.assertTrue(finished.wait(5))
+        release.set()
+
+    def test_failing_task_does_not_stop_its_queue(self):
+        done = []
+
+        def fail():
+            raise RuntimeError("ошибка обработчика")
+
+        self.sequencer.submit('user', fail)
+        self.sequencer.submit('user', lambda: done.append(True))
+        self.assertTrue(self.sequencer.stop(timeout=5))
+        self.assertEqual(done, [True])
+
+    def test_stop_times_out_while_task_runs(self):
+        release = threading.Event()
+        self.sequencer.submit('user', lambda: release.wait(5))
+        self.assertFalse(self.sequencer.stop(timeout=0.05))
+        release.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
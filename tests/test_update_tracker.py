@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+from unittest import mock
+
+from db_utils import get_last_update_id, save_last_update_id
+from tests.helpers import TemporaryDatabaseTestCase
+from update_tracker import UpdateTracker
+
+
+class UpdateTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = []
+        self.tracker = UpdateTracker(lambda: None, self.saved.append)
+
+    def dispatch(self, update_id, tasks=0):
+        self.tracker.begin(update_id)
+        for _ in range(tasks):
+            self.tracker.add_task(update_id)
+        self.tracker.end_dispatch(update_id)
+
+    def test_nothing_processed_initially(self):
+        self.assertIsNone(self.tracker.processed())
+        self.tracker.save()
+        self.assertEqual(self.saved, [])
+
+    def test_watermark_waits_for_earliest_unfinished_update(self):
+        self.dispatch(1, tasks=1)
+        self.dispatch(2)
+        self.dispatch(3, tasks=1)
+        self.assertEqual(self.tracker.processed(), 0)
+        # Обновление 3 закончено раньше 1: отметка не сдвигается через незаконченное
+        self.tracker.task_done(3)
+        self.assertEqual(self.tracker.processed(), 0)
+        self.tracker.task_done(1)
+        self.assertEqual(self.tracker.processed(), 3)
+
+    def test_update_is_unfinished_while_dispatcher_handles_it(self):
+        self.dispatch(1)
+        self.tracker.begin(2)
+        self.tracker.add_task(2)
+        self.tracker.task_done(2)
+        self.assertEqual(self.tracker.processed(), 1)
+        self.tracker.end_dispatch(2)
+        self.assertEqual(self.tracker.processed(), 2)
+
+    def test_interrupted_dispatch_is_closed_by_next_update(self):
+        # Разбор обновления 1 прервался до последней группы обработчиков
+        self.tracker.begin(1)
+        self.dispatch(2)
+        self.assertEqual(self.tracker.processed(), 2)
+
+    def test_update_dropped_before_handlers_is_processed(self):
+        # Предобработчик отбросил обновление 2 (DispatcherHandlerStop) и сам закончил его разбор
+        self.dispatch(1)
+        self.tracker.begin(2)
+        self.tracker.end_dispatch(2)
+        self.assertEqual(self.tracker.processed(), 2)
+        self.tracker.save()
+        self.assertEqual(self.saved, [2])
+
+    def test_save_writes_only_changes(self):
+        self.dispatch(1)
+        self.tracker.save()
+        self.tracker.save()
+        self.dispatch(2)
+        self.tracker.save()
+        self.assertEqual(self.saved, [1, 2])
+
+    def test_restore_marks_earlier_updates_processed(self):
+        tracker = UpdateTracker(lambda: (10, time.time()), self.saved.append)
+        self.assertEqual(tracker.restore(), 10)
+        self.assertTrue(tracker.is_processed(10))
+        self.assertFalse(tracker.is_processed(11))
+        self.assertEqual(tracker.processed(), 10)
+        tracker.save()
+        self.assertEqual(self.saved, [])
+
+    def test_stale_offset_is_ignored(self):
+        tracker = UpdateTracker(lambda: (10, time.time() - 2 * 86400), self.saved.append)
+        self.assertIsNone(tracker.restore())
+        self.assertFalse(tracker.is_processed(5))
+
+
+class UpdateOffsetPersistenceTest(TemporaryDatabaseTestCase):
+    def test_offset_survives_restart(self):
+        self.assertIsNone(get_last_update_id())
+        tracker = UpdateTracker(get_last_update_id, save_last_update_id)
+        for update_id in (5, 6, 7):
+            tracker.begin(update_id)
+            tracker.end_dispatch(update_id)
+        tracker.save()
+
+        update_id, saved_at = get_last_update_id()
+        self.assertEqual(update_id, 7)
+        self.assertLess(abs(time.time() - saved_at), 5)
+
+        restarted = UpdateTracker(get_last_update_id, save_last_update_id)
+        self.assertEqual(restarted.restore(), 7)
+        self.assertTrue(restarted.is_processed(7))
+        self.assertFalse(restarted.is_processed(8))
+
+    def test_saved_offset_never_goes_back(self):
+        save_last_update_id(20)
+        save_last_update_id(15)
+        self.assertEqual(get_last_update_id()[0], 20)
+        save_last_update_id(25)
+        self.assertEqual(get_last_update_id()[0], 25)
+
+    def test_old_offset_is_replaced_by_lower_one(self):
+        # Через двое суток Telegram мог начать нумерацию обновлений заново
+        with mock.patch('db_utils.time.time', return_value=time.time() - 2 * 86400):
+            save_last_update_id(1000)
+        save_last_update_id(3)
+        self.assertEqual(get_last_update_id()[0], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+
+from telegram.ext import Updater
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд Telegram держит запрос getUpdates, ожидая новых обновлений
+POLL_TIMEOUT = float(os.environ.get('POLL_TIMEOUT', '30'))
+# Сколько обновлений получать за один запрос (не больше 100)
+POLL_LIMIT = min(100, max(1, int(os.environ.get('POLL_LIMIT', '100'))))
+# Пауза (секунд) после каждого ответа getUpdates; при длинном опросе она только добавляет задержку
+POLL_INTERVAL = float(os.environ.get('POLL_INTERVAL', '0'))
+# Как часто (в секундах) писать в лог сводку по размерам пачек getUpdates
+POLL_STATS_INTERVAL = float(os.environ.get('POLL_STATS_INTERVAL', '300'))
+
+
+class PollStats:
+    """Счетчики запросов getUpdates и размеров полученных пачек за текущий интервал"""
+
+    def __init__(self, limit=POLL_LIMIT, interval=POLL_STATS_INTERVAL):
+        self.limit = limit
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        self.started_at = now
+        self.polls = 0
+        self.empty = 0
+        self.full = 0
+        self.updates = 0
+        self.largest = 0
+
+    def record(self, batch_size, now=None):
+        """Учитывает ответ getUpdates; раз в interval секунд пишет сводку в лог"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.polls += 1
+            self.updates += batch_size
+            self.largest = max(self.largest, batch_size)
+            if batch_size == 0:
+                self.empty += 1
+            elif batch_size >= self.limit:
+                # Полная пачка: на сервере, скорее всего, остались обновления
+                self.full += 1
+            if self.interval > 0 and now - self.started_at >= self.interval:
+                logger.info(self.summary(now))
+                self._reset(now)
+
+    def summary(self, now=None):
+        now = time.monotonic() if now is None else now
+        batches = self.polls - self.empty
+        average = self.updates / batches if batches else 0
+        return (f"getUpdates за {now - self.started_at:.0f} с: запросов {self.polls}, пустых {self.empty}, "
+                f"обновлений {self.updates}, в среднем {average:.1f} на непустую пачку, "
+                f"максимум {self.largest}, полных пачек (limit {self.limit}) {self.full}")
+
+
+class PollingUpdater(Updater):
+    """
+    Updater, запрашивающий обновления пачками до POLL_LIMIT штук и считающий
+    размеры пачек в PollStats (Updater из python-telegram-bot 13 не передает limit).
+    """
+
+    def __init__(self, *args, poll_limit=POLL_LIMIT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.poll_limit = poll_limit
+        self.poll_stats = PollStats(poll_limit)
+
+    def stop_receiving(self):
+        """
+        Прекращает опрос, не останавливая диспетчер. Пачка, полученная после этого,
+        не подтверждается и придет снова после перезапуска.
+        """
+        self.running = False
+
+    def _start_polling(self, poll_interval, timeout, read_latency, bootstrap_retries, drop_pending_updates,
+                       allowed_updates, ready=None):
+        self._bootstrap(bootstrap_retries, drop_pending_updates=drop_pending_updates, webhook_url='',
+                        allowed_updates=None)
+
+        def polling_action_cb():
+            updates = self.bot.get_updates(self.last_update_id, limit=self.poll_limit, timeout=timeout,
+                                           read_latency=read_latency, allowed_updates=allowed_updates)
+            self.poll_stats.record(len(updates))
+            if updates:
+                if not self.running:
+                    logger.debug("Обновления не приняты: бот останавливается")
+                else:
+                    for update in updates:
+                        self.update_queue.put(update)
+                    self.last_update_id = updates[-1].update_id + 1
+            return True
+
+        def polling_onerr_cb(exc):
+            # Ошибку обрабатывает обработчик ошибок диспетчера
+            self.update_queue.put(exc)
+
+        if ready is not None:
+            ready.set()
+
+        self._network_loop_retry(polling_action_cb, polling_onerr_cb, 'getting Updates', poll_interval)
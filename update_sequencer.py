@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import queue
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Сколько обновлений обрабатывается одновременно (обновления одного пользователя - всегда по очереди)
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '8'))
+
+# Служебный элемент очереди: просьба рабочему потоку завершиться
+_STOP = object()
+
+
+class UpdateSequencer:
+    """
+    Пул рабочих потоков с очередью на каждого пользователя.
+
+    Задачи с одним ключом (user_id) выполняются строго в порядке поступления
+    и никогда одновременно, задачи разных ключей - параллельно в workers потоках.
+    После каждой задачи ключ встает в конец общей очереди, поэтому пользователь
+    с длинной очередью не задерживает остальных.
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS):
+        self.workers = max(1, workers)
+        # ключ -> очередь его задач; ключ есть в словаре, пока у него есть задачи
+        self._queues = {}
+        self._ready = queue.Queue()
+        self._pending = 0
+        self._threads = []
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Запускает рабочие потоки (повторный вызов ничего не делает)"""
+        with self._cond:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'update-worker-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, key, task):
+        """Ставит task() в очередь ключа key"""
+        self.start()
+        with self._cond:
+            tasks = self._queues.get(key)
+            if tasks is None:
+                self._queues[key] = deque([task])
+                self._ready.put(key)
+            else:
+                tasks.append(task)
+            self._pending += 1
+
+    def stop(self, timeout=None):
+        """Дожидается выполнения поставленных задач и останавливает рабочие потоки"""
+        with self._cond:
+            done = self._cond.wait_for(lambda: self._pending == 0, timeout)
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._ready.put(_STOP)
+        return done
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            if key is _STOP:
+                return
+            with self._cond:
+                task = self._queues[key].popleft()
+            try:
+                task()
+            except Exception as e:
+                logger.error(f"Ошибка при обработке обновления ({key}): {e}")
+            with self._cond:
+                if self._queues[key]:
+                    self._ready.put(key)
+                else:
+                    del self._queues[key]
+                self._pending -= 1
+                self._cond.notify_all()
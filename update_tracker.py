@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Сообщения старше этого количества секунд (например, накопившиеся, пока бот был
+# остановлен) не обрабатываются; 0 - обрабатывать все
+UPDATE_MAX_AGE = float(os.environ.get('UPDATE_MAX_AGE', '900'))
+# Как часто (в секундах) сохранять ID последнего обработанного обновления
+UPDATE_OFFSET_SAVE_INTERVAL = float(os.environ.get('UPDATE_OFFSET_SAVE_INTERVAL', '5'))
+
+# Сохраненный ID старше суток не используется: после долгого перерыва Telegram
+# может начать нумерацию обновлений заново
+_OFFSET_TRUST_PERIOD = 86400
+
+
+class DrainMarker:
+    """Элемент очереди диспетчера: отмечает, что все обновления перед ним разобраны"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class UpdateTracker:
+    """
+    Учет обработанных обновлений Telegram.
+
+    Диспетчер отмечает начало (begin) и конец (end_dispatch) разбора обновления,
+    а задачи обработчиков, поставленные в пул, - свое начало и окончание
+    (add_task/task_done). Обновление обработано, когда закончены и разбор, и задачи;
+    processed() - наибольший ID, до которого (включительно) обработаны все обновления.
+    Он сохраняется через save(update_id) и читается после перезапуска через
+    load() -> (update_id, момент сохранения) или None.
+    """
+
+    def __init__(self, load, save):
+        self._load = load
+        self._save = save
+        # update_id -> [незавершенных задач, разбор диспетчером еще идет]
+        self._inflight = {}
+        self._dispatching = None
+        self._last_seen = None
+        self._saved = None
+        # ID, до которого (включительно) обновления обработаны до перезапуска
+        self.resume_from = None
+        self._lock = threading.Lock()
+
+    def restore(self):
+        """Читает сохраненный ID; возвращает его или None, если его нет или он устарел"""
+        loaded = self._load()
+        if loaded is None:
+            return None
+        update_id, saved_at = loaded
+        if saved_at is None or time.time() - saved_at > _OFFSET_TRUST_PERIOD:
+            logger.info(f"Сохраненный ID обновления {update_id} устарел и не используется")
+            return None
+        with self._lock:
+            self.resume_from = self._saved = self._last_seen = update_id
+        return update_id
+
+    def is_processed(self, update_id):
+        """Было ли обновление обработано до перезапуска"""
+        return self.resume_from is not None and update_id <= self.resume_from
+
+    def begin(self, update_id):
+        with self._lock:
+            # Разбор предыдущего обновления мог прерваться до последней группы обработчиков
+            if self._dispatching is not None:
+                self._end_dispatch(self._dispatching)
+            self._inflight[update_id] = [0, True]
+            self._dispatching = update_id
+            if self._last_seen is None or update_id > self._last_seen:
+                self._last_seen = update_id
+
+    def end_dispatch(self, update_id):
+        with self._lock:
+            self._end_dispatch(update_id)
+
+    def _end_dispatch(self, update_id):
+        if self._dispatching == update_id:
+            self._dispatching = None
+        entry = self._inflight.get(update_id)
+        if entry is not None:
+            entry[1] = False
+            if entry[0] == 0:
+                del self._inflight[update_id]
+
+    def add_task(self, update_id):
+        with self._lock:
+            entry = self._inflight.get(update_id)
+            if entry is not None:
+                entry[0] += 1
+
+    def task_done(self, update_id):
+        with self._lock:
+            entry = self._inflight.get(update_id)
+            if entry is not None:
+                entry[0] -= 1
+                if entry[0] == 0 and not entry[1]:
+                    del self._inflight[update_id]
+
+    def processed(self):
+        with self._lock:
+            if self._inflight:
+                return min(self._inflight) - 1
+            return self._last_seen
+
+    def save(self):
+        """Сохраняет ID последнего обработанного обновления, если он изменился"""
+        update_id = self.processed()
+        if update_id is None or update_id == self._saved:
+            return
+        try:
+            self._save(update_id)
+            self._saved = update_id
+        except Exception as e:
+            logger.error(f"Не удалось сохранить ID последнего обновления: {e}")
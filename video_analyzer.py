@@ -9,6 +9,7 @@ from datetime import datetime
 import pytz
 import logging
 from names_loader import NamesLoader
+from db_utils import LEGACY_LESSON_ACTIONS, DB_TYPE_POSTGRES, DB_TYPE_SQLITE, execute_statement
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -17,7 +18,8 @@ logger = logging.getLogger('VideoAnalyzer')
 class VideoDownloadsAnalyzer:
     """Класс для анализа скачиваний видео из базы данных"""
     
-    def __init__(self, db_type='sqlite', database=None, host=None, user=None, password=None, port=None):
+    def __init__(self, db_type='sqlite', database=None, host=None, user=None, password=None, port=None,
+                 connection=None):
         """Инициализация анализатора
         
         Args:
@@ -27,15 +29,20 @@ class VideoDownloadsAnalyzer:
             user: пользователь для PostgreSQL
             password: пароль для PostgreSQL
             port: порт для PostgreSQL
+            connection: уже открытое соединение (например, из пула db_utils);
+                анализатор не закрывает его в disconnect()
         """
         self.db_type = db_type.lower()
+        # Тип базы в обозначениях db_utils (для именованных запросов)
+        self.dialect = DB_TYPE_POSTGRES if self.db_type == 'postgresql' else DB_TYPE_SQLITE
         self.database = database
         self.host = host
         self.user = user
         self.password = password
         self.port = port
-        self.conn = None
-        self.cursor = None
+        self.conn = connection
+        self.cursor = connection.cursor() if connection is not None else None
+        self.owns_connection = connection is None
         
         # Загрузим данные о пользователях из CSV
         try:
@@ -45,17 +52,11 @@ class VideoDownloadsAnalyzer:
             logger.error(f"Ошибка при загрузке данных о пользователях: {e}")
             self.names_loader = None
         
-        # Соответствие действий датам
-        self.action_to_date_map = {
-            'get_video_18 мая': '18 мая',
-            'get_latest_video': '18 мая',  # Последнее видео - это 18 мая
-            'get_video_22 мая': '22 мая',
-            'get_previous_video': '22 мая',  # Предыдущее видео - это 22 мая
-            'get_video_25 мая': '25 мая'
-        }
+        # Соответствие действий датам (по нему размечены старые записи logs.lesson_id)
+        self.action_to_date_map = dict(LEGACY_LESSON_ACTIONS)
         
-        # Известные даты занятий
-        self.known_dates = ['18 мая', '22 мая', '25 мая']
+        # Известные даты занятий: берутся из каталога при получении данных о скачиваниях
+        self.known_dates = []
     
     def connect(self):
         """Подключение к базе данных"""
@@ -98,8 +99,12 @@ class VideoDownloadsAnalyzer:
         if self.conn:
             if self.cursor:
                 self.cursor.close()
-            self.conn.close()
-            logger.info("Соединение с базой данных закрыто")
+                self.cursor = None
+            # Чужое соединение (из пула) закрывает тот, кто его передал
+            if self.owns_connection:
+                self.conn.close()
+                logger.info("Соединение с базой данных закрыто")
+            self.conn = None
     
     def get_video_downloads(self):
         """Получить данные о загрузках видео по датам
@@ -112,88 +117,26 @@ class VideoDownloadsAnalyzer:
                 logger.error("Не удалось подключиться к базе данных")
                 return {}
         
-        result = {date: [] for date in self.known_dates}
-        
         try:
-            # Проверим структуру таблицы logs
-            try:
-                if self.db_type == 'postgresql':
-                    self.cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'logs'")
-                else:  # SQLite
-                    self.cursor.execute("PRAGMA table_info(logs)")
-                columns = self.cursor.fetchall()
-                logger.info(f"Столбцы таблицы logs: {columns}")
-                
-                # Проверим количество записей
-                self.cursor.execute("SELECT COUNT(*) FROM logs")
-                count = self.cursor.fetchone()[0]
-                logger.info(f"Всего записей в таблице logs: {count}")
-                
-                # Проверим типы действий
-                self.cursor.execute("SELECT DISTINCT action FROM logs LIMIT 20")
-                actions = self.cursor.fetchall()
-                logger.info(f"Примеры действий: {actions}")
-            except Exception as e:
-                logger.error(f"Ошибка при проверке структуры базы данных: {e}")
+            # Получателей берем из сводной таблицы lesson_downloads: ее размер
+            # зависит только от числа занятий и студентов, а не от объема logs
+            users_by_lesson = {}
+            execute_statement(self.cursor, self.dialect, 'lesson_recipients')
+            for title, *user_row in self.cursor.fetchall():
+                users_by_lesson.setdefault(title, []).append(tuple(user_row))
+            
+            # Занятия берем из каталога (новые первыми), затем добавляем занятия,
+            # которые известны только по старым скачиваниям
+            execute_statement(self.cursor, self.dialect, 'catalog_titles')
+            self.known_dates = [row[0] for row in self.cursor.fetchall()]
+            self.known_dates += [title for title in users_by_lesson if title not in self.known_dates]
+            result = {date: [] for date in self.known_dates}
             
-            # Для каждой даты получаем список пользователей
             for date in self.known_dates:
-                # Самый простой запрос, который работает в обоих типах баз данных
-                query = """
-                    SELECT DISTINCT l.username, l.user_id, u.first_name, u.last_name
-                    FROM logs l
-                    LEFT JOIN users u ON l.user_id = u.user_id
-                    WHERE (l.action_data LIKE ? OR l.action LIKE ?)
-                    ORDER BY l.username
-                """
-                
-                params = [f'%{date}%', f'%{date}%']
-                
-                # Для PostgreSQL нужно заменить ? на %s
-                if self.db_type == 'postgresql':
-                    query = query.replace('?', '%s')
-                
-                logger.info(f"Запрос для даты {date}: {query}")
-                logger.info(f"Параметры: {params}")
-                
                 try:
-                    self.cursor.execute(query, params)
-                    users = self.cursor.fetchall()
+                    users = users_by_lesson.get(date, [])
                     logger.info(f"Найдено пользователей для даты {date}: {len(users)}")
                 
-                    # Если ничего не нашли, попробуем еще один запрос
-                    if len(users) == 0:
-                        # Попробуем поискать по конкретным действиям
-                        if date == '25 мая':
-                            actions_to_check = ['get_video_25 мая', 'video_25']
-                        elif date == '22 мая':
-                            actions_to_check = ['get_video_22 мая', 'get_previous_video', 'video_22']
-                        elif date == '18 мая':
-                            actions_to_check = ['get_video_18 мая', 'get_latest_video', 'video_18']
-                        else:
-                            actions_to_check = []
-                        
-                        if actions_to_check:
-                            placeholders = ', '.join(['%s' if self.db_type == 'postgresql' else '?'] * len(actions_to_check))
-                            action_query = f"""
-                                SELECT DISTINCT l.username, l.user_id, u.first_name, u.last_name
-                                FROM logs l
-                                LEFT JOIN users u ON l.user_id = u.user_id
-                                WHERE l.action IN ({placeholders})
-                                ORDER BY l.username
-                            """
-                            
-                            logger.info(f"Дополнительный запрос для даты {date}: {action_query}")
-                            logger.info(f"Параметры: {actions_to_check}")
-                            
-                            try:
-                                self.cursor.execute(action_query, actions_to_check)
-                                more_users = self.cursor.fetchall()
-                                logger.info(f"Найдено дополнительных пользователей: {len(more_users)}")
-                                users.extend(more_users)
-                            except Exception as e:
-                                logger.error(f"Ошибка в дополнительном запросе: {e}")
-                
                     # Формируем список пользователей для этой даты
                     for user_row in users:
                         username, user_id, first_name, last_name = user_row
@@ -267,23 +210,7 @@ class VideoDownloadsAnalyzer:
         
         try:
             # Запрос для получения самых активных пользователей
-            query = """
-                SELECT l.user_id, l.username, u.first_name, u.last_name, COUNT(*) as action_count
-                FROM logs l
-                LEFT JOIN users u ON l.user_id = u.user_id
-                GROUP BY l.user_id, l.username, u.first_name, u.last_name
-                ORDER BY action_count DESC
-                LIMIT %s
-            """ if self.db_type == 'postgresql' else """
-                SELECT l.user_id, l.username, u.first_name, u.last_name, COUNT(*) as action_count
-                FROM logs l
-                LEFT JOIN users u ON l.user_id = u.user_id
-                GROUP BY l.user_id, l.username, u.first_name, u.last_name
-                ORDER BY action_count DESC
-                LIMIT ?
-            """
-            
-            self.cursor.execute(query, (limit,))
+            execute_statement(self.cursor, self.dialect, 'top_active_users', (limit,))
             top_users = self.cursor.fetchall()
             
             # Формируем отчет
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+import logging
+import os
+import time
+
+import tornado.web
+from telegram.error import NetworkError, RetryAfter
+from telegram.ext import Updater
+from telegram.ext.utils.webhookhandler import WebhookHandler, WebhookServer
+
+logger = logging.getLogger(__name__)
+
+# Как получать обновления: 'polling' - запрашивать у Telegram, 'webhook' - принимать по HTTP
+UPDATE_MODE = os.environ.get('UPDATE_MODE', 'polling')
+UPDATE_MODE_POLLING = 'polling'
+UPDATE_MODE_WEBHOOK = 'webhook'
+# Публичный адрес, на который Telegram отправляет обновления (без пути), например https://bot.example.com
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+# Адрес и порт локального HTTP-сервера (TLS снимает прокси платформы перед ним)
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', '8443')))
+# Путь, по которому принимаются обновления
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+# Секрет, который Telegram передает в заголовке каждого запроса; запросы без него отклоняются
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN', '')
+# Сколько одновременных соединений Telegram может открывать к вебхуку (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Пауза (секунд) между попытками установить вебхук
+_BOOTSTRAP_INTERVAL = 5
+
+
+class SecretWebhookHandler(WebhookHandler):
+    """Обработчик вебхука, принимающий только запросы с правильным секретом в заголовке"""
+
+    def initialize(self, bot, update_queue, secret_token=None):
+        super().initialize(bot, update_queue)
+        self.secret_token = secret_token
+
+    def _validate_post(self):
+        super()._validate_post()
+        if self.secret_token:
+            received = self.request.headers.get(SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(received.encode('utf-8'), self.secret_token.encode('utf-8')):
+                logger.warning(f"Запрос к вебхуку с неверным секретом от {self.request.remote_ip}")
+                raise tornado.web.HTTPError(403)
+
+
+class SecretWebhookApp(tornado.web.Application):
+    def __init__(self, webhook_path, bot, update_queue, secret_token=None):
+        shared_objects = {'bot': bot, 'update_queue': update_queue, 'secret_token': secret_token}
+        super().__init__([(rf"{webhook_path}/?", SecretWebhookHandler, shared_objects)])
+
+    def log_request(self, handler):
+        pass
+
+
+class WebhookUpdater(Updater):
+    """
+    Updater, проверяющий секрет вебхука.
+
+    python-telegram-bot 13 передает secret_token в set_webhook, но не проверяет его
+    во входящих запросах, поэтому HTTP-приложение вебхука заменено своим.
+    Сертификаты не поддерживаются: сервер слушает HTTP за TLS-прокси.
+    """
+
+    def __init__(self, *args, secret_token=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.secret_token = secret_token or None
+
+    def stop_receiving(self):
+        """Закрывает HTTP-сервер вебхука, не останавливая диспетчер"""
+        self.running = False
+        self._stop_httpd()
+
+    def _start_webhook(self, listen, port, url_path, cert, key, bootstrap_retries, drop_pending_updates,
+                       webhook_url, allowed_updates, ready=None, ip_address=None, max_connections=40):
+        if not url_path.startswith('/'):
+            url_path = f'/{url_path}'
+
+        app = SecretWebhookApp(url_path, self.bot, self.update_queue, self.secret_token)
+        self.httpd = WebhookServer(listen, port, app, None)
+
+        attempt = 0
+        while True:
+            try:
+                self.bot.set_webhook(url=webhook_url, allowed_updates=allowed_updates,
+                                     drop_pending_updates=drop_pending_updates,
+                                     max_connections=max_connections, secret_token=self.secret_token)
+                break
+            except (NetworkError, RetryAfter) as e:
+                attempt += 1
+                if 0 <= bootstrap_retries < attempt:
+                    raise
+                logger.warning(f"Не удалось установить вебхук (попытка {attempt}): {e}")
+                time.sleep(e.retry_after if isinstance(e, RetryAfter) else _BOOTSTRAP_INTERVAL)
+        logger.info(f"Вебхук установлен: {webhook_url}")
+
+        self.httpd.serve_forever(ready=ready)
+
+
+def webhook_url():
+    """Полный адрес вебхука из WEBHOOK_URL и WEBHOOK_PATH"""
+    return f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH.strip('/')}"